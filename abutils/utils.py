@@ -1,10 +1,17 @@
 # Standard
+import csv
+import itertools
 import uuid
 import socket
+import logging
+import threading
+import time
+from collections import OrderedDict
 
 # Third Party
-from django.db.models import Model
-from django.http import HttpRequest
+from django.conf import settings
+from django.db.models import Model, QuerySet
+from django.http import HttpRequest, StreamingHttpResponse
 
 # Local
 
@@ -45,3 +52,102 @@ def request_is_from_host(request: HttpRequest, hostname: str) -> bool:
     req_ip = get_ip_address(request)
     host_ip = socket.gethostbyname(hostname)
     return req_ip == host_ip
+
+
+class LRUCache(object):
+    """
+    A small in-process cache whose entries expire after ttl seconds, evicting the least recently used
+    entry once it holds max_size entries. Sits in front of the shared Django cache for very hot lookups.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expiry time, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return (True, value) if key is cached and fresh, else (False, None)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            expiry, value = entry
+            if expiry < time.monotonic():
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def redis_connection():
+    """The connection to the Redis server shared with the rq worker. Only meaningful if INTSYS_ASYNC_JOBS is True."""
+    import redis
+    return redis.from_url(settings.INTSYS_REDIS_URL)
+
+
+def run_in_background(queue_name: str, func, *args, **kwargs):
+    """
+    Run func(*args, **kwargs) on the rq worker's named queue ('high', 'default', or 'low').
+    If background jobs are disabled (see INTSYS_ASYNC_JOBS) or can't be queued, func is run immediately instead.
+    :return: func's result if it was run immediately, else None.
+    """
+    if getattr(settings, 'INTSYS_ASYNC_JOBS', False):
+        try:
+            from rq import Queue
+            Queue(queue_name, connection=redis_connection()).enqueue(func, *args, **kwargs)
+            return None
+        except Exception as e:
+            logger = logging.getLogger("xerocraft-django")
+            logger.warning("Couldn't queue %s, so running it now. %s", func.__name__, str(e))
+    return func(*args, **kwargs)
+
+
+def iterate_in_chunks(queryset: QuerySet, chunk_size: int=1000):
+    """
+    Iterate over queryset's objects in pk order, fetching chunk_size of them per query.
+    Unlike .iterator(), this keeps memory use flat even though the DB driver buffers whole result sets,
+    and select_related() still applies to each chunk.
+    """
+    queryset = queryset.order_by('pk')
+    last_pk = None
+    while True:
+        chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        chunk = list(chunk[:chunk_size])
+        if len(chunk) == 0:
+            return
+        for obj in chunk:
+            yield obj
+        last_pk = chunk[-1].pk
+
+
+class _Echo(object):
+    """A pseudo-buffer whose write() returns what it's given, so that csv.writer rows can be streamed."""
+
+    def write(self, value):
+        return value
+
+
+def streaming_csv_response(filename: str, header: list, rows) -> StreamingHttpResponse:
+    """A CSV download that is written as the rows iterable is consumed, so it starts right away."""
+    writer = csv.writer(_Echo())
+    response = StreamingHttpResponse(
+        (writer.writerow(row) for row in itertools.chain([header], rows)),
+        content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
+    return response
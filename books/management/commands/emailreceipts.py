@@ -18,12 +18,17 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         mv = DonationMailView()
         for donation in Donation.objects.filter(send_receipt=True).all():
-            sent = mv.send(donation)
-            if sent:
-                donation.send_receipt = False
-                donation.save()
-                DonationNote.objects.create(
-                    donation=donation,
-                    author=None,
-                    content="Receipt emailed on {}.".format(date.today().isoformat())
-                )
\ No newline at end of file
+            result = mv.send(donation)
+            if result == mv.SEND_FAILED:
+                continue
+            if result == mv.SEND_QUEUED:
+                content = "Receipt queued for email on {}."
+            else:
+                content = "Receipt was still waiting to be emailed on {}, so it wasn't queued again."
+            donation.send_receipt = False
+            donation.save()
+            DonationNote.objects.create(
+                donation=donation,
+                author=None,
+                content=content.format(date.today().isoformat())
+            )
\ No newline at end of file
@@ -1,5 +1,7 @@
+from datetime import date
 from django.test import TestCase
 from books.models import MonetaryDonation, Sale
+from members.tests import DirectorsOnlyMixin
 from pydoc import locate  # for loading classes
 
 
@@ -14,4 +16,21 @@ class TestMonetaryDonation(TestCase):
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =]
 
+class TestSalesCsv(DirectorsOnlyMixin, TestCase):
+
+    directors_only_urls = ['book:csv-sales']
+
+    def setUp(self):
+        super().setUp()
+        for n in range(3):
+            Sale.objects.create(sale_date=date(2016, 6, 20), payer_name="Payer {}".format(n), total_paid_by_customer=10)
+
+    def test_sales(self):
+        response = self.get_as_director('book:csv-sales')
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertTrue(lines[0].startswith("id,sale date,deposit date"))
+        self.assertEqual([line.split(",")[4] for line in lines[1:]], ["Payer 0", "Payer 1", "Payer 2"])
+
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =]
+
 
@@ -14,6 +14,8 @@ urlpatterns = [
     url(r'^net-income-vs-date-chart/$', views.net_income_vs_date_chart, name='net-income-vs-date-chart'),
     url(r'^net-income-vs-date-chart/2/$', views.net_income_vs_date_chart_2, name='net-income-vs-date-chart-2'),
 
+    url(r'^csv/sales/$', views.csv_sales_download, name='csv-sales'),
+
     # DJANGO REST FRAMEWORK API
     url(r'^', include(router.urls)),
 ]
@@ -9,6 +9,7 @@ from django.http.response import HttpResponse
 from django.contrib.auth.decorators import login_required
 
 # Local
+from abutils.utils import iterate_in_chunks, streaming_csv_response
 from .models import (
     ExpenseLineItem,
     Sale, SaleNote,
@@ -84,6 +85,31 @@ def net_income_vs_date_chart_2(request):  # This is a temporary view
     return render(request, 'books/net-income-vs-date-chart.html', {'data': acc_income_vs_time})
 
 
+# = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
+
+@login_required
+def csv_sales_download(request):
+
+    if not request.user.member.is_tagged_with("Director"):
+        return HttpResponse("This page is for Directors only.")
+
+    sales = Sale.objects.select_related('payer_acct')
+    rows = (
+        [
+            sale.pk, sale.sale_date, sale.deposit_date or "",
+            sale.payer_acct.username if sale.payer_acct is not None else "", sale.payer_name, sale.payer_email,
+            sale.get_payment_method_display(), sale.method_detail,
+            sale.total_paid_by_customer, sale.processing_fee, sale.ctrlid
+        ]
+        for sale in iterate_in_chunks(sales)
+    )
+    header = [
+        "id", "sale date", "deposit date", "payer acct", "payer name", "payer email",
+        "payment method", "method detail", "total paid", "processing fee", "ctrlid"
+    ]
+    return streaming_csv_response("sales.csv", header, rows)
+
+
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = SALE REST API
 
 class SaleViewSet(viewsets.ModelViewSet):  # Django REST Framework
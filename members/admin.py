@@ -11,7 +11,8 @@ from books.admin import Sellable
 from members.models import Tag, Pushover, Tagging, VisitEvent, \
     Member, Membership, PaidMembershipNudge, GroupMembership, \
     MemberNote, MemberLogin, MembershipGiftCardRedemption, \
-    MembershipGiftCard, MembershipGiftCardReference, DiscoveryMethod, WifiMacDetected
+    MembershipGiftCard, MembershipGiftCardReference, DiscoveryMethod, WifiMacDetected, \
+    PresenceInterval, DailyOccupancy
 
 
 @admin.register(Tag)
@@ -63,6 +64,21 @@ class WifiMacDetectedAdmin(admin.ModelAdmin):  # No need to version events.
     search_fields = ['mac']
 
 
+@admin.register(PresenceInterval)
+class PresenceIntervalAdmin(admin.ModelAdmin):  # Regenerated from raw events, so no need to version.
+    list_display = ['pk', 'source', 'who', 'mac', 'start', 'end', 'departed']
+    list_filter = ['source']
+    date_hierarchy = 'start'
+    raw_id_fields = ['who']
+
+
+@admin.register(DailyOccupancy)
+class DailyOccupancyAdmin(admin.ModelAdmin):
+    list_display = ['pk', 'date', 'source', 'count']
+    list_filter = ['source']
+    date_hierarchy = 'date'
+
+
 class MemberTypeFilter(admin.SimpleListFilter):
     title = "Worker Type"
     parameter_name = 'type'
@@ -0,0 +1,36 @@
+from decimal import Decimal
+from django.core.management.base import BaseCommand, CommandError
+import members.stats as stats
+
+
+def in_cents(revenue):
+    cents = Decimal('0.01')
+    return [(month, indi.quantize(cents), grp.quantize(cents)) for month, indi, grp in revenue]
+
+
+class Command(BaseCommand):
+
+    help = "Rebuilds the daily membership stats and monthly revenue tables from scratch, after which signals " \
+           "keep them current. " \
+           "Rerun it after changing memberships with QuerySet.update() or bulk_create(), which send no signals."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true', default=False,
+            help="Check that the tables give the same counts and revenue as computing from the memberships.")
+
+    def verify(self):
+        problems = []
+        if stats.member_counts_from_stats() != stats.member_counts():
+            problems.append("Member counts differ.")
+        if in_cents(stats.accrued_membership_revenue_from_stats()) != in_cents(stats.accrued_membership_revenue()):
+            problems.append("Monthly revenue differs.")
+        return problems
+
+    def handle(self, *args, **options):
+        row_count = stats.rebuild_daily_stats()
+        self.stdout.write("Wrote {} daily stat rows.".format(row_count))
+        if options['verify']:
+            problems = self.verify()
+            if len(problems) > 0:
+                raise CommandError(" ".join(problems))
+            self.stdout.write("Verified.")
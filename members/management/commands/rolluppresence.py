@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from members.presence import rollup, BATCH_SIZE
+
+
+class Command(BaseCommand):
+
+    help = "Rolls new visit events and WiFi detections up into presence intervals and daily occupancy counts."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+            help="The number of raw rows to roll up per transaction.")
+
+    def handle(self, *args, **options):
+        result = rollup(options['batch_size'])
+        for source, date_count in sorted(result.items()):
+            self.stdout.write("Source {}: occupancy updated for {} date(s).".format(source, date_count))
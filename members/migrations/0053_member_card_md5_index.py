@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('members', '0052_auto_20160812_1533'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='member',
+            name='membership_card_md5',
+            field=models.CharField(max_length=32, null=True, blank=True, db_index=True, help_text='MD5 of the random urlsafe base64 string on the membership card.'),
+        ),
+    ]
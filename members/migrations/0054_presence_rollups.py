@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('members', '0053_member_card_md5_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PresenceInterval',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('source', models.CharField(max_length=1, choices=[('V', 'Visit events'), ('W', 'WiFi MAC detections')], help_text='The kind of raw data this interval was rolled up from.')),
+                ('mac', models.CharField(max_length=12, blank=True, help_text='The MAC address that was present, if the source is WiFi detections.')),
+                ('start', models.DateTimeField(db_index=True, help_text='The first time presence was observed.')),
+                ('end', models.DateTimeField(db_index=True, help_text='The last time presence was observed, or the time of departure.')),
+                ('departed', models.BooleanField(default=False, help_text='True if the interval was ended by a departure event.')),
+                ('who', models.ForeignKey(null=True, blank=True, on_delete=django.db.models.deletion.CASCADE, to='members.Member', help_text='The member who was present, if the source is visit events.')),
+            ],
+            options={
+                'ordering': ['start'],
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='presenceinterval',
+            index_together=set([('source', 'end')]),
+        ),
+        migrations.CreateModel(
+            name='DailyOccupancy',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('date', models.DateField(help_text='The local date.')),
+                ('source', models.CharField(max_length=1, choices=[('V', 'Visit events'), ('W', 'WiFi MAC detections')], help_text='The kind of raw data this count was rolled up from.')),
+                ('count', models.IntegerField(help_text='The number of distinct members (or MACs) present at some point during the day.')),
+            ],
+            options={
+                'ordering': ['date'],
+                'verbose_name_plural': 'Daily occupancies',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailyoccupancy',
+            unique_together=set([('date', 'source')]),
+        ),
+        migrations.CreateModel(
+            name='RollupMark',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(max_length=40, unique=True, help_text='The name of the rollup.')),
+                ('last_id', models.IntegerField(default=0, help_text='Rows with ids above this have not been rolled up yet.')),
+            ],
+        ),
+    ]
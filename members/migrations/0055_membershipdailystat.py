@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from decimal import Decimal
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('members', '0054_presence_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MembershipDailyStat',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('date', models.DateField(help_text='The day these stats apply to.')),
+                ('membership_type', models.CharField(max_length=1, choices=[('R', 'Regular'), ('W', 'Work-Trade'), ('S', 'Scholarship'), ('C', 'Complimentary'), ('G', 'Group'), ('F', 'Family'), ('K', 'Gift Card'), ('P', 'Group Purchase')], help_text='The type of membership.')),
+                ('active_count', models.IntegerField(default=0, help_text='The number of memberships of this type that were active on this day.')),
+                ('revenue', models.DecimalField(max_digits=14, decimal_places=6, default=Decimal('0'), help_text="The revenue accrued on this day, with each sale price prorated over its membership's days.")),
+            ],
+            options={
+                'ordering': ['date'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='membershipdailystat',
+            unique_together=set([('date', 'membership_type')]),
+        ),
+    ]
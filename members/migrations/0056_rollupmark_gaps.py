@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('members', '0055_membershipdailystat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rollupmark',
+            name='gaps',
+            field=models.TextField(blank=True, default='', help_text='JSON object mapping missing ids at or below last_id to when they were noticed missing.'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('members', '0056_rollupmark_gaps'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='membershipdailystat',
+            name='revenue',
+        ),
+    ]
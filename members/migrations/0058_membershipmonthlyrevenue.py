@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('members', '0057_remove_membershipdailystat_revenue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MembershipMonthlyRevenue',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('month', models.DateField(unique=True, help_text='The first day of the month that this revenue was earned in.')),
+                ('indi_revenue', models.DecimalField(max_digits=20, decimal_places=10, help_text='The revenue earned this month from individual memberships.')),
+                ('group_revenue', models.DecimalField(max_digits=20, decimal_places=10, help_text='The revenue earned this month from group memberships.')),
+            ],
+            options={
+                'ordering': ['month'],
+            },
+        ),
+    ]
@@ -2,15 +2,17 @@
 
 # Standard
 import base64
+import copy
 import uuid
 import hashlib
 from datetime import datetime, date, timedelta
 from decimal import Decimal
-from typing import Union, Tuple
+from typing import Union, Tuple, Callable, Iterable, List
 
 # Third Party
-from django.db import models
+from django.db import models, connection
 from django.db.migrations.recorder import MigrationRecorder
+from django.core.cache import cache
 from django.utils import timezone
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
@@ -19,7 +21,7 @@ from nameparser import HumanName
 
 # Local
 from books.models import Sale
-from abutils.utils import generate_ctrlid
+from abutils.utils import generate_ctrlid, LRUCache
 
 
 TZ = timezone.get_default_timezone()
@@ -74,6 +76,27 @@ class Tag(models.Model):
         ordering = ['name']
 
 
+class MemberQuerySet(models.QuerySet):
+
+    def with_paid_status(self, on_date: date=None, grace_period: timedelta=timedelta(0)):
+        """Annotate each member with is_paid, i.e. whether a membership covers on_date (default today),
+        allowing the given grace period after the membership's end. This is done in the same query.
+        """
+        if on_date is None:
+            on_date = date.today()
+        qn = connection.ops.quote_name
+        sql = "EXISTS (SELECT 1 FROM {ms} WHERE {ms}.{member} = {m}.{pk} AND {ms}.{start} <= %s AND {ms}.{end} >= %s)"
+        sql = sql.format(
+            ms=qn(Membership._meta.db_table),
+            member=qn(Membership._meta.get_field('member').column),
+            start=qn(Membership._meta.get_field('start_date').column),
+            end=qn(Membership._meta.get_field('end_date').column),
+            m=qn(self.model._meta.db_table),
+            pk=qn(self.model._meta.pk.column),
+        )
+        return self.extra(select={'is_paid': sql}, select_params=(on_date, on_date-grace_period))
+
+
 class Member(models.Model):
     """Represents a Xerocraft member.
     Member is an extension of auth.User that adds Xerocraft-specific state like "tags".
@@ -84,7 +107,7 @@ class Member(models.Model):
         help_text="This must point to the corresponding auth.User object.")
 
     # Saving as MD5 provides some protection against read-only attacks.
-    membership_card_md5 = models.CharField(max_length=MEMB_CARD_STR_LEN, null=True, blank=True,
+    membership_card_md5 = models.CharField(max_length=MEMB_CARD_STR_LEN, null=True, blank=True, db_index=True,
         help_text="MD5 of the random urlsafe base64 string on the membership card.")
 
     membership_card_when = models.DateTimeField(null=True, blank=True,
@@ -101,49 +124,91 @@ class Member(models.Model):
     tags = models.ManyToManyField(Tag, blank=True, related_name="members",
         through='Tagging', through_fields=('tagged_member', 'tag'))
 
-    @staticmethod
-    def generate_auth_token_str(is_unique):
-        """Generate a token (and its md5) which will be used in nag email urls, icalendar urls, etc."""
+    objects = MemberQuerySet.as_manager()
 
-        # Note: This is very similar to the generator in membership. Should there be one util that serves both apps?
-
-        # Generate a token which is 32 characters of url-safe base64.
+    @staticmethod
+    def _new_auth_token() -> Tuple[str, str]:
+        """A new token, which is 32 characters of url-safe base64, and its md5."""
         u1 = uuid.uuid4().bytes
         u2 = uuid.uuid4().bytes
         b64 = base64.urlsafe_b64encode(u1+u2).decode()[:32]
+        return b64, hashlib.md5(b64.encode()).hexdigest()
 
-        # Calculate md5 of the b64 and start over if there's a md5 collision
-        md5 = hashlib.md5(b64.encode()).hexdigest()
-        if is_unique(md5):
-            return b64, md5
-        else:
-            # Collision detected, so try again.
-            return Member.generate_auth_token_str(is_unique)
+    @staticmethod
+    def generate_auth_token_strs(count: int, taken: Callable[[List[str]], Iterable[str]]) -> List[Tuple[str, str]]:
+        """Generate count tokens (and their md5s) which will be used in nag email urls, icalendar urls, etc.
+        Uniqueness is checked for all candidates at once: taken(md5s) must return those of the md5s already in use,
+        typically with a single IN query.
+        """
+        result = []
+        while len(result) < count:
+            candidates = {}
+            for _ in range(count - len(result)):
+                b64, md5 = Member._new_auth_token()
+                candidates[md5] = b64
+            for md5 in set(taken(list(candidates.keys()))):
+                del candidates[md5]  # Collision detected, so it will be replaced on the next pass.
+            result += [(b64, md5) for md5, b64 in candidates.items()]
+        return result
 
     def generate_member_card_str(self):
 
-        def unique(token: str) -> bool:
-            md5_count = Member.objects.filter(membership_card_md5=token).count()
-            assert md5_count <= 1 # Greater than 1 means collision checking has somehow failed in the past.
-            return md5_count == 0
+        def taken(md5s):
+            return Member.objects.filter(membership_card_md5__in=md5s).values_list('membership_card_md5', flat=True)
 
-        b64, md5 = Member.generate_auth_token_str(unique)
+        [(b64, md5)] = Member.generate_auth_token_strs(1, taken)
         # Save the the md5 of the base64 string in the member table.
+        Member.forget_card_md5(self.membership_card_md5)
+        Member.forget_card_md5(md5)
         self.membership_card_md5 = md5
         self.membership_card_when = timezone.now()
         self.save()
         return b64
 
+    # A member's tags are cached as a dict of tag name -> can_tag, memoized on the instance and kept in the
+    # shared cache. Tagging changes forget the member's entry, and Tag changes bump the version to forget them all.
+    # Without a cache shared between processes, those only reach the process that made the change, so entries
+    # are kept just long enough to cover the repeated checks of a burst of requests. Tags grant permissions
+    # (e.g. Director, Staff), so a revoked tag mustn't linger.
+    TAGS_VERSION_CACHE_KEY = "members.tags.version"
+    TAGS_CACHE_TIMEOUT = 10
+
+    @staticmethod
+    def _tags_cache_key(member_pk: int) -> str:
+        return "members.tags.%s.%d" % (cache.get(Member.TAGS_VERSION_CACHE_KEY, 0), member_pk)
+
+    @staticmethod
+    def forget_tags(member_pk: int):
+        """Call this when a member's taggings change."""
+        cache.delete(Member._tags_cache_key(member_pk))
+
+    @staticmethod
+    def forget_all_tags():
+        """Call this when a tag changes."""
+        try:
+            cache.incr(Member.TAGS_VERSION_CACHE_KEY)
+        except ValueError:  # Key isn't in the cache, yet.
+            cache.set(Member.TAGS_VERSION_CACHE_KEY, 1, None)
+
+    def tag_map(self) -> dict:
+        '''A dict mapping the names of the member's tags to whether the member can tag others with them.'''
+        result = getattr(self, '_tag_map', None)
+        if result is None:
+            cache_key = Member._tags_cache_key(self.pk)
+            result = cache.get(cache_key)
+            if result is None:
+                result = dict(Tagging.objects.filter(tagged_member=self).values_list('tag__name', 'can_tag'))
+                cache.set(cache_key, result, Member.TAGS_CACHE_TIMEOUT)
+            self._tag_map = result
+        return result
+
     def is_tagged_with(self, tag_name):
         '''Determine if member has a tag with the given tag-name.'''
-        return True if tag_name in [x.name for x in self.tags.all()] else False
+        return tag_name in self.tag_map()
 
     def can_tag_with(self, tag):
         '''Determine if member can tag others with tags having given tag-name.'''
-        for tagging in self.taggings.all():
-            if tagging.tag.name == tag.name:
-                return tagging.can_tag
-        return False
+        return self.tag_map().get(tag.name, False)
 
     def is_domain_staff(self):  # Different than website staff.
         return self.is_tagged_with("Staff")
@@ -151,14 +216,9 @@ class Member(models.Model):
     def is_currently_paid(self, grace_period=timedelta(0)):
         ''' Determine whether member is currently covered by a membership with a given grace period.'''
         now = datetime.now().date()
-
-        m = Membership.objects.filter(
+        return Membership.objects.filter(
             member=self,
-            start_date__lte=now, end_date__gte=now-grace_period)
-        if len(m) > 0:
-            return True
-
-        return False
+            start_date__lte=now, end_date__gte=now-grace_period).exists()
 
     @property
     def first_name(self)->str:
@@ -186,13 +246,60 @@ class Member(models.Model):
     @property
     def is_active(self): return self.auth_user.is_active
 
+    # Card lookups happen on every kiosk screen and card API call, so card md5 -> member (with auth_user) is cached
+    # in two tiers: briefly in-process, and for longer in the Django cache. Cards that don't identify anyone are
+    # cached only briefly, in the Django cache. Member and User signal handlers forget the affected cards.
+    # Tags aren't part of the cached member. They're cached, and forgotten, separately (see tag_map).
+    _card_lru = LRUCache(max_size=256, ttl=30)
+    CARD_CACHE_TIMEOUT = 60*60
+    CARD_NEGATIVE_CACHE_TIMEOUT = 10
+    _NO_MEMBER = 0  # Cached for cards that don't identify anyone.
+
+    @staticmethod
+    def _card_cache_key(member_card_md5: str) -> str:
+        return "members.card." + member_card_md5
+
+    @staticmethod
+    def forget_card_md5(member_card_md5: str):
+        """Call this when a card md5 starts or stops identifying a member."""
+        if member_card_md5 is None: return
+        Member._card_lru.delete(member_card_md5)
+        cache.delete(Member._card_cache_key(member_card_md5))
+
+    @staticmethod
+    def get_by_card_strs(card_strs: List[str]) -> List[Union['Member', None]]:
+        """The members identified by the card strings, or None for those that don't identify anyone.
+        Cards that aren't cached are looked up together, in a single query.
+        """
+        md5s = [hashlib.md5(card_str.encode()).hexdigest() for card_str in card_strs]
+        found = {}
+        for md5 in set(md5s):
+            hit, member = Member._card_lru.get(md5)
+            if not hit:
+                member = cache.get(Member._card_cache_key(md5))
+            if member is not None:
+                found[md5] = None if member == Member._NO_MEMBER else member
+
+        missing = [md5 for md5 in set(md5s) if md5 not in found]
+        if len(missing) > 0:
+            fetched = {m.membership_card_md5: m for m in
+                Member.objects.select_related('auth_user').filter(membership_card_md5__in=missing)}
+            for md5 in missing:
+                member = found[md5] = fetched.get(md5)
+                if member is None:
+                    cache.set(Member._card_cache_key(md5), Member._NO_MEMBER, Member.CARD_NEGATIVE_CACHE_TIMEOUT)
+                else:
+                    cache.set(Member._card_cache_key(md5), member, Member.CARD_CACHE_TIMEOUT)
+        for md5, member in found.items():
+            if member is not None:
+                Member._card_lru.set(md5, member)
+
+        # Callers get their own copies, including auth_user, so they can't alter the cached ones.
+        return [copy.deepcopy(found[md5]) for md5 in md5s]
+
     @staticmethod
     def get_by_card_str(member_card_str):
-        member_card_md5 = hashlib.md5(member_card_str.encode()).hexdigest()
-        try:
-            return Member.objects.get(membership_card_md5=member_card_md5)
-        except Member.DoesNotExist:
-            return None
+        return Member.get_by_card_strs([member_card_str])[0]
 
     @staticmethod
     def get_for_staff(member_card_str: str, staff_card_str: str) -> Tuple[bool, Union[Tuple['Member', 'Member'], str]]:
@@ -203,9 +310,8 @@ class Member(models.Model):
         :return: (True, (member, staff)) on success, (False, error_message) on failure
         """
         # Look up the subject member and the staff member and report various possible errors:
-        member = Member.get_by_card_str(member_card_str)
+        member, staff = Member.get_by_card_strs([member_card_str, staff_card_str])
         if member is None: return False, "Invalid member card"
-        staff = Member.get_by_card_str(staff_card_str)
         if staff is None: return False, "Invalid staff card"
         if not staff.is_domain_staff(): return False, "Not a staff member"
         return True, (member, staff)
@@ -389,6 +495,85 @@ class WifiMacDetected(models.Model):
         verbose_name_plural = "Wifi MACs detected"
 
 
+class PresenceInterval(models.Model):
+    """ A span of time during which a member (per visit events) or a MAC (per WiFi detections) was present.
+    These are rolled up from the raw VisitEvent and WifiMacDetected rows by the rolluppresence command.
+    """
+
+    SRC_VISITS = "V"
+    SRC_WIFI = "W"
+    SOURCE_CHOICES = [
+        (SRC_VISITS, "Visit events"),
+        (SRC_WIFI, "WiFi MAC detections"),
+    ]
+    source = models.CharField(max_length=1, choices=SOURCE_CHOICES, null=False, blank=False,
+        help_text="The kind of raw data this interval was rolled up from.")
+
+    who = models.ForeignKey(Member, null=True, blank=True,
+        on_delete=models.CASCADE,  # This is a summary that can be regenerated, so it isn't precious.
+        help_text="The member who was present, if the source is visit events.")
+
+    mac = models.CharField(max_length=12, blank=True,
+        help_text="The MAC address that was present, if the source is WiFi detections.")
+
+    start = models.DateTimeField(null=False, blank=False, db_index=True,
+        help_text="The first time presence was observed.")
+
+    end = models.DateTimeField(null=False, blank=False, db_index=True,
+        help_text="The last time presence was observed, or the time of departure.")
+
+    departed = models.BooleanField(default=False,
+        help_text="True if the interval was ended by a departure event.")
+
+    def __str__(self):
+        return "{}, {} to {}".format(
+            self.who if self.who_id is not None else self.mac, TZ.normalize(self.start), TZ.normalize(self.end))
+
+    class Meta:
+        ordering = ['start']
+        index_together = [('source', 'end')]
+
+
+class DailyOccupancy(models.Model):
+    """ The number of distinct members (or MACs) that were present on a given local date. """
+
+    date = models.DateField(null=False, blank=False,
+        help_text="The local date.")
+
+    source = models.CharField(max_length=1, choices=PresenceInterval.SOURCE_CHOICES, null=False, blank=False,
+        help_text="The kind of raw data this count was rolled up from.")
+
+    count = models.IntegerField(null=False, blank=False,
+        help_text="The number of distinct members (or MACs) present at some point during the day.")
+
+    def __str__(self):
+        return "{}, {}, {}".format(self.date, self.source, self.count)
+
+    class Meta:
+        ordering = ['date']
+        unique_together = ('date', 'source')
+        verbose_name_plural = "Daily occupancies"
+
+
+class RollupMark(models.Model):
+    """ High-water mark for an incremental rollup: the last raw row id that was rolled up.
+    Ids are assigned when rows are inserted but rows only become visible when their transaction commits,
+    so ids skipped over by the mark are remembered as gaps and rechecked in case they commit late.
+    """
+
+    name = models.CharField(max_length=40, unique=True,
+        help_text="The name of the rollup.")
+
+    last_id = models.IntegerField(default=0,
+        help_text="Rows with ids above this have not been rolled up yet.")
+
+    gaps = models.TextField(blank=True, default="",
+        help_text="JSON object mapping missing ids at or below last_id to when they were noticed missing.")
+
+    def __str__(self):
+        return "{} @ {}".format(self.name, self.last_id)
+
+
 class MemberLogin(models.Model):
     """ Record member, datetime, ip for each login. """
 
@@ -641,6 +826,60 @@ class Membership(models.Model):
         return "%s, %s to %s" % (self.member, self.start_date, self.end_date)
 
 
+class MembershipDailyStat(models.Model):
+    """ Per-day, per-type membership counts, kept current by Membership and GroupMembership signal handlers once
+    the rebuildmembershipstats command has populated the table.
+    Revenue isn't kept here because summing rounded daily amounts wouldn't match the exact monthly figures.
+    See MembershipMonthlyRevenue instead.
+    NOTE: QuerySet.update() and bulk_create() don't send signals, so rerun rebuildmembershipstats after using them
+    on memberships.
+    """
+
+    date = models.DateField(null=False, blank=False,
+        help_text="The day these stats apply to.")
+
+    # Group purchases are counted apart from the individual (type 'Group') memberships that they produce.
+    MT_GROUP_PURCHASE = "P"
+    TYPE_CHOICES = Membership.MEMBERSHIP_TYPE_CHOICES + [
+        (MT_GROUP_PURCHASE, "Group Purchase"),
+    ]
+    membership_type = models.CharField(max_length=1, choices=TYPE_CHOICES, null=False, blank=False,
+        help_text="The type of membership.")
+
+    active_count = models.IntegerField(default=0,
+        help_text="The number of memberships of this type that were active on this day.")
+
+    def __str__(self):
+        return "%s, %s, %s" % (self.date, self.membership_type, self.active_count)
+
+    class Meta:
+        ordering = ['date']
+        unique_together = ('date', 'membership_type')
+
+
+class MembershipMonthlyRevenue(models.Model):
+    """ Per-month accrued membership revenue, kept current like MembershipDailyStat once the rebuildmembershipstats
+    command has populated the table. Each month is summed from the memberships' prorated sale prices in one go,
+    rather than from rounded daily amounts, so it matches members.stats.accrued_membership_revenue.
+    Only months with individual memberships are kept, as in accrued_membership_revenue.
+    """
+
+    month = models.DateField(unique=True, null=False, blank=False,
+        help_text="The first day of the month that this revenue was earned in.")
+
+    indi_revenue = models.DecimalField(max_digits=20, decimal_places=10, null=False, blank=False,
+        help_text="The revenue earned this month from individual memberships.")
+
+    group_revenue = models.DecimalField(max_digits=20, decimal_places=10, null=False, blank=False,
+        help_text="The revenue earned this month from group memberships.")
+
+    def __str__(self):
+        return "%s, %s, %s" % (self.month, self.indi_revenue, self.group_revenue)
+
+    class Meta:
+        ordering = ['month']
+
+
 class DiscoveryMethod(models.Model):
     """Different ways that members learn about us. E.g. 'Tucson Meet Yourself', 'Radio', 'TV', 'Website', etc """
 
@@ -1,5 +1,10 @@
 from members.models import Member, Pushover
+from abutils.utils import redis_connection
+from django.conf import settings
+from django.core.cache import cache
 import os
+import json
+import time
 import pushover
 import logging
 
@@ -19,20 +24,122 @@ else:
         logger.info("Pushover could not be initialized. Alerts will not be sent.")
         logger.info("Pushover init exception: "+str(e))
 
+# Notifications are delivered by the rq worker. They're held in Redis until INTSYS_NOTIFICATION_WINDOW seconds
+# after the first of them was queued, then the clock process (see flush_if_due) queues a job that sends everything
+# held as a single digest per recipient.
+PENDING_LIST_KEY = "members.notifications.pending"
+FIRST_PENDING_KEY = "members.notifications.first-pending"  # When the oldest pending notification was queued.
+FLUSH_QUEUED_KEY = "members.notifications.flush-queued"
+FLUSH_QUEUED_TIMEOUT = 10*60  # In case a flush job is lost, don't block new ones forever.
+MAX_SEND_ATTEMPTS = 3  # On the rq worker. Sends made during a request only get one attempt.
+KEY_CACHE_TIMEOUT = 5*60  # Each process has its own cache, so other processes only see key changes after this.
+MAX_MESSAGE_LEN = 1024  # Pushover's limit.
+
+_clients = {}  # Pushover user key -> pushover.Client, reused across sends.
+
+
+def _key_cache_key(member_pk: int) -> str:
+    return "members.notifications.key.%d" % member_pk
+
+
+def forget_pushover_key(member_pk: int):
+    """Call this when a member's Pushover info changes."""
+    cache.delete(_key_cache_key(member_pk))
+
+
+def pushover_key(member: Member):
+    """The member's Pushover user key, or None if they don't have one. Cached to keep lookups off the DB."""
+    cache_key = _key_cache_key(member.pk)
+    key = cache.get(cache_key)
+    if key is None:
+        key = Pushover.objects.filter(who=member).values_list('key', flat=True).first() or ""
+        cache.set(cache_key, key, KEY_CACHE_TIMEOUT)
+    return key if key != "" else None
+
+
+def digest(notes):
+    """Combine a recipient's (title, message) notes into one (title, message)."""
+    if len(notes) == 1:
+        return notes[0]
+    title = "{} {}s".format(len(notes), notes[0][0]) if len(set(t for t, _ in notes)) == 1 \
+        else "{} notifications".format(len(notes))
+    message = "\n\n".join("{}: {}".format(t, m) for t, m in notes)
+    if len(message) > MAX_MESSAGE_LEN:
+        message = message[:MAX_MESSAGE_LEN-3] + "..."
+    return title, message
+
+
+def _send(key: str, recipient: str, title: str, message: str, attempts: int=MAX_SEND_ATTEMPTS):
+    """Send to Pushover user key, retrying with backoff if attempts > 1. Retries should only happen on the worker."""
+    for attempt in range(1, attempts+1):
+        try:
+            client = _clients.get(key)
+            if client is None:
+                client = _clients[key] = pushover.Client(key)
+            client.send_message(message, title=title)
+            return True
+        except Exception as e:
+            _clients.pop(key, None)  # Start afresh on the next attempt.
+            if attempt == attempts:
+                logger.error("Couldn't send msg '%s' to %s because %s", title, recipient, str(e))
+            else:
+                time.sleep(2**attempt)
+    return False
+
+
+def flush_if_due(now: float=None) -> bool:
+    """
+    Queue a flush job if the oldest pending notification has waited out INTSYS_NOTIFICATION_WINDOW.
+    Called periodically by the clock process. Returns True if a flush is due.
+    """
+    if now is None:
+        now = time.time()
+    conn = redis_connection()
+    first_pending = conn.get(FIRST_PENDING_KEY)
+    if first_pending is None or now - float(first_pending) < settings.INTSYS_NOTIFICATION_WINDOW:
+        return False
+    if conn.set(FLUSH_QUEUED_KEY, 1, nx=True, ex=FLUSH_QUEUED_TIMEOUT):
+        from rq import Queue
+        Queue('high', connection=conn).enqueue(flush_notifications)
+    return True
+
+
+def flush_notifications():
+    """Deliver everything that's pending, one digest per recipient. Runs on the rq worker."""
+    conn = redis_connection()
+    pipe = conn.pipeline()  # A transaction, so anything pushed after it starts a new window.
+    pipe.lrange(PENDING_LIST_KEY, 0, -1)
+    pipe.delete(PENDING_LIST_KEY, FIRST_PENDING_KEY, FLUSH_QUEUED_KEY)
+    pending, _ = pipe.execute()
+
+    notes_by_key, recipients = {}, {}
+    for item in pending:
+        key, recipient, title, message = json.loads(item.decode())
+        notes_by_key.setdefault(key, []).append((title, message))
+        recipients[key] = recipient
+    for key, notes in notes_by_key.items():
+        _send(key, recipients[key], *digest(notes))
+
 
-# REVIEW: This sometimes fails. Should it be an asynchronous task with retries?
 def notify(target_member: Member, title: str, message: str):
+    """Queue a Pushover notification. When background jobs are enabled, this does no network I/O to Pushover."""
     if not pushover_available:
         return
 
-    try:
-        target_key = Pushover.objects.get(who=target_member).key
-    except Pushover.DoesNotExist:
+    target_key = pushover_key(target_member)
+    if target_key is None:
         logger.error("Couldn't send msg to %s since there's no pushover key for them.", str(target_member))
         return
 
-    try:
-        client = pushover.Client(target_key)
-        client.send_message(message, title=title)
-    except Exception as e:
-        logger.error("Couldn't send msg to %s because %s", str(target_member), str(e))
+    if getattr(settings, 'INTSYS_ASYNC_JOBS', False):
+        try:
+            pipe = redis_connection().pipeline()
+            pipe.rpush(PENDING_LIST_KEY, json.dumps([target_key, str(target_member), title, message]))
+            pipe.set(FIRST_PENDING_KEY, time.time(), nx=True)
+            pipe.execute()
+            return
+        except Exception as e:
+            logger.warning("Couldn't queue msg to %s, so sending it now. %s", str(target_member), str(e))
+
+    # Retrying here would hold up the request (e.g. a check-in) that triggered the notification.
+    _send(target_key, str(target_member), title, message, attempts=1)
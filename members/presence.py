@@ -0,0 +1,238 @@
+# Standard
+from datetime import date, datetime, time, timedelta
+import json
+import logging
+
+# Third party
+from django.db import transaction
+from django.utils import timezone
+
+# Local
+from members.models import Member, VisitEvent, WifiMacDetected, PresenceInterval, DailyOccupancy, RollupMark
+
+# Observations of the same member (or MAC) that are closer together than these gaps belong to the same interval.
+# WiFi detections arrive every few minutes while a phone is present, but visit events are much sparser.
+GAPS = {
+    PresenceInterval.SRC_VISITS: timedelta(hours=3),
+    PresenceInterval.SRC_WIFI: timedelta(minutes=30),
+}
+
+BATCH_SIZE = 5000
+
+# Ids that the high-water mark skips are rechecked for this long, in case their rows were inserted by transactions
+# that hadn't committed yet. After that they're assumed to belong to rolled back or deleted rows.
+GAP_TIMEOUT = timedelta(hours=1)
+# At most this many skipped ids are tracked, so a big jump in ids (e.g. after purging raw rows) doesn't produce a
+# huge list of gaps. If there are more, the highest ids are kept because they're the likeliest to commit late.
+MAX_GAPS = 1000
+
+logger = logging.getLogger("members")
+
+
+class _Source(object):
+    """How to read one kind of raw presence data."""
+
+    def __init__(self, code: str, model, key_field: str):
+        self.code = code
+        self.model = model
+        self.key_field = key_field  # The raw row field (and PresenceInterval field) identifying who/what was present.
+        self.key_attname = PresenceInterval._meta.get_field(key_field).attname
+        self.gap = GAPS[code]
+
+    @property
+    def mark_name(self):
+        return "presence." + self.code
+
+    def rows(self, after_id: int, batch_size: int) -> list:
+        """Returns (id, key, when, is_departure) tuples, in id order."""
+        return self._tuples(self.model.objects.filter(id__gt=after_id).order_by('id'), batch_size)
+
+    def rows_with_ids(self, ids) -> list:
+        """Returns (id, key, when, is_departure) tuples for whichever of the given ids exist."""
+        return self._tuples(self.model.objects.filter(id__in=ids), len(ids))
+
+    def _tuples(self, queryset, batch_size: int) -> list:
+        if self.model is VisitEvent:
+            rows = queryset.values_list('id', 'who', 'when', 'event_type')[:batch_size]
+            return [(pk, key, when, evt == VisitEvent.EVT_DEPARTURE) for pk, key, when, evt in rows]
+        rows = queryset.values_list('id', self.key_field, 'when')[:batch_size]
+        return [(pk, key, when, False) for pk, key, when in rows]
+
+
+SOURCES = [
+    _Source(PresenceInterval.SRC_VISITS, VisitEvent, 'who'),
+    _Source(PresenceInterval.SRC_WIFI, WifiMacDetected, 'mac'),
+]
+
+
+def _local_dates(start: datetime, end: datetime):
+    day = timezone.localtime(start).date()
+    last = timezone.localtime(end).date()
+    while day <= last:
+        yield day
+        day += timedelta(days=1)
+
+
+def _day_bounds(day: date):
+    tz = timezone.get_current_timezone()
+    return (
+        timezone.make_aware(datetime.combine(day, time.min), tz),
+        timezone.make_aware(datetime.combine(day + timedelta(days=1), time.min), tz),
+    )
+
+
+def _absorb(intervals: list, when: datetime, is_departure: bool, gap: timedelta):
+    """Fold an observation into one key's intervals. Returns the intervals that changed and those merged away."""
+    matches = [
+        i for i in intervals
+        if i.start - gap <= when <= i.end + gap and not (i.departed and when > i.end)
+    ]
+    if len(matches) == 0:
+        interval = PresenceInterval(start=when, end=when, departed=is_departure)
+        intervals.append(interval)
+        return [interval], []
+
+    # The observation might bridge several intervals, in which case they're merged into the first.
+    interval, others = matches[0], matches[1:]
+    for other in others:
+        interval.start = min(interval.start, other.start)
+        interval.end = max(interval.end, other.end)
+        interval.departed = interval.departed or other.departed
+        intervals.remove(other)
+    interval.start = min(interval.start, when)
+    interval.end = max(interval.end, when)
+    interval.departed = interval.departed or is_departure
+    return [interval], others
+
+
+def _take_rows(source: _Source, mark: RollupMark, batch_size: int) -> list:
+    """The next batch of new rows plus any late arrivals in the gaps, updating the mark to match."""
+    now = timezone.now()
+    gaps = {
+        int(pk): noticed for pk, noticed in json.loads(mark.gaps or "{}").items()
+        if noticed > (now - GAP_TIMEOUT).timestamp()
+    }
+    late = source.rows_with_ids(list(gaps.keys())) if len(gaps) > 0 else []
+    rows = source.rows(mark.last_id, batch_size)
+
+    if len(late) > 0:
+        logger.info("Presence rollup of %s found %d late row(s).", source.model.__name__, len(late))
+    for pk, _, _, _ in late:
+        del gaps[pk]
+    if len(rows) > 0:
+        ids = sorted(pk for pk, _, _, _ in rows)
+        new_last_id = ids[-1]
+        # Walk down from the top of the batch, so a big jump in ids doesn't generate more than MAX_GAPS of them.
+        skipped = []
+        for lower, upper in reversed(list(zip([mark.last_id] + ids[:-1], ids))):
+            skipped.extend(range(upper-1, lower, -1)[:MAX_GAPS-len(skipped)])
+            if len(skipped) >= MAX_GAPS:
+                break
+        for pk in skipped:
+            gaps[pk] = now.timestamp()
+        dropped = sorted(gaps.keys())[:max(0, len(gaps)-MAX_GAPS)]
+        for pk in dropped:
+            del gaps[pk]
+        untracked = len(dropped) + (new_last_id - mark.last_id - len(ids)) - len(skipped)
+        if untracked > 0:
+            logger.warning("Presence rollup of %s isn't tracking %d gap(s) below id %d.",
+                source.model.__name__, untracked, new_last_id)
+        mark.last_id = new_last_id
+    mark.gaps = json.dumps(gaps) if len(gaps) > 0 else ""
+    mark.save()
+    return late + rows
+
+
+def _rollup_batch(source: _Source, mark: RollupMark, batch_size: int) -> set:
+    """Roll up one batch of raw rows. Returns the local dates whose occupancy may have changed."""
+    rows = _take_rows(source, mark, batch_size)
+    if len(rows) == 0:
+        return set()
+
+    keys = set(key for _, key, _, _ in rows)
+    earliest = min(when for _, _, when, _ in rows)
+    intervals = {}
+    for interval in PresenceInterval.objects.filter(
+      source=source.code, end__gte=earliest - source.gap, **{source.key_field+'__in': keys}):
+        intervals.setdefault(getattr(interval, source.key_attname), []).append(interval)
+
+    changed, deleted = {}, {}
+    for _, key, when, is_departure in sorted(rows, key=lambda row: (row[1], row[2])):
+        key_intervals = intervals.setdefault(key, [])
+        touched, removed = _absorb(key_intervals, when, is_departure, source.gap)
+        for interval in touched:
+            if interval.pk is None:
+                interval.source = source.code
+                setattr(interval, source.key_attname, key)
+            changed[id(interval)] = interval
+        for interval in removed:
+            changed.pop(id(interval), None)
+            if interval.pk is not None:
+                deleted[interval.pk] = interval
+
+    dates = set()
+    for interval in list(changed.values()) + list(deleted.values()):
+        dates.update(_local_dates(interval.start, interval.end))
+    PresenceInterval.objects.filter(pk__in=deleted.keys()).delete()
+    for interval in changed.values():
+        if interval.pk is not None:
+            interval.save()
+    PresenceInterval.objects.bulk_create([i for i in changed.values() if i.pk is None])
+    return dates
+
+
+def _update_daily_occupancy(source: _Source, dates):
+    for day in sorted(dates):
+        day_start, day_end = _day_bounds(day)
+        count = PresenceInterval.objects\
+            .filter(source=source.code, start__lt=day_end, end__gte=day_start)\
+            .values(source.key_field).distinct().count()
+        DailyOccupancy.objects.update_or_create(date=day, source=source.code, defaults={'count': count})
+
+
+def rollup(batch_size: int=BATCH_SIZE) -> dict:
+    """
+    Incrementally roll raw visit events and WiFi detections up into presence intervals and daily occupancy.
+    Each source picks up after the highest raw row id it has already rolled up, and also rolls up rows that
+    turned up late in ids it skipped over (see RollupMark).
+    :return: A dict mapping source codes to the number of dates whose occupancy was updated.
+    """
+    result = {}
+    for source in SOURCES:
+        dates = set()
+        while True:
+            with transaction.atomic():
+                mark, _ = RollupMark.objects.select_for_update().get_or_create(name=source.mark_name)
+                batch_dates = _rollup_batch(source, mark, batch_size)
+                _update_daily_occupancy(source, batch_dates)
+            if len(batch_dates) == 0:
+                break
+            dates |= batch_dates
+        result[source.code] = len(dates)
+        logger.info("Presence rollup of %s updated occupancy for %d date(s).", source.model.__name__, len(dates))
+    return result
+
+
+def here_now(source_code: str=PresenceInterval.SRC_VISITS, now: datetime=None):
+    """
+    Who is present, according to the rolled up intervals.
+    :return: Members if the source is visit events, else MAC address strings.
+    """
+    if now is None:
+        now = timezone.now()
+    current = PresenceInterval.objects.filter(
+        source=source_code,
+        departed=False,
+        end__gte=now - GAPS[source_code],
+        start__lte=now,
+    )
+    if source_code == PresenceInterval.SRC_VISITS:
+        return Member.objects.filter(pk__in=current.values('who')).select_related('auth_user')
+    return sorted(set(current.values_list('mac', flat=True)))
+
+
+def visits_per_day(start: date, end: date, source_code: str=PresenceInterval.SRC_VISITS) -> dict:
+    """Distinct visitors per local date, from start to end inclusive. Dates with no visitors are omitted."""
+    return dict(DailyOccupancy.objects
+        .filter(source=source_code, date__gte=start, date__lte=end)
+        .values_list('date', 'count'))
@@ -29,6 +29,14 @@ def get_MemberSerializer(respect_privacy: bool) -> serializers.ModelSerializer:
     )
 
     class MemberSerializer(serializers.ModelSerializer):
+
+        is_currently_paid = serializers.SerializerMethodField()
+
+        def get_is_currently_paid(self, member):
+            # Querysets from Member.objects.with_paid_status() have already answered this, without extra queries.
+            is_paid = getattr(member, 'is_paid', None)
+            return member.is_currently_paid() if is_paid is None else bool(is_paid)
+
         class Meta:
             model = models.Member
             fields = private_fields + public_fields
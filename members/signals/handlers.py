@@ -3,14 +3,15 @@ from datetime import timedelta
 import logging
 
 # Third Party
-from django.db.models.signals import post_save, pre_save, pre_delete
+from django.db.models.signals import post_save, post_delete, pre_save, pre_delete
 from django.dispatch import receiver
 from django.contrib.auth.models import User, user_logged_in
 from django.core.exceptions import ObjectDoesNotExist
 
 # Local
-from members.models import Member, Tag, Tagging, MemberLogin, GroupMembership, Membership, VisitEvent
+from members.models import Member, Tag, Tagging, MemberLogin, GroupMembership, Membership, VisitEvent, Pushover
 import members.notifications as notifications
+import members.stats as stats
 from abutils.utils import get_ip_address
 
 __author__ = 'Adrian'
@@ -36,11 +37,63 @@ def create_default_member(sender, **kwargs):
         Tagging.objects.create(tagged_member=m, tag=t)
 
 
+@receiver(pre_save, sender=Member)
+def note_card_before_save(sender, **kwargs):
+    # If the card md5 is edited directly, the old card's cache entry needs forgetting too.
+    instance = kwargs.get('instance')
+    instance._card_md5_before_save = None
+    if instance.pk is not None:
+        instance._card_md5_before_save = \
+            sender.objects.filter(pk=instance.pk).values_list('membership_card_md5', flat=True).first()
+
+
+@receiver(post_save, sender=Member)
+@receiver(post_delete, sender=Member)
+def forget_member_card(sender, **kwargs):
+    # Cards are usually rotated by generate_member_card_str, but the md5 can also be edited directly.
+    # Either way, the cached member is out of date.
+    instance = kwargs.get('instance')
+    Member.forget_card_md5(instance.membership_card_md5)
+    Member.forget_card_md5(getattr(instance, '_card_md5_before_save', None))
+
+
+@receiver(post_save, sender=User)
+def forget_user_card(sender, **kwargs):
+    # Cached members carry their auth_user, e.g. for names and is_active.
+    update_fields = kwargs.get('update_fields')
+    if kwargs.get('created') or (update_fields is not None and set(update_fields) == {'last_login'}):
+        return  # Nothing cached yet, or nothing that matters to card lookups.
+    md5 = Member.objects.filter(auth_user=kwargs.get('instance')).values_list('membership_card_md5', flat=True).first()
+    Member.forget_card_md5(md5)
+
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 # VISIT
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 
+def _notify_of_arrival(visit: VisitEvent, previous_arrival):
+    """Tell the recipient about visit, an arrival, unless it's too close to the visitor's previous_arrival."""
+
+    # TODO: Shouldn't have a hard-coded userid here. Make configurable, perhaps with tags.
+    recipient = Member.objects.get(auth_user__username='adrianb')
+    if visit.who == recipient:
+        # No need to inform the recipient that they're visiting
+        return
+
+    # RFID checkin systems may fire multiple times. Skip checkin if "too close" to the prev checkin time.
+    delta = timedelta.max if previous_arrival is None else visit.when - previous_arrival.when
+    if delta < timedelta(hours=1):
+        return
+
+    vname = "{} {}".format(visit.who.first_name, visit.who.last_name).strip()
+    vname = "Anonymous" if len(vname) == "" else vname
+    vstat = "Paid" if visit.who.is_currently_paid() else "Unpaid"
+
+    message = "{}\n{}\n{}".format(visit.who.username, vname, vstat)
+    notifications.notify(recipient, "Check-In", message)
+
+
 @receiver(pre_save, sender=VisitEvent)  # Making this PRE-save because I want to get latest before save.
 def note_checkin(sender, **kwargs):
     try:
@@ -51,37 +104,64 @@ def note_checkin(sender, **kwargs):
             if visit.event_type != VisitEvent.EVT_ARRIVAL:
                 return
 
-            # TODO: Shouldn't have a hard-coded userid here. Make configurable, perhaps with tags.
-            recipient = Member.objects.get(auth_user__username='adrianb')
-            if visit.who == recipient:
-                # No need to inform the recipient that they're visiting
-                return
-
-            # RFID checkin systems may fire multiple times. Skip checkin if "too close" to the prev checkin time.
             try:
                 recent_visit = VisitEvent.objects.filter(who=visit.who, event_type=VisitEvent.EVT_ARRIVAL).latest('when')
-                delta = visit.when - recent_visit.when
             except VisitEvent.DoesNotExist:
-                delta = timedelta.max
-            if delta < timedelta(hours=1):
-                return
-
-            vname = "{} {}".format(visit.who.first_name, visit.who.last_name).strip()
-            vname = "Anonymous" if len(vname) == "" else vname
-            vstat = "Paid" if visit.who.is_currently_paid() else "Unpaid"
-
-            message = "{}\n{}\n{}".format(visit.who.username, vname, vstat)
-            notifications.notify(recipient, "Check-In", message)
+                recent_visit = None
+            _notify_of_arrival(visit, recent_visit)
 
     except Exception as e:
         # Makes sure that problems here do not prevent the visit event from being saved!
         logger.error("Problem in note_checkin: %s", str(e))
 
 
+def note_checkins(visit_pks):
+    """Does what note_checkin does, for visit events that were created in bulk (which skips signals).
+    Intended to run in the background, so each visit gets its own queries.
+    """
+    arrivals = VisitEvent.objects.filter(pk__in=visit_pks, event_type=VisitEvent.EVT_ARRIVAL)\
+        .select_related('who__auth_user').order_by('when')
+    for visit in arrivals:
+        try:
+            previous = VisitEvent.objects\
+                .filter(who=visit.who, event_type=VisitEvent.EVT_ARRIVAL, when__lt=visit.when)\
+                .order_by('-when').first()
+            _notify_of_arrival(visit, previous)
+        except Exception as e:
+            logger.error("Problem noting checkin #%s: %s", visit.pk, str(e))
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# PUSHOVER
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+@receiver(post_save, sender=Pushover)
+@receiver(post_delete, sender=Pushover)
+def forget_pushover_key(sender, **kwargs):
+    notifications.forget_pushover_key(kwargs.get('instance').who_id)
+
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 # TAGGING
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
+@receiver(post_save, sender=Tagging)
+@receiver(post_delete, sender=Tagging)
+def forget_member_tags(sender, **kwargs):
+    tagging = kwargs.get('instance')
+    Member.forget_tags(tagging.tagged_member_id)
+    # The tagged member instance may be in use, e.g. by Tagging.add_if_permitted, so drop its memo too.
+    cached_member = getattr(tagging, sender._meta.get_field('tagged_member').get_cache_name(), None)
+    if cached_member is not None:
+        cached_member.__dict__.pop('_tag_map', None)
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def forget_all_member_tags(sender, **kwargs):
+    Member.forget_all_tags()
+
+
 @receiver(post_save, sender=Tagging)
 def email_for_saved_tagging(sender, **kwargs):
     if kwargs.get('created', True):
@@ -113,6 +193,34 @@ def link_membership_to_member(sender, **kwargs):
             mship.link_to_member()
 
 
+@receiver(pre_save, sender=Membership)
+@receiver(pre_save, sender=GroupMembership)
+def note_dates_before_save(sender, **kwargs):
+    # The daily stats for the old date range need updating too, if the dates change.
+    instance = kwargs.get('instance')
+    instance._dates_before_save = None
+    if instance.pk is not None and stats.daily_stats_ready():
+        instance._dates_before_save = \
+            sender.objects.filter(pk=instance.pk).values_list('start_date', 'end_date').first()
+
+
+@receiver(post_save, sender=Membership)
+@receiver(post_delete, sender=Membership)
+@receiver(post_save, sender=GroupMembership)
+@receiver(post_delete, sender=GroupMembership)
+def update_membership_daily_stats(sender, **kwargs):
+    if not stats.daily_stats_ready():
+        return
+    instance = kwargs.get('instance')
+    date_ranges = {(instance.start_date, instance.end_date)}
+    dates_before_save = getattr(instance, '_dates_before_save', None)
+    if dates_before_save is not None:
+        date_ranges.add(dates_before_save)
+    for first_day, last_day in date_ranges:
+        if first_day <= last_day:
+            stats.update_daily_stats(first_day, last_day)
+
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 # LOGIN
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
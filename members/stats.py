@@ -0,0 +1,280 @@
+# Standard
+from datetime import date, timedelta
+from decimal import Decimal
+import logging
+
+# Third party
+from dateutil.relativedelta import relativedelta
+from django.db import connection, transaction
+
+# Local
+from members.models import Membership, GroupMembership, MembershipDailyStat, MembershipMonthlyRevenue
+
+# Membership data from before this date isn't reliable, so it's excluded by default.
+FIRST_STATS_DAY = date(2015, 1, 1)
+
+# Member count chart series: regular, family, work-trade, group, complimentary.
+# Not enough gift card sales to call them out separately, so they're included in the regular count.
+# Other types, e.g. scholarships, are charted as days with members but aren't counted in any series.
+COUNT_SERIES_FOR_TYPE = {
+    Membership.MT_REGULAR: 0,
+    Membership.MT_GIFTCARD: 0,
+    Membership.MT_FAMILY: 1,
+    Membership.MT_WORKTRADE: 2,
+    Membership.MT_GROUP: 3,
+    Membership.MT_COMPLIMENTARY: 4,
+}
+COUNT_SERIES = 5
+
+logger = logging.getLogger("members")
+
+
+def daily_counts(spans, series_count: int, first_day: date=None, last_day: date=None) -> list:
+    """
+    Count overlapping spans per day, for several series at once, by sweeping over the span boundaries.
+    Each span is a (start_date, end_date, series) triple where the dates are inclusive and series is an index
+    below series_count, or None if the span only counts toward coverage.
+    Spans are clipped to first_day and last_day, if given.
+    :return: A list of (date, counts) pairs, in date order, for each day covered by at least one span.
+    """
+    # Day ordinal -> changes to the series counts, with the change in coverage in the extra last slot.
+    deltas = {}
+    for start, end, series in spans:
+        if first_day is not None and start < first_day:
+            start = first_day
+        if last_day is not None and end > last_day:
+            end = last_day
+        if start > end:
+            continue
+        for ordinal, change in ((start.toordinal(), 1), (end.toordinal()+1, -1)):
+            delta = deltas.get(ordinal)
+            if delta is None:
+                delta = deltas[ordinal] = [0] * (series_count+1)
+            if series is not None:
+                delta[series] += change
+            delta[-1] += change
+
+    result = []
+    running = [0] * (series_count+1)
+    ordinals = sorted(deltas)
+    for ordinal, next_ordinal in zip(ordinals, ordinals[1:]):
+        running = [count+change for count, change in zip(running, deltas[ordinal])]
+        if running[-1] > 0:
+            counts = tuple(running[:-1])
+            result.extend((date.fromordinal(o), counts) for o in range(ordinal, next_ordinal))
+    return result
+
+
+def member_counts(first_day: date=FIRST_STATS_DAY, last_day: date=None) -> list:
+    """The daily member count series, as (date, counts) pairs, computed from the memberships."""
+    if last_day is None:
+        last_day = date.today()
+    spans = (
+        (start, end, COUNT_SERIES_FOR_TYPE.get(mtype))
+        for start, end, mtype in Membership.objects.values_list('start_date', 'end_date', 'membership_type')
+    )
+    return daily_counts(spans, COUNT_SERIES, first_day=first_day, last_day=last_day)
+
+
+def month_overlaps(start: date, end: date):
+    """Yields ((year, month), day_count) for each calendar month that the inclusive date range touches."""
+    day = start
+    while day <= end:
+        last = min(day.replace(day=1) + relativedelta(months=1) - timedelta(days=1), end)
+        yield (day.year, day.month), (last - day).days + 1
+        day = last + timedelta(days=1)
+
+
+def _accrue(revenue: dict, start: date, end: date, sale_price, first_day: date, last_day: date):
+    """Spread the sale price evenly over the membership's days and add each month's share to revenue."""
+    amt_per_day = sale_price / Decimal((end - start).days + 1)
+    for month, day_count in month_overlaps(max(start, first_day), min(end, last_day)):
+        revenue[month] = revenue.get(month, Decimal(0)) + amt_per_day * day_count
+
+
+def _revenue_by_month(first_day: date, last_day: date):
+    """Individual and group revenue earned from first_day to last_day inclusive, as dicts keyed by (year, month)."""
+    indi_data, grp_data = {}, {}
+
+    for start, end, sale_price in Membership.objects\
+      .filter(start_date__lte=last_day, end_date__gte=first_day)\
+      .values_list('start_date', 'end_date', 'sale_price'):
+        _accrue(indi_data, start, end, sale_price, first_day, last_day)
+
+    for gm in GroupMembership.objects.filter(start_date__lte=last_day, end_date__gte=first_day):
+        if gm.sale_price == 0.0:
+            logger.warning("$0 group membership #%s: %s", gm.pk, str(gm))
+        _accrue(grp_data, gm.start_date, gm.end_date, gm.sale_price, first_day, last_day)
+
+    return indi_data, grp_data
+
+
+def accrued_membership_revenue(first_day: date=FIRST_STATS_DAY, last_day: date=None) -> list:
+    """
+    Membership revenue earned per month, with each membership's sale price prorated over its days.
+    Only the days from first_day to last_day (default today) inclusive are counted.
+    :return: A list of ((year, month), individual revenue, group revenue), in month order, for the months
+    that have individual memberships.
+    """
+    if last_day is None:
+        last_day = date.today()
+    indi_data, grp_data = _revenue_by_month(first_day, last_day)
+    months = sorted(indi_data)
+    return [(month, indi_data[month], grp_data.get(month, Decimal(0))) for month in months]
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# DAILY STATS TABLE
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+# Counts are kept per day and revenue per month, so that revenue isn't summed from rounded daily amounts.
+# The tables are kept current by signal handlers, which QuerySet.update() and bulk_create() bypass, so rerun
+# rebuildmembershipstats after changing memberships that way.
+
+def daily_stats_ready() -> bool:
+    """The daily stats table is only maintained, and only used, once it has been built."""
+    return MembershipDailyStat.objects.exists()
+
+
+def monthly_revenue_ready() -> bool:
+    """Likewise for the monthly revenue table, which is built along with the daily stats table."""
+    return MembershipMonthlyRevenue.objects.exists()
+
+
+def _lock_stats():
+    """
+    Serialize updates to the stats tables until the current transaction ends.
+    Otherwise, overlapping updates could both insert the same rows and fail, or write counts from stale reads.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", [MembershipDailyStat._meta.db_table])
+
+
+def _compute_daily_stats(first_day: date, last_day: date) -> list:
+    """Unsaved MembershipDailyStats for the given days, from the memberships that overlap them."""
+    spans = list(Membership.objects
+        .filter(start_date__lte=last_day, end_date__gte=first_day)
+        .values_list('start_date', 'end_date', 'membership_type'))
+    spans += [
+        (start, end, MembershipDailyStat.MT_GROUP_PURCHASE)
+        for start, end in GroupMembership.objects
+            .filter(start_date__lte=last_day, end_date__gte=first_day)
+            .values_list('start_date', 'end_date')
+    ]
+
+    # Day ordinal -> membership type -> change in count
+    deltas = {}
+    for start, end, mtype in spans:
+        start, end = max(start, first_day), min(end, last_day)
+        if start > end:
+            continue
+        for ordinal, change in ((start.toordinal(), 1), (end.toordinal()+1, -1)):
+            by_type = deltas.setdefault(ordinal, {})
+            by_type[mtype] = by_type.get(mtype, 0) + change
+
+    stats = []
+    running = {}
+    ordinals = sorted(deltas)
+    for ordinal, next_ordinal in zip(ordinals, ordinals[1:]):
+        for mtype, change in deltas[ordinal].items():
+            running[mtype] = running.get(mtype, 0) + change
+        for o in range(ordinal, next_ordinal):
+            day = date.fromordinal(o)
+            stats.extend(
+                MembershipDailyStat(date=day, membership_type=mtype, active_count=count)
+                for mtype, count in running.items() if count > 0
+            )
+    return stats
+
+
+def _update_monthly_revenue(first_day: date, last_day: date) -> int:
+    """Recompute the monthly revenue for the months that the given days touch. Returns the number of rows written."""
+    first_day = first_day.replace(day=1)
+    last_day = last_day.replace(day=1) + relativedelta(months=1) - timedelta(days=1)
+    indi_data, grp_data = _revenue_by_month(first_day, last_day)
+    rows = [
+        MembershipMonthlyRevenue(month=date(year, month, 1),
+            indi_revenue=indi_data[(year, month)], group_revenue=grp_data.get((year, month), Decimal(0)))
+        for year, month in sorted(indi_data)
+    ]
+    MembershipMonthlyRevenue.objects.filter(month__gte=first_day, month__lte=last_day).delete()
+    MembershipMonthlyRevenue.objects.bulk_create(rows)
+    return len(rows)
+
+
+def update_daily_stats(first_day: date, last_day: date) -> int:
+    """
+    Recompute the daily stats for the given days, and the monthly revenue for their months if that table has
+    been built. Returns the number of daily stat rows written.
+    """
+    with transaction.atomic():
+        _lock_stats()
+        # Compute after locking, so that memberships changed by a concurrent update are seen.
+        stats = _compute_daily_stats(first_day, last_day)
+        MembershipDailyStat.objects.filter(date__gte=first_day, date__lte=last_day).delete()
+        MembershipDailyStat.objects.bulk_create(stats)
+        if monthly_revenue_ready():
+            _update_monthly_revenue(first_day, last_day)
+    return len(stats)
+
+
+def rebuild_daily_stats() -> int:
+    """Recompute the daily stats and monthly revenue tables from scratch. Returns the daily stat row count."""
+    first_days, last_days = [], []
+    for model in [Membership, GroupMembership]:
+        first_day = model.objects.order_by('start_date').values_list('start_date', flat=True).first()
+        last_day = model.objects.order_by('-end_date').values_list('end_date', flat=True).first()
+        if first_day is not None:
+            first_days.append(first_day)
+            last_days.append(last_day)
+    with transaction.atomic():
+        _lock_stats()
+        MembershipDailyStat.objects.all().delete()
+        MembershipMonthlyRevenue.objects.all().delete()
+        if len(first_days) == 0:
+            return 0
+        row_count = update_daily_stats(min(first_days), max(last_days))
+        _update_monthly_revenue(min(first_days), max(last_days))
+        return row_count
+
+
+def member_counts_from_stats(first_day: date=FIRST_STATS_DAY, last_day: date=None) -> list:
+    """Same as member_counts, but read from the daily stats table."""
+    if last_day is None:
+        last_day = date.today()
+    counts_by_day = {}
+    for day, mtype, count in MembershipDailyStat.objects\
+      .filter(date__gte=first_day, date__lte=last_day)\
+      .exclude(membership_type=MembershipDailyStat.MT_GROUP_PURCHASE)\
+      .values_list('date', 'membership_type', 'active_count'):
+        counts = counts_by_day.setdefault(day, [0] * COUNT_SERIES)
+        series = COUNT_SERIES_FOR_TYPE.get(mtype)
+        if series is not None:
+            counts[series] += count
+    return [(day, tuple(counts_by_day[day])) for day in sorted(counts_by_day)]
+
+
+def accrued_membership_revenue_from_stats(first_day: date=FIRST_STATS_DAY, last_day: date=None) -> list:
+    """
+    Same as accrued_membership_revenue, but whole months are read from the monthly revenue table.
+    Months that are only partly in the range, e.g. the current month, are still computed from the memberships.
+    """
+    if last_day is None:
+        last_day = date.today()
+    first_whole = first_day if first_day.day == 1 else first_day.replace(day=1) + relativedelta(months=1)
+    after_whole = (last_day + timedelta(days=1)).replace(day=1)  # The first day after the last whole month.
+    if first_whole >= after_whole:
+        return accrued_membership_revenue(first_day, last_day)
+
+    revenue = {
+        (month.year, month.month): (indi, grp)
+        for month, indi, grp in MembershipMonthlyRevenue.objects
+            .filter(month__gte=first_whole, month__lt=after_whole)
+            .values_list('month', 'indi_revenue', 'group_revenue')
+    }
+    for part_first, part_last in [(first_day, first_whole - timedelta(days=1)), (after_whole, last_day)]:
+        if part_first <= part_last:
+            indi_data, grp_data = _revenue_by_month(part_first, part_last)
+            for month in indi_data:
+                revenue[month] = (indi_data[month], grp_data.get(month, Decimal(0)))
+    return [(month, indi, grp) for month, (indi, grp) in sorted(revenue.items())]
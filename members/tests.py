@@ -1,23 +1,35 @@
 
 # Standard
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta
+import hashlib
+from decimal import Decimal
+from fractions import Fraction
 import json
 import os
+import time
+from concurrent.futures import wait
+from unittest.mock import MagicMock, patch
 
 # Third Party
 from django.test import Client
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.contrib.auth.models import User
 from django.core import management, mail
 from django.utils import timezone
 from django.core.urlresolvers import reverse
+from django.core.cache import cache
 from freezegun import freeze_time
 import members.notifications as notifications
+import members.presence as presence
+import members.stats as stats
+from members.stats import daily_counts, accrued_membership_revenue
 
 # Local
-from members.models import Tag, Tagging, VisitEvent, Membership, Pushover
-from members.views import _calculate_accrued_membership_revenue
+from members.models import Member, Tag, Tagging, VisitEvent, Membership, Pushover, WifiMacDetected, PresenceInterval, RollupMark
+from members.views import _calculate_accrued_membership_revenue, Kiosk_LogVisitEvent
 from members.notifications import pushover_available
+from members.management.commands.rebuildmembershipstats import in_cents
+from abutils.utils import iterate_in_chunks, streaming_csv_response
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 
@@ -94,6 +106,21 @@ class TestMemberNag(TestCase):
             management.call_command("membernag", date=self.FREEZE_DATE_STR)
             self.assertEqual(len(mail.outbox), 0)
 
+    def test_unpaid_visit_by_director(self):
+
+        with freeze_time(self.FREEZE_DATE_STR):
+
+            Membership.objects.create(
+                member=self.memb,
+                membership_type=Membership.MT_COMPLIMENTARY,
+                start_date=date.today()-timedelta(days=21),
+                end_date=date.today()-timedelta(days=20),
+            )
+            director = Tag.objects.create(name="Director", meaning="Director")
+            Tagging.objects.create(tagged_member=self.memb, tag=director)
+            management.call_command("membernag", date=self.FREEZE_DATE_STR)
+            self.assertEqual(len(mail.outbox), 0)
+
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 
@@ -200,6 +227,18 @@ class TestViews(TestCase):
     def test_calculate_accrued_membership_revenue(self):
         _calculate_accrued_membership_revenue()
 
+    def test_accrued_membership_revenue_proration(self):
+        member = User.objects.create_user(username='payer').member
+        Membership.objects.create(
+            member=member,
+            membership_type=Membership.MT_REGULAR,
+            start_date=date(2015, 1, 17),
+            end_date=date(2015, 2, 15),  # 30 days, 15 in each month.
+            sale_price=Decimal("60.00"),
+        )
+        data = accrued_membership_revenue(last_day=date(2015, 2, 10))
+        self.assertEqual(data, [((2015, 1), Decimal("30"), Decimal(0)), ((2015, 2), Decimal("20"), Decimal(0))])
+
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 # TEST REST APIs
@@ -289,4 +328,548 @@ class TestNotify(TestCase):
 
     def test(self):
         if pushover_available:
-            notifications.notify(self.user.member, "Testing Pushover", "This is a test.")
\ No newline at end of file
+            notifications.notify(self.user.member, "Testing Pushover", "This is a test.")
+
+
+class TestNotifyPlumbing(TestCase):
+
+    def test_key_cache(self):
+        member = User.objects.create_user(username='pushee').member
+        self.assertIsNone(notifications.pushover_key(member))
+        po = Pushover.objects.create(who=member, key="abc")
+        self.assertEqual(notifications.pushover_key(member), "abc")
+        po.key = "xyz"
+        po.save()
+        self.assertEqual(notifications.pushover_key(member), "xyz")
+        po.delete()
+        self.assertIsNone(notifications.pushover_key(member))
+
+    def test_digest(self):
+        self.assertEqual(notifications.digest([("Check-In", "a")]), ("Check-In", "a"))
+        title, message = notifications.digest([("Check-In", "a"), ("Check-In", "b")])
+        self.assertEqual(title, "2 Check-Ins")
+        self.assertEqual(message, "Check-In: a\n\nCheck-In: b")
+        title, message = notifications.digest([("Check-In", "a"), ("Log-In", "b" * 2000)])
+        self.assertEqual(title, "2 notifications")
+        self.assertEqual(len(message), notifications.MAX_MESSAGE_LEN)
+
+    def test_send_without_retries(self):
+        class FailingClient:
+            def __init__(self, key):
+                pass
+            def send_message(self, message, title):
+                raise ConnectionError("Pushover is down.")
+        with patch('pushover.Client', FailingClient), patch('time.sleep') as sleep:
+            self.assertFalse(notifications._send("abc", "someone", "Title", "Message", attempts=1))
+            self.assertEqual(sleep.call_count, 0)
+            self.assertFalse(notifications._send("abc", "someone", "Title", "Message"))
+            self.assertEqual(sleep.call_count, notifications.MAX_SEND_ATTEMPTS-1)
+
+    @override_settings(INTSYS_NOTIFICATION_WINDOW=60)
+    def test_flush_waits_for_window(self):
+        conn = MagicMock()
+        conn.get.return_value = b"1000.0"  # When the first pending notification was queued.
+        conn.set.return_value = True
+        with patch('members.notifications.redis_connection', return_value=conn), patch('rq.Queue') as queue:
+            self.assertFalse(notifications.flush_if_due(now=1059.0))
+            self.assertEqual(queue.return_value.enqueue.call_count, 0)
+            self.assertTrue(notifications.flush_if_due(now=1060.0))
+            queue.return_value.enqueue.assert_called_once_with(notifications.flush_notifications)
+
+
+class TestCardLookup(TestCase):
+
+    def setUp(self):
+        Member._card_lru.clear()
+        cache.clear()
+        self.member = User.objects.create_user(username='carded').member
+
+    def test_rotation(self):
+        old_card = self.member.generate_member_card_str()
+        self.assertEqual(Member.get_by_card_str(old_card), self.member)
+        self.assertEqual(Member.get_by_card_str(old_card), self.member)  # Cached.
+        new_card = self.member.generate_member_card_str()
+        self.assertIsNone(Member.get_by_card_str(old_card))
+        self.assertEqual(Member.get_by_card_str(new_card), self.member)
+
+    def test_unknown_card(self):
+        bogus = "x" * Member.MEMB_CARD_STR_LEN
+        self.assertIsNone(Member.get_by_card_str(bogus))
+        self.member.membership_card_md5 = hashlib.md5(bogus.encode()).hexdigest()
+        self.member.save()
+        self.assertEqual(Member.get_by_card_str(bogus), self.member)
+
+    def test_negative_cache(self):
+        bogus = "y" * Member.MEMB_CARD_STR_LEN
+        self.assertIsNone(Member.get_by_card_str(bogus))
+        with self.assertNumQueries(0):
+            self.assertIsNone(Member.get_by_card_str(bogus))
+
+    def test_revoked_card(self):
+        card = self.member.generate_member_card_str()
+        self.assertEqual(Member.get_by_card_str(card), self.member)
+        self.member.membership_card_md5 = None
+        self.member.save()
+        self.assertIsNone(Member.get_by_card_str(card))
+
+    def test_user_change(self):
+        card = self.member.generate_member_card_str()
+        self.assertTrue(Member.get_by_card_str(card).is_active)
+        self.member.auth_user.is_active = False
+        self.member.auth_user.save()
+        self.assertFalse(Member.get_by_card_str(card).is_active)
+
+    def test_warm_path_is_query_free(self):
+        card = self.member.generate_member_card_str()
+        Member.get_by_card_str(card)
+        with self.assertNumQueries(0):
+            self.assertEqual(Member.get_by_card_str(card).auth_user.username, 'carded')
+
+    def test_get_for_staff(self):
+        staff = User.objects.create_user(username='staffer').member
+        Tagging.objects.create(tagged_member=staff, tag=Tag.objects.create(name="Staff", meaning="Staff"))
+        member_card, staff_card = self.member.generate_member_card_str(), staff.generate_member_card_str()
+        with self.assertNumQueries(2):  # Both cards in one query, then the staff member's tags.
+            self.assertEqual(Member.get_for_staff(member_card, staff_card), (True, (self.member, staff)))
+        with self.assertNumQueries(0):
+            self.assertEqual(Member.get_for_staff(member_card, staff_card), (True, (self.member, staff)))
+
+    def test_returns_copies(self):
+        card = self.member.generate_member_card_str()
+        found = Member.get_by_card_str(card)
+        found.membership_card_when = None
+        found.auth_user.first_name = "Changed"
+        found = Member.get_by_card_str(card)
+        self.assertIsNotNone(found.membership_card_when)
+        self.assertEqual(found.auth_user.first_name, "")
+
+
+class TestTagCache(TestCase):
+
+    def setUp(self):
+        self.tagger = User.objects.create_user(username='tagger').member
+        self.taggee = User.objects.create_user(username='taggee').member
+        self.tag = Tag.objects.create(name="Cache Test", meaning="For testing the tag cache")
+        Tagging.objects.create(tagged_member=self.tagger, tag=self.tag, can_tag=True)
+
+    def test_add_and_remove(self):
+        tagger = Member.objects.get(pk=self.tagger.pk)
+        self.assertTrue(tagger.can_tag_with(self.tag))
+        self.assertFalse(self.taggee.is_tagged_with(self.tag.name))
+        Tagging.add_if_permitted(tagger, self.taggee, self.tag)
+        self.assertTrue(self.taggee.is_tagged_with(self.tag.name))
+        self.assertFalse(self.taggee.can_tag_with(self.tag))
+        Tagging.remove_if_permitted(tagger, self.taggee, self.tag)
+        self.assertFalse(Member.objects.get(pk=self.taggee.pk).is_tagged_with(self.tag.name))
+
+    def test_warm_path_is_query_free(self):
+        Member.objects.get(pk=self.tagger.pk).is_tagged_with(self.tag.name)  # Warms the shared cache.
+        tagger = Member.objects.get(pk=self.tagger.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(tagger.is_tagged_with(self.tag.name))
+            self.assertTrue(tagger.can_tag_with(self.tag))
+
+    def test_tag_rename(self):
+        self.assertTrue(Member.objects.get(pk=self.tagger.pk).is_tagged_with("Cache Test"))
+        self.tag.name = "Renamed"
+        self.tag.save()
+        tagger = Member.objects.get(pk=self.tagger.pk)
+        self.assertFalse(tagger.is_tagged_with("Cache Test"))
+        self.assertTrue(tagger.is_tagged_with("Renamed"))
+
+
+class TestKioskContentProviders(TestCase):
+
+    @staticmethod
+    def fast(member, member_card_str, event_type):
+        return "fast;"
+
+    @staticmethod
+    def slow(member, member_card_str, event_type):
+        time.sleep(1.0)
+        return "slow;"
+
+    def content(self, providers):
+        view = Kiosk_LogVisitEvent()
+        view.extra_content_providers = providers
+        return view.get_extra_content(None, "", VisitEvent.EVT_ARRIVAL)
+
+    def test_sequential(self):
+        self.assertEqual(self.content([self.fast, self.fast]), "fast;fast;")
+
+    @override_settings(INTSYS_KIOSK_CONTENT_THREADS=2, INTSYS_KIOSK_CONTENT_TIMEOUT=0.2)
+    def test_concurrent_with_timeout(self):
+        start = time.time()
+        self.assertEqual(self.content([self.slow, self.fast]), "fast;")
+        self.assertLess(time.time() - start, 0.9)
+
+    @override_settings(INTSYS_KIOSK_CONTENT_THREADS=2, INTSYS_KIOSK_CONTENT_TIMEOUT=0.2)
+    def test_stuck_provider_is_skipped(self):
+        def stuck(member, member_card_str, event_type):
+            time.sleep(1.0)
+            return "stuck;"
+        self.assertEqual(self.content([stuck, self.fast]), "fast;")
+        # The first call to stuck is still running, so the second doesn't wait for it:
+        start = time.time()
+        self.assertEqual(self.content([stuck, self.fast]), "fast;")
+        self.assertLess(time.time() - start, 0.2)
+        self.assertTrue(Kiosk_LogVisitEvent._is_stuck(stuck))
+
+    def tearDown(self):
+        # Let abandoned providers finish so they don't tie up the pool in later tests.
+        with Kiosk_LogVisitEvent._lock:
+            abandoned = [future for futures in Kiosk_LogVisitEvent._abandoned.values() for future in futures]
+        wait(abandoned)
+
+
+@override_settings(INTSYS_ASYNC_JOBS=False)
+class TestBatchVisitEvents(TestCase):
+
+    def setUp(self):
+        self.member = User.objects.create_user(username='visitor').member
+        card_str = self.member.generate_member_card_str()
+        self.card_md5 = hashlib.md5(card_str.encode()).hexdigest()
+
+    def post(self, records):
+        response = Client().post(reverse('memb:api-visit-events'), json.dumps(records), content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode())
+
+    def test_batch(self):
+        records = [
+            {'card_md5': self.card_md5, 'event_type': "A", 'when': "2016-06-20T10:00:00-07:00", 'method': "R"},
+            {'card_md5': self.card_md5, 'event_type': "D", 'when': "2016-06-20T12:00:00-07:00", 'method': "R"},
+            {'card_md5': self.card_md5, 'event_type': "D", 'when': "2016-06-20T12:00:00-07:00", 'method': "R"},
+            {'card_md5': "0" * 32, 'event_type': "A", 'when': "2016-06-20T10:00:00-07:00"},
+            {'card_md5': self.card_md5, 'event_type': "X", 'when': "2016-06-20T10:00:00-07:00"},
+        ]
+        result = self.post(records)
+        self.assertEqual(result['created'], 2)
+        self.assertEqual(result['duplicates'], 1)
+        self.assertEqual([r['index'] for r in result['rejected']], [3, 4])
+        self.assertEqual(VisitEvent.objects.filter(who=self.member).count(), 2)
+        self.assertEqual(VisitEvent.objects.get(event_type="A").method, VisitEvent.METHOD_RFID)
+
+        # Replaying the batch doesn't create anything new.
+        result = self.post(records[:2])
+        self.assertEqual(result['created'], 0)
+        self.assertEqual(result['duplicates'], 2)
+
+    def test_concurrent_replay(self):
+        records = [
+            {'card_md5': self.card_md5, 'event_type': "A", 'when': "2016-06-20T10:00:00-07:00", 'method': "R"},
+            {'card_md5': self.card_md5, 'event_type': "D", 'when': "2016-06-20T12:00:00-07:00", 'method': "R"},
+        ]
+        # Another replay logs the arrival just after this one checks for duplicates.
+        when = datetime(2016, 6, 20, 17, 0, tzinfo=timezone.utc)
+        VisitEvent.objects.create(who=self.member, when=when, event_type="A", method="R")
+        real_filter = VisitEvent.objects.filter
+        calls = []
+
+        def filter_misses_first(*args, **kwargs):
+            calls.append(1)
+            return VisitEvent.objects.none() if len(calls) == 1 else real_filter(*args, **kwargs)
+
+        with patch.object(VisitEvent.objects, 'filter', side_effect=filter_misses_first):
+            result = self.post(records)
+        self.assertEqual(result['created'], 1)
+        self.assertEqual(result['duplicates'], 1)
+        self.assertEqual(VisitEvent.objects.filter(who=self.member).count(), 2)
+
+    def test_bad_card_md5(self):
+        records = [
+            {'card_md5': [self.card_md5], 'event_type': "A", 'when': "2016-06-20T10:00:00-07:00"},
+            {'card_md5': {'x': 1}, 'event_type': "A", 'when': "2016-06-20T10:00:00-07:00"},
+            {'card_md5': self.card_md5, 'event_type': "A", 'when': "2016-06-20T10:00:00-07:00"},
+        ]
+        result = self.post(records)
+        self.assertEqual(result['created'], 1)
+        self.assertEqual([r['index'] for r in result['rejected']], [0, 1])
+
+    def test_bad_body(self):
+        response = Client().post(reverse('memb:api-visit-events'), "nope", content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+
+
+class TestPresenceRollup(TestCase):
+
+    def setUp(self):
+        self.m1 = User.objects.create_user(username='m1').member
+        self.m2 = User.objects.create_user(username='m2').member
+        self.day = timezone.make_aware(datetime(2016, 6, 20, 10, 0), timezone.get_current_timezone())
+        # Ids used by earlier tests would otherwise show up as gaps.
+        probe = VisitEvent.objects.create(who=self.m1, when=self.day, event_type=VisitEvent.EVT_ARRIVAL)
+        probe.delete()
+        RollupMark.objects.create(name="presence."+PresenceInterval.SRC_VISITS, last_id=probe.pk)
+
+    def visit(self, who, hours, event_type=VisitEvent.EVT_ARRIVAL):
+        return VisitEvent.objects.create(who=who, when=self.day+timedelta(hours=hours), event_type=event_type)
+
+    def test_visits(self):
+        self.visit(self.m1, 0)
+        self.visit(self.m1, 1, VisitEvent.EVT_PRESENT)
+        self.visit(self.m1, 2, VisitEvent.EVT_DEPARTURE)
+        self.visit(self.m1, 2.5)  # After a departure, so a new interval.
+        self.visit(self.m2, 0)
+        presence.rollup(batch_size=2)
+
+        intervals = PresenceInterval.objects.filter(source=PresenceInterval.SRC_VISITS, who=self.m1)
+        self.assertEqual(intervals.count(), 2)
+        self.assertTrue(intervals[0].departed)
+        self.assertEqual(intervals[0].end - intervals[0].start, timedelta(hours=2))
+        self.assertEqual(presence.visits_per_day(self.day.date(), self.day.date()), {self.day.date(): 2})
+
+        # The next rollup picks up where the last one stopped.
+        self.visit(self.m2, 2)
+        presence.rollup()
+        self.assertEqual(PresenceInterval.objects.filter(who=self.m2).count(), 1)
+        here = presence.here_now(now=self.day+timedelta(hours=3))
+        self.assertEqual(set(here), {self.m1, self.m2})
+
+    def test_late_rows(self):
+        self.visit(self.m1, 0)
+        late = VisitEvent.objects.create(who=self.m2, when=self.day, event_type=VisitEvent.EVT_ARRIVAL)
+        self.visit(self.m1, 1)
+        # Simulate the middle row's transaction not having committed when the rollup runs.
+        late_pk = late.pk
+        late.delete()
+        presence.rollup()
+        self.assertEqual(PresenceInterval.objects.filter(who=self.m2).count(), 0)
+
+        VisitEvent.objects.create(id=late_pk, who=self.m2, when=self.day, event_type=VisitEvent.EVT_ARRIVAL)
+        presence.rollup()
+        self.assertEqual(PresenceInterval.objects.filter(who=self.m2).count(), 1)
+        self.assertEqual(presence.visits_per_day(self.day.date(), self.day.date()), {self.day.date(): 2})
+        mark = RollupMark.objects.get(name="presence."+PresenceInterval.SRC_VISITS)
+        self.assertEqual(mark.gaps, "")
+
+    def test_gaps_are_bounded_by_count(self):
+        events = [self.visit(self.m1, hours) for hours in range(6)]
+        for evt in events[1:5]:
+            evt.delete()
+        with patch.object(presence, 'MAX_GAPS', 3):
+            presence.rollup(batch_size=1)  # The skipped ids span batches.
+            presence.rollup()
+        mark = RollupMark.objects.get(name="presence."+PresenceInterval.SRC_VISITS)
+        self.assertEqual(mark.last_id, events[5].pk)
+        self.assertEqual(set(int(pk) for pk in json.loads(mark.gaps)), set(evt.pk for evt in events[2:5]))
+
+    def test_wifi(self):
+        for minutes in [0, 10, 20, 120]:
+            WifiMacDetected.objects.create(mac="0123456789ab", when=self.day+timedelta(minutes=minutes))
+        presence.rollup()
+        intervals = PresenceInterval.objects.filter(source=PresenceInterval.SRC_WIFI)
+        self.assertEqual(intervals.count(), 2)
+        self.assertEqual(intervals[0].end - intervals[0].start, timedelta(minutes=20))
+        self.assertEqual(
+            presence.visits_per_day(self.day.date(), self.day.date(), PresenceInterval.SRC_WIFI),
+            {self.day.date(): 1})
+
+
+class TestBulkWifiDetections(TestCase):
+
+    def setUp(self):
+        admin = User.objects.create_superuser(username='sensor', email="sensor@example.com", password="pw4sensor")
+        self.client = Client()
+        self.client.login(username=admin.username, password="pw4sensor")
+        WifiMacDetected.objects.create(mac="0123456789ab", when=timezone.now() - timedelta(minutes=1))
+
+    @override_settings(INTSYS_WIFI_DEDUPE_WINDOW=300)
+    def test_bulk(self):
+        now = timezone.now()
+        samples = [
+            {'mac': "01:23:45:67:89:AB", 'when': now.isoformat()},  # Within the window of the existing detection.
+            {'mac': "0123456789ab", 'when': (now + timedelta(minutes=10)).isoformat()},
+            {'mac': "ba9876543210", 'when': now.isoformat()},
+            {'mac': "ba9876543210", 'when': (now + timedelta(minutes=1)).isoformat()},
+            {'mac': "nope", 'when': now.isoformat()},
+        ]
+        response = self.client.post("/members/api/wifi-mac-detected/bulk/", json.dumps(samples),
+            content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.content.decode())
+        self.assertEqual(result['created'], 2)
+        self.assertEqual(result['duplicates'], 2)
+        self.assertEqual([r['index'] for r in result['rejected']], [4])
+        self.assertEqual(WifiMacDetected.objects.count(), 3)
+
+
+class TestDailyCounts(TestCase):
+
+    def test_against_day_by_day(self):
+        spans = [
+            (date(2014, 12, 25), date(2015, 1, 3), 0),
+            (date(2015, 1, 2), date(2015, 1, 2), 1),
+            (date(2015, 1, 2), date(2015, 1, 5), None),
+            (date(2015, 1, 9), date(2015, 1, 10), 1),
+            (date(2015, 1, 10), date(2015, 1, 8), 0),  # Ends before it starts, so it's ignored.
+        ]
+        expected = {}
+        for start, end, series in spans:
+            day = max(start, date(2015, 1, 1))
+            while day <= min(end, date(2015, 1, 9)):
+                counts = expected.setdefault(day, [0, 0])
+                if series is not None:
+                    counts[series] += 1
+                day += timedelta(days=1)
+        result = daily_counts(spans, 2, first_day=date(2015, 1, 1), last_day=date(2015, 1, 9))
+        self.assertEqual(result, [(day, tuple(expected[day])) for day in sorted(expected)])
+
+
+class TestMembershipDailyStats(TestCase):
+
+    def membership(self, start, end, mtype=Membership.MT_REGULAR, price="50.00"):
+        return Membership.objects.create(
+            member=self.member, membership_type=mtype, start_date=start, end_date=end, sale_price=Decimal(price))
+
+    def assertStatsMatch(self):
+        last_day = date(2016, 12, 31)
+        self.assertEqual(stats.member_counts_from_stats(last_day=last_day), stats.member_counts(last_day=last_day))
+
+    def setUp(self):
+        self.member = User.objects.create_user(username='statsy').member
+        self.membership(date(2016, 1, 10), date(2016, 2, 9))
+        self.membership(date(2016, 1, 20), date(2016, 2, 19), Membership.MT_COMPLIMENTARY, "0")
+
+    def test_rebuild_and_maintain(self):
+        self.assertFalse(stats.daily_stats_ready())
+        management.call_command("rebuildmembershipstats", verify=True)
+        self.assertTrue(stats.daily_stats_ready())
+        self.assertStatsMatch()
+
+        # Signals keep the table current from here on.
+        later = self.membership(date(2016, 2, 1), date(2016, 3, 1), Membership.MT_WORKTRADE, "10.00")
+        self.assertStatsMatch()
+        later.start_date, later.end_date = date(2016, 5, 1), date(2016, 5, 31)
+        later.save()
+        self.assertStatsMatch()
+        later.delete()
+        self.assertStatsMatch()
+
+    @staticmethod
+    def reference_revenue(first_day, last_day):
+        """Independently of members.stats, add up each membership's exact share of its price one day at a time."""
+        revenue = {}
+        for mship in Membership.objects.all():
+            share = Fraction(mship.sale_price) / ((mship.end_date - mship.start_date).days + 1)
+            day = max(mship.start_date, first_day)
+            while day <= min(mship.end_date, last_day):
+                revenue[(day.year, day.month)] = revenue.get((day.year, day.month), 0) + share
+                day += timedelta(days=1)
+        return in_cents(
+            (month, Decimal(amt.numerator) / Decimal(amt.denominator), Decimal(0))
+            for month, amt in sorted(revenue.items()))
+
+    def assertRevenueMatches(self, first_day, last_day):
+        self.assertEqual(
+            in_cents(stats.accrued_membership_revenue_from_stats(first_day, last_day)),
+            self.reference_revenue(first_day, last_day))
+
+    def test_revenue_is_exact(self):
+        management.call_command("rebuildmembershipstats", verify=True)
+        self.assertTrue(stats.monthly_revenue_ready())
+        self.assertRevenueMatches(stats.FIRST_STATS_DAY, date(2016, 12, 31))
+
+        # Signals keep the table current, and neither price divides evenly by the days.
+        self.membership(date(2016, 1, 1), date(2016, 1, 3), price="10.00")
+        later = self.membership(date(2016, 1, 25), date(2016, 4, 24), price="100.00")
+        self.assertRevenueMatches(stats.FIRST_STATS_DAY, date(2016, 12, 31))
+        later.start_date, later.end_date = date(2016, 3, 5), date(2016, 6, 4)
+        later.save()
+        self.assertRevenueMatches(stats.FIRST_STATS_DAY, date(2016, 12, 31))
+        self.assertRevenueMatches(date(2016, 1, 15), date(2016, 3, 10))  # Starts and ends part way through months.
+        self.assertEqual(in_cents(_calculate_accrued_membership_revenue()),
+            self.reference_revenue(stats.FIRST_STATS_DAY, date.today()))
+
+
+class DirectorsOnlyMixin(object):
+    """
+    Sets up a Director and a member who isn't one, to test pages that are for Directors only.
+    Also used by the books and tasks tests. Set directors_only_urls to the url names of the pages.
+    """
+
+    directors_only_urls = []
+
+    def setUp(self):
+        super().setUp()
+        director = User.objects.create_user(username='director', password="pw4director")
+        Tagging.objects.create(tagged_member=director.member, tag=Tag.objects.create(name="Director", meaning="Director"))
+        self.director = director.member
+        self.member = User.objects.create_user(username='notdirector', password="pw4member").member
+
+    def get_as(self, username, password, url_name):
+        client = Client()
+        client.login(username=username, password=password)
+        return client.get(reverse(url_name))
+
+    def get_as_director(self, url_name):
+        return self.get_as('director', "pw4director", url_name)
+
+    def test_directors_only(self):
+        for url_name in self.directors_only_urls:
+            response = self.get_as('notdirector', "pw4member", url_name)
+            self.assertEqual(response.content.decode(), "This page is for Directors only.")
+
+
+class TestCsvExports(DirectorsOnlyMixin, TestCase):
+
+    directors_only_urls = ['memb:csv-memberships', 'memb:csv-visit-events']
+
+    def setUp(self):
+        super().setUp()
+        for hours in range(5):
+            VisitEvent.objects.create(who=self.member, when=timezone.now()-timedelta(hours=hours),
+                event_type=VisitEvent.EVT_ARRIVAL, method=VisitEvent.METHOD_RFID)
+        Membership.objects.create(member=self.member, membership_type=Membership.MT_REGULAR,
+            start_date=date(2016, 1, 1), end_date=date(2016, 1, 31), sale_price=Decimal("50.00"))
+
+    def test_iterate_in_chunks(self):
+        visits = VisitEvent.objects.select_related('who__auth_user')
+        expected = list(VisitEvent.objects.order_by('pk').values_list('pk', flat=True))
+        with self.assertNumQueries(4):  # Chunks of 2, 2 and 1, then an empty one.
+            self.assertEqual([v.pk for v in iterate_in_chunks(visits, chunk_size=2)], expected)
+        with self.assertNumQueries(2):  # Exactly one full chunk, then an empty one.
+            self.assertEqual(len(list(iterate_in_chunks(visits.filter(pk__in=expected[:2]), chunk_size=2))), 2)
+
+    def test_streaming_csv_response(self):
+        response = streaming_csv_response("test.csv", ["a", "b"], ([n, "x,{}".format(n)] for n in range(2)))
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="test.csv"')
+        content = b"".join(response.streaming_content).decode()
+        self.assertEqual(content.splitlines(), ['a,b', '0,"x,0"', '1,"x,1"'])
+
+    def test_memberships(self):
+        response = self.get_as_director('memb:csv-memberships')
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0].split(",")[:3], ["id", "member", "type"])
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[1].split(",")[1:5], ["notdirector", "Regular", "2016-01-01", "2016-01-31"])
+
+    def test_visit_events(self):
+        response = self.get_as_director('memb:csv-visit-events')
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], "id,member,when,event type,method")
+        self.assertEqual(len(lines), 6)
+
+
+class TestPaidStatus(TestCase):
+
+    def setUp(self):
+        self.paid = User.objects.create_user(username='paid').member
+        self.lapsed = User.objects.create_user(username='lapsed').member
+        self.never = User.objects.create_user(username='never').member
+        for member, start, end in [
+          (self.paid, date.today()-timedelta(days=10), date.today()+timedelta(days=10)),
+          (self.lapsed, date.today()-timedelta(days=40), date.today()-timedelta(days=5))]:
+            Membership.objects.create(
+                member=member, membership_type=Membership.MT_COMPLIMENTARY, start_date=start, end_date=end)
+
+    def test_with_paid_status(self):
+        with self.assertNumQueries(1):
+            is_paid = {m.pk: bool(m.is_paid) for m in Member.objects.with_paid_status()}
+        self.assertEqual(is_paid, {self.paid.pk: True, self.lapsed.pk: False, self.never.pk: False})
+
+        members = Member.objects.with_paid_status(grace_period=timedelta(days=7)).filter(pk=self.lapsed.pk)
+        self.assertTrue(members[0].is_paid)
+
+        for member in [self.paid, self.lapsed, self.never]:
+            self.assertEqual(member.is_currently_paid(), is_paid[member.pk])
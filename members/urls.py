@@ -32,6 +32,7 @@ urlpatterns = [
     url(r'^api/member-details/(?P<member_card_str>[-_a-zA-Z0-9]{32})_(?P<staff_card_str>[-_a-zA-Z0-9]{32})/$', views.api_member_details, name="api-member-details"),
     url(r'^api/member-details-pub/(?P<member_card_str>[-_a-zA-Z0-9]{32})/$', views.api_member_details_pub, name="api-member-details-pub"),
     url(r'^api/visit-event/(?P<member_card_str>[-_a-zA-Z0-9]{32})_(?P<event_type>[APD])/$', views.api_log_visit_event, name="api-visit-event"),
+    url(r'^api/visit-events/$', views.api_log_visit_events, name="api-visit-events"),
 
     # DJANGO REST FRAMEWORK API
     url(r'^api/', include(router.urls)),
@@ -39,6 +40,8 @@ urlpatterns = [
     # OTHER
     url(r'^csv/monthly-accrued-membership/$', views.csv_monthly_accrued_membership, name='csv-monthly-accrued-membership'),
     url(r'^csv/monthly-accrued-membership-download/$', views.csv_monthly_accrued_membership_download, name='csv-monthly-accrued-membership_download'),
+    url(r'^csv/memberships/$', views.csv_memberships_download, name='csv-memberships'),
+    url(r'^csv/visit-events/$', views.csv_visit_events_download, name='csv-visit-events'),
 
     # RFID cards
     url(r'^rfid-entry-granted/(?P<rfid_cardnum_hash>[a-fA-f0-9]{32})/$', views.rfid_entry_granted, name='rfid-entry-granted'),
@@ -1,22 +1,30 @@
 
 # Standard
-from datetime import date
-from collections import Counter
+from datetime import date, timedelta
 from time import mktime
-import csv
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 from decimal import Decimal
 from logging import getLogger
 
 # Third party
 from django.shortcuts import get_object_or_404
-from dateutil.relativedelta import relativedelta
 from django.shortcuts import render, redirect
 from django.http import HttpResponse, JsonResponse
 from django.core.urlresolvers import reverse
 from django.contrib.auth.decorators import login_required
 from django.views.generic import View
 from django.conf import settings
-from rest_framework import viewsets
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Max
+from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from dateutil.parser import parse as parse_datetime
+from rest_framework import viewsets, status
+from rest_framework.decorators import list_route
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from reportlab.pdfgen import canvas
@@ -30,14 +38,16 @@ from reportlab.lib.pagesizes import letter
 from members.models import Member, Tag, Tagging, VisitEvent, Membership, DiscoveryMethod, MembershipGiftCardReference, WifiMacDetected
 from members.forms import Desktop_ChooseUserForm
 import members.serializers as ser
-from members.models import GroupMembership
 from members.notifications import notify
-from abutils.utils import request_is_from_host
+import members.stats as stats
+from members.signals.handlers import note_checkins
+from abutils.utils import request_is_from_host, run_in_background, iterate_in_chunks, streaming_csv_response
 
 logger = getLogger("members")
 
 ORG_NAME_POSSESSIVE = settings.INTSYS_ORG_NAME_POSSESSIVE
 FACILITY_PUBLIC_IP = settings.INTSYS_FACILITY_PUBLIC_IP
+VISIT_EVENT_INSERT_ATTEMPTS = 3
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = PRIVATE
 
@@ -130,6 +140,87 @@ def api_log_visit_event(request, member_card_str, event_type):
         return JsonResponse({'error': result})
 
 
+@csrf_exempt
+@require_POST
+def api_log_visit_events(request):
+    """
+    Log a batch of visit events, e.g. as replayed by an RFID reader after an outage.
+    The body is a JSON list of {"card_md5", "event_type", "when", "method"} records, with "when" in ISO 8601.
+    Events that were already logged are skipped, so replaying a batch is harmless.
+    """
+
+    # See api_log_visit_event regarding FACILITY_PUBLIC_IP.
+    if FACILITY_PUBLIC_IP is not None:
+        if not request_is_from_host(request, FACILITY_PUBLIC_IP):
+            msg = "Must be on {} WiFi to check in/out".format(ORG_NAME_POSSESSIVE)
+            return JsonResponse({'error': msg})
+
+    try:
+        records = json.loads(request.body.decode())
+        assert isinstance(records, list)
+    except (ValueError, AssertionError):
+        return JsonResponse({'error': "Expected a JSON list of visit events."}, status=400)
+
+    valid_types = [x for (x, _) in VisitEvent.VISIT_EVENT_CHOICES]
+    valid_methods = [x for (x, _) in VisitEvent.VISIT_METHOD_CHOICES]
+    card_md5s = set(r['card_md5'] for r in records if isinstance(r, dict) and isinstance(r.get('card_md5'), str))
+    members = {m.membership_card_md5: m for m in Member.objects.filter(membership_card_md5__in=card_md5s)}
+
+    # Validate the records and drop duplicates within the batch:
+    rejected, candidates = [], {}
+    for n, r in enumerate(records):
+        try:
+            assert isinstance(r, dict), "Not a visit event."
+            member = members.get(r.get('card_md5'))
+            assert member is not None, "No matching member found."
+            assert r.get('event_type') in valid_types, "Invalid event type."
+            method = r.get('method', VisitEvent.METHOD_UNKNOWN)
+            assert method in valid_methods, "Invalid method."
+            when = parse_datetime(r['when'])
+            if timezone.is_naive(when):
+                when = timezone.make_aware(when, timezone.get_current_timezone())
+        except (AssertionError, KeyError, ValueError, OverflowError, TypeError) as e:
+            rejected.append({'index': n, 'error': str(e) or "Invalid visit event."})
+            continue
+        candidates.setdefault((member.pk, when), VisitEvent(who=member, when=when, event_type=r['event_type'], method=method))
+
+    # Drop events that were logged previously, then add the rest.
+    # A concurrent replay of the same events can add some of them between the check and the insert, in which case
+    # the insert violates unique (who, when) and is rolled back to the savepoint. Checking again then finds them.
+    for attempt in range(VISIT_EVENT_INSERT_ATTEMPTS):
+        try:
+            with transaction.atomic():
+                existing = set(VisitEvent.objects.filter(
+                    who__in=set(pk for pk, _ in candidates.keys()),
+                    when__in=set(when for _, when in candidates.keys()),
+                ).values_list('who', 'when'))
+                new_keys = set(key for key in candidates.keys() if key not in existing)
+                new_events = [candidates[key] for key in new_keys]
+                VisitEvent.objects.bulk_create(new_events)
+                # bulk_create doesn't provide pks, so fetch them for the background work.
+                new_pks = [pk for pk, who, when in VisitEvent.objects.filter(
+                    who__in=set(pk for pk, _ in new_keys),
+                    when__in=set(when for _, when in new_keys),
+                ).values_list('pk', 'who', 'when') if (who, when) in new_keys] if len(new_keys) > 0 else []
+            break
+        except IntegrityError:
+            if attempt + 1 == VISIT_EVENT_INSERT_ATTEMPTS:
+                raise
+            logger.info("Some visit events were logged concurrently, so checking for duplicates again.")
+
+    for evt in new_events:
+        _inform_other_systems_of_checkin(evt.who, evt.event_type)
+    if len(new_pks) > 0:
+        run_in_background('default', note_checkins, new_pks)
+
+    return JsonResponse({
+        'success': "Visit events logged",
+        'created': len(new_events),
+        'duplicates': len(records) - len(rejected) - len(new_events),
+        'rejected': rejected,
+    })
+
+
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = DESKTOP
 
 @login_required
@@ -267,6 +358,80 @@ class Kiosk_LogVisitEvent(View):
 
     extra_content_providers = []
 
+    # If INTSYS_KIOSK_CONTENT_THREADS is greater than zero, providers run concurrently in a pool of that many
+    # threads and any provider that takes longer than INTSYS_KIOSK_CONTENT_TIMEOUT seconds contributes nothing.
+    # A provider that times out keeps its pool thread until it finishes, so it isn't run again until then.
+    # Otherwise, a few hung providers could tie up the whole pool.
+    _executor = None
+    _abandoned = {}  # Provider -> futures of its calls that timed out but haven't finished.
+    _lock = threading.Lock()
+
+    @classmethod
+    def _get_executor(cls) -> ThreadPoolExecutor:
+        with cls._lock:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(max_workers=settings.INTSYS_KIOSK_CONTENT_THREADS)
+            return cls._executor
+
+    @classmethod
+    def _abandon(cls, f, future):
+        abandoned_at = time.time()
+        with cls._lock:
+            cls._abandoned.setdefault(f, set()).add(future)
+
+        def finished(done_future):
+            with cls._lock:
+                cls._abandoned[f].discard(done_future)
+            logger.warning("Kiosk content provider %s finished %.3fs after it was abandoned.",
+                f.__name__, time.time() - abandoned_at)
+
+        future.add_done_callback(finished)
+
+    @classmethod
+    def _is_stuck(cls, f) -> bool:
+        with cls._lock:
+            return len(cls._abandoned.get(f, ())) > 0
+
+    @staticmethod
+    def _run_provider(f, member, member_card_str, event_type, in_thread=False):
+        start = time.time()
+        try:
+            return f(member, member_card_str, event_type)
+        finally:
+            logger.info("Kiosk content provider %s took %.3fs", f.__name__, time.time() - start)
+            if in_thread:
+                connection.close()  # Each pool thread gets its own DB connection.
+
+    def get_extra_content(self, member, member_card_str, event_type) -> str:
+        threads = getattr(settings, 'INTSYS_KIOSK_CONTENT_THREADS', 0)
+        if threads <= 0 or len(self.extra_content_providers) <= 1:
+            return "".join(
+                self._run_provider(f, member, member_card_str, event_type) for f in self.extra_content_providers)
+
+        timeout = getattr(settings, 'INTSYS_KIOSK_CONTENT_TIMEOUT', 2.0)
+        executor = self._get_executor()
+        futures = []
+        for f in self.extra_content_providers:
+            if self._is_stuck(f):
+                logger.warning("Kiosk content provider %s is still stuck on an earlier call, so it was skipped.",
+                    f.__name__)
+                futures.append(None)
+            else:
+                futures.append(executor.submit(self._run_provider, f, member, member_card_str, event_type, True))
+        deadline = time.time() + timeout
+        extra_content = ""
+        for f, future in zip(self.extra_content_providers, futures):
+            if future is None:
+                continue
+            try:
+                extra_content += future.result(timeout=max(0, deadline - time.time()))
+            except TimeoutError:
+                logger.warning("Kiosk content provider %s timed out, so its content was skipped.", f.__name__)
+                self._abandon(f, future)
+            except Exception as e:
+                logger.error("Kiosk content provider %s failed: %s", f.__name__, str(e))
+        return extra_content
+
     def get(self, request, *args, **kwargs):
         member_card_str = kwargs['member_card_str']
         event_type = kwargs['event_type']
@@ -281,9 +446,7 @@ class Kiosk_LogVisitEvent(View):
             }
             assert len(actions) == len(VisitEvent.VISIT_EVENT_CHOICES)
 
-            extra_content = ""
-            for f in self.extra_content_providers:
-                extra_content += f(member, member_card_str, event_type)
+            extra_content = self.get_extra_content(member, member_card_str, event_type)
 
             params = {
                 "username"      : member.username,
@@ -400,8 +563,12 @@ class MemberViewSet(viewsets.ModelViewSet):
     serializer_class = ser.get_MemberSerializer(True)  # Default to privacy.
     permission_classes = [IsAuthenticated]
 
+    def get_queryset(self):
+        # Paid status is for today, so it's annotated per request.
+        return Member.objects.with_paid_status().select_related('auth_user')
+
     def retrieve(self, request, pk=None):
-        memb = get_object_or_404(self.queryset, pk=pk)
+        memb = get_object_or_404(self.get_queryset(), pk=pk)
 
         with_privacy = True
         is_director = request.user.member.is_tagged_with("Director")
@@ -447,6 +614,54 @@ class WifiMacDetectedViewSet(viewsets.ModelViewSet):
     queryset = WifiMacDetected.objects.all()
     serializer_class = ser.WifiMacDetectedSerializer
 
+    @list_route(methods=['post'])
+    def bulk(self, request):
+        """
+        Log a batch of detections, given as a list of {"mac", "when"} samples with "when" in ISO 8601.
+        A sample is dropped if the same MAC was already logged within INTSYS_WIFI_DEDUPE_WINDOW seconds of it.
+        """
+        samples = request.data
+        if not isinstance(samples, list):
+            return Response({'error': "Expected a list of samples."}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Validate the samples and group them by MAC:
+        rejected, whens_by_mac = [], {}
+        for n, sample in enumerate(samples):
+            try:
+                assert isinstance(sample, dict), "Not a sample."
+                mac = str(sample['mac']).replace(":", "").replace("-", "").lower()
+                assert len(mac) == 12 and all(c in "0123456789abcdef" for c in mac), "Invalid MAC."
+                when = parse_datetime(sample['when'])
+                if timezone.is_naive(when):
+                    when = timezone.make_aware(when, timezone.get_current_timezone())
+            except (AssertionError, KeyError, ValueError, OverflowError, TypeError) as e:
+                rejected.append({'index': n, 'error': str(e) or "Invalid sample."})
+                continue
+            whens_by_mac.setdefault(mac, []).append(when)
+
+        # Keep only samples that are more than the window away from the last one kept for the same MAC,
+        # starting from the latest detection already logged for it.
+        window = timedelta(seconds=getattr(settings, 'INTSYS_WIFI_DEDUPE_WINDOW', 300))
+        latest = dict(WifiMacDetected.objects
+            .filter(mac__in=whens_by_mac.keys())
+            .values('mac').annotate(latest=Max('when'))
+            .values_list('mac', 'latest'))
+        new_detections = []
+        for mac, whens in whens_by_mac.items():
+            last = latest.get(mac)
+            for when in sorted(whens):
+                if last is not None and abs(when - last) < window:
+                    continue
+                new_detections.append(WifiMacDetected(mac=mac, when=when))
+                last = when
+        WifiMacDetected.objects.bulk_create(new_detections)
+
+        return Response({
+            'created': len(new_detections),
+            'duplicates': len(samples) - len(rejected) - len(new_detections),
+            'rejected': rejected,
+        })
+
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
 # RFID CARDS
@@ -477,37 +692,14 @@ def desktop_member_count_vs_date(request):
     if not request.user.member.is_tagged_with("Director"):
         return HttpResponse("This page is for Directors only.")
 
-    end_date = date.today()  # .replace(day=1)  # - relativedelta(days=1)
-    wt_data = Counter()
-    reg_data = Counter()
-    comp_data = Counter()
-    group_data = Counter()
-    fam_data = Counter()
-
-    memberships = Membership.objects.all()
-    for pm in memberships:
-        # Not enough gift card sales to call them out separately. Will include them in "Regular" count.
-        wt_inc = 1 if pm.membership_type == pm.MT_WORKTRADE else 0
-        reg_inc = 1 if pm.membership_type in [pm.MT_REGULAR, pm.MT_GIFTCARD] else 0
-        comp_inc = 1 if pm.membership_type == pm.MT_COMPLIMENTARY else 0
-        group_inc = 1 if pm.membership_type == pm.MT_GROUP else 0
-        fam_inc = 1 if pm.membership_type == pm.MT_FAMILY else 0
-        day = max(pm.start_date, date(2015, 1, 1))
-        while day <= min(pm.end_date, end_date):
-            js_time_milliseconds = int(mktime(day.timetuple())) * 1000
-            wt_data.update({js_time_milliseconds: wt_inc})
-            reg_data.update({js_time_milliseconds: reg_inc})
-            comp_data.update({js_time_milliseconds: comp_inc})
-            group_data.update({js_time_milliseconds: group_inc})
-            fam_data.update({js_time_milliseconds: fam_inc})
-            day += relativedelta(days=1)
-
-    js_times = sorted(reg_data)  # Gets keys
-    reg_counts = zero_to_null([reg_data[k] for k in js_times])
-    wt_counts = zero_to_null([wt_data[k] for k in js_times])
-    comp_counts = zero_to_null([comp_data[k] for k in js_times])
-    group_counts = zero_to_null([group_data[k] for k in js_times])
-    fam_counts = zero_to_null([fam_data[k] for k in js_times])
+    if stats.daily_stats_ready():
+        counts_by_day = stats.member_counts_from_stats()
+    else:
+        counts_by_day = stats.member_counts()
+
+    js_times = [int(mktime(day.timetuple())) * 1000 for day, _ in counts_by_day]
+    series = list(zip(*[counts for _, counts in counts_by_day])) or [()] * stats.COUNT_SERIES
+    reg_counts, fam_counts, wt_counts, group_counts, comp_counts = [zero_to_null(list(x)) for x in series]
 
     data = list(zip(js_times, reg_counts, fam_counts, wt_counts, group_counts, comp_counts))
     return render(request, 'members/desktop-member-count-vs-date.html', {'data': data})
@@ -523,40 +715,10 @@ def csv_monthly_accrued_membership(request):
 
 
 def _calculate_accrued_membership_revenue():
-
-    end_date = date.today()  # .replace(day=1)  # - relativedelta(days=1)
-    indi_data = Counter()
-    grp_data = Counter()
-
-    for pm in Membership.objects.all():
-
-        duration = pm.end_date - pm.start_date
-        days = 1.0 + duration.total_seconds() / (60.0*60.0*24.0)
-        amt_per_day = pm.sale_price / Decimal(days)
-        day = max(pm.start_date, date(2015, 1, 1))
-        while day <= min(pm.end_date, end_date):
-            indi_data.update({(day.year, day.month): amt_per_day})
-            day += relativedelta(days=1)
-
-    for gm in GroupMembership.objects.all():
-        if gm.sale_price == 0.0:
-            logger.warning("$0 group membership #%s: %s", gm.pk, str(gm))
-
-        duration = gm.end_date - gm.start_date
-        days = 1.0 + duration.total_seconds() / (60.0*60.0*24.0)
-        amt_per_day = gm.sale_price / Decimal(days)
-        day = max(gm.start_date, date(2015,1,1))
-        while day <= min(gm.end_date, end_date):
-            grp_data.update({(day.year, day.month): amt_per_day})
-            day += relativedelta(days=1)
-
-    dates = sorted([x for x in indi_data])
-    indi_vals = [indi_data[k] for k in dates]
-    grp_vals = [grp_data[k] for k in dates]
-    indi_vals = [x if isinstance(x, Decimal) else Decimal(x) for x in indi_vals]
-    grp_vals = [x if isinstance(x, Decimal) else Decimal(x) for x in grp_vals]
-    data = list(zip(dates, indi_vals, grp_vals))
-    return data
+    if stats.monthly_revenue_ready():
+        return stats.accrued_membership_revenue_from_stats()
+    else:
+        return stats.accrued_membership_revenue()
 
 
 @login_required()
@@ -565,18 +727,43 @@ def csv_monthly_accrued_membership_download(request):
         return HttpResponse("This page is for Directors only.")
 
     data = _calculate_accrued_membership_revenue()
+    TWOPLACES = Decimal('0.01')
+    rows = (
+        [year, month, indi_val.quantize(TWOPLACES), grp_val.quantize(TWOPLACES)]
+        for (year, month), indi_val, grp_val in data
+    )
+    return streaming_csv_response("monthly-accrued-membership.csv", ["year", "month", "indi rev", "group rev"], rows)
 
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment; filename="monthly-accrued-membership.csv"'
 
-    writer = csv.writer(response)
-    TWOPLACES = Decimal('0.01')
-    writer.writerow(["year", "month", "indi rev", "group rev"])
+@login_required()
+def csv_memberships_download(request):
+    if not request.user.member.is_tagged_with("Director"):
+        return HttpResponse("This page is for Directors only.")
 
-    for (year, month), indi_val, grp_val in data:
-        writer.writerow([year, month, indi_val.quantize(TWOPLACES), grp_val.quantize(TWOPLACES)])
+    memberships = Membership.objects.select_related('member__auth_user')
+    rows = (
+        [
+            pm.pk, pm.member.username if pm.member is not None else "", pm.get_membership_type_display(),
+            pm.start_date, pm.end_date, pm.sale_price, pm.sale_id or "", pm.group_id or "", pm.ctrlid
+        ]
+        for pm in iterate_in_chunks(memberships)
+    )
+    header = ["id", "member", "type", "start date", "end date", "sale price", "sale id", "group id", "ctrlid"]
+    return streaming_csv_response("memberships.csv", header, rows)
 
-    return response
+
+@login_required()
+def csv_visit_events_download(request):
+    if not request.user.member.is_tagged_with("Director"):
+        return HttpResponse("This page is for Directors only.")
+
+    visits = VisitEvent.objects.select_related('who__auth_user')
+    rows = (
+        [visit.pk, visit.who.username, timezone.localtime(visit.when).isoformat(),
+         visit.get_event_type_display(), visit.get_method_display()]
+        for visit in iterate_in_chunks(visits)
+    )
+    return streaming_csv_response("visit-events.csv", ["id", "member", "when", "event type", "method"], rows)
 
 
 @login_required()
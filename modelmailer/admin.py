@@ -1,3 +1,17 @@
 from django.contrib import admin
 
-# Register your models here.
+from modelmailer.models import OutgoingEmail
+
+
+@admin.register(OutgoingEmail)
+class OutgoingEmailAdmin(admin.ModelAdmin):
+
+    list_display = ['pk', 'created', 'recipients', 'subject', 'status', 'attempts', 'next_attempt', 'sent']
+
+    list_filter = ['status']
+
+    search_fields = ['recipients', 'subject']
+
+    readonly_fields = ['idempotency_key', 'created', 'sent', 'last_error']
+
+    date_hierarchy = 'created'
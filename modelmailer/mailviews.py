@@ -1,20 +1,28 @@
 
 # Standard
 import logging
-from typing import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Sequence
 
 # Third Party
-from django.core.mail import EmailMultiAlternatives
+from django.core.mail import EmailMultiAlternatives, EmailMessage, get_connection
+from django.db import connection as db_connection
 from django.template.loader import get_template
 from django.template import Context
 
 # Local
+from modelmailer import outbox
 
 registrations = {}
 
 
 class MailView:
 
+    # Outcomes of send():
+    SEND_FAILED = 0
+    SEND_QUEUED = 1
+    SEND_ALREADY_QUEUED = 2  # An identical message is still waiting to be sent, so this one wasn't queued.
+
     def __init__(self):
         self.logger = logging.getLogger("modelmailer")
 
@@ -22,6 +30,9 @@ class MailView:
         raise NotImplementedError("get_email_spec must be implemented by subclass")
 
     def send(self, obj):
+        """Render the email for obj and queue it in the outbox, which sends it in the background.
+        Returns SEND_QUEUED, SEND_ALREADY_QUEUED, or SEND_FAILED (which is the only falsy one).
+        """
         try:
             spec = self.get_email_spec(obj)
             params = Context(spec['parameters'])
@@ -35,16 +46,17 @@ class MailView:
                 spec['bccs'],        # BCC list
             )
             msg.attach_alternative(html, "text/html")
-            msg.send()
-            self.logger.info(spec['info-for-log'])
-            return True
+            key = outbox.make_idempotency_key(
+                type(self).__name__, type(obj).__name__, getattr(obj, 'pk', None),
+                spec['recipients'], spec['subject'], text)
+            _, created = outbox.queue_message(msg, key, spec['info-for-log'])
+            return MailView.SEND_QUEUED if created else MailView.SEND_ALREADY_QUEUED
 
         except Exception as e:
-            # TODO: Save in DB, log error, and try again later?
-            self.logger.error("Failed to send email for {} #{} using {} because: {}".format(
+            self.logger.error("Failed to queue email for {} #{} using {} because: {}".format(
                 type(obj), getattr(obj, 'pk', "noPK"), type(self), str(e)
             ))
-            return False
+            return MailView.SEND_FAILED
 
 
 def register(model_class):
@@ -53,3 +65,73 @@ def register(model_class):
         return mailview_class
     return x
 
+
+def render_messages(render: Callable, items: Sequence, threads: int=0) -> list:
+    """
+    Build an email message for each item by calling render(item).
+    :param threads: If greater than zero, render in a pool of this many threads.
+    Rendering in threads only pays off if render doesn't need much from the database.
+    :return: A list of messages, parallel to items. The message is None if rendering failed.
+    """
+    logger = logging.getLogger("modelmailer")
+
+    def render_one(item):
+        try:
+            return render(item)
+        except Exception as e:
+            logger.error("Failed to render email for %s because: %s", item, str(e))
+            return None
+
+    def render_slice(some_items):
+        try:
+            return [render_one(item) for item in some_items]
+        finally:
+            db_connection.close()  # Each thread gets its own DB connection, so close it when the thread is done.
+
+    if threads <= 0:
+        return [render_one(item) for item in items]
+
+    # One slice per thread, so that each thread connects to the DB at most once.
+    slice_size = max(1, -(-len(items) // threads))
+    slices = [items[n:n+slice_size] for n in range(0, len(items), slice_size)]
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return [msg for rendered in executor.map(render_slice, slices) for msg in rendered]
+
+
+def send_messages_batched(messages: Sequence[EmailMessage], chunk_size: int=100) -> list:
+    """
+    Send messages over a single email backend connection, chunk_size messages per send_messages call.
+    Messages that are None (e.g. failed to render) are skipped.
+    :return: A list of booleans, parallel to messages, indicating which were handed off to the backend.
+    If the backend reports sending fewer than a whole chunk, there's no telling which went out, so the whole
+    chunk is reported as not sent.
+    """
+    logger = logging.getLogger("modelmailer")
+    results = [False] * len(messages)
+    pending = [(n, msg) for n, msg in enumerate(messages) if msg is not None]
+    if len(pending) == 0:
+        return results
+
+    connection = get_connection()
+    try:
+        connection.open()
+        for start in range(0, len(pending), chunk_size):
+            chunk = pending[start:start+chunk_size]
+            try:
+                sent = connection.send_messages([msg for _, msg in chunk])
+            except Exception as e:
+                # Some of the chunk may have gone out, but resending could duplicate them.
+                logger.error("Failed to send %d email(s) to %s because: %s",
+                    len(chunk), ", ".join(",".join(msg.to) for _, msg in chunk), str(e))
+                continue
+            if sent != len(chunk):
+                logger.error("Backend reports %s of %d email(s) to %s sent.",
+                    sent, len(chunk), ", ".join(",".join(msg.to) for _, msg in chunk))
+                continue
+            for n, _ in chunk:
+                results[n] = True
+    finally:
+        connection.close()
+
+    logger.info("Sent %d of %d email(s).", sum(results), len(messages))
+    return results
@@ -0,0 +1,19 @@
+# Standard
+
+# Third party
+from django.core.management.base import BaseCommand
+
+# Local
+from modelmailer.outbox import drain_outbox, BATCH_SIZE
+
+
+class Command(BaseCommand):
+
+    help = "Sends queued emails that are due, including retries of earlier failures."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        sent = drain_outbox(options['batch_size'])
+        self.stdout.write("Sent %d email(s)." % sent)
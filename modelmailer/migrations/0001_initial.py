@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutgoingEmail',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('idempotency_key', models.CharField(max_length=64, unique=True, help_text="Identifies the message so that queueing it twice doesn't send it twice.")),
+                ('created', models.DateTimeField(auto_now_add=True, help_text='Date/time at which the message was queued.')),
+                ('subject', models.CharField(max_length=256, blank=True, help_text="The message's subject line.")),
+                ('sender', models.CharField(max_length=256, help_text="The message's From address.")),
+                ('recipients', models.TextField(help_text="The message's To addresses, one per line.")),
+                ('bccs', models.TextField(blank=True, help_text="The message's BCC addresses, one per line.")),
+                ('text_body', models.TextField(blank=True, help_text='The plain text version of the message.')),
+                ('html_body', models.TextField(blank=True, help_text='The HTML version of the message, if any.')),
+                ('info_for_log', models.CharField(max_length=256, blank=True, help_text='Logged once the message has been sent.')),
+                ('status', models.CharField(max_length=1, choices=[('P', 'Pending'), ('S', 'Sent'), ('D', 'Dead')], default='P', help_text='Whether the message is waiting to be sent, has been sent, or has been given up on.')),
+                ('attempts', models.IntegerField(default=0, help_text='The number of failed attempts to send the message.')),
+                ('next_attempt', models.DateTimeField(db_index=True, default=django.utils.timezone.now, help_text="The message won't be sent before this date/time.")),
+                ('last_error', models.TextField(blank=True, help_text='The error from the most recent failed attempt, if any.')),
+                ('sent', models.DateTimeField(null=True, blank=True, default=None, help_text='Date/time at which the message was handed to the email backend.')),
+            ],
+            options={
+                'ordering': ['next_attempt'],
+            },
+        ),
+    ]
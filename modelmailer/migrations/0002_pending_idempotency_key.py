@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def clear_finished_keys(apps, schema_editor):
+    OutgoingEmail = apps.get_model('modelmailer', 'OutgoingEmail')
+    OutgoingEmail.objects.exclude(status='P').update(idempotency_key=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('modelmailer', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='outgoingemail',
+            name='idempotency_key',
+            field=models.CharField(max_length=64, unique=True, null=True, blank=True, help_text="Identifies a pending message so that queueing it again before it's sent doesn't send it twice."),
+        ),
+        migrations.RunPython(clear_finished_keys, migrations.RunPython.noop),
+    ]
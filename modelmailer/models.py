@@ -1,3 +1,64 @@
 from django.db import models
+from django.utils import timezone
 
-# Create your models here.
+
+class OutgoingEmail(models.Model):
+    """ A rendered email message waiting to be sent, or a record of one that was sent or given up on. """
+
+    # Cleared once the message is sent or given up on, so that the same message can be queued again later.
+    idempotency_key = models.CharField(max_length=64, unique=True, null=True, blank=True,
+        help_text="Identifies a pending message so that queueing it again before it's sent doesn't send it twice.")
+
+    created = models.DateTimeField(null=False, blank=False, auto_now_add=True,
+        help_text="Date/time at which the message was queued.")
+
+    subject = models.CharField(max_length=256, blank=True,
+        help_text="The message's subject line.")
+
+    sender = models.CharField(max_length=256, blank=False,
+        help_text="The message's From address.")
+
+    recipients = models.TextField(blank=False,
+        help_text="The message's To addresses, one per line.")
+
+    bccs = models.TextField(blank=True,
+        help_text="The message's BCC addresses, one per line.")
+
+    text_body = models.TextField(blank=True,
+        help_text="The plain text version of the message.")
+
+    html_body = models.TextField(blank=True,
+        help_text="The HTML version of the message, if any.")
+
+    info_for_log = models.CharField(max_length=256, blank=True,
+        help_text="Logged once the message has been sent.")
+
+    STAT_PENDING = "P"
+    STAT_SENT = "S"
+    STAT_DEAD = "D"
+    STATUS_CHOICES = [
+        (STAT_PENDING, "Pending"),
+        (STAT_SENT, "Sent"),
+        (STAT_DEAD, "Dead"),  # Gave up after too many failed attempts.
+    ]
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES, default=STAT_PENDING,
+        null=False, blank=False,
+        help_text="Whether the message is waiting to be sent, has been sent, or has been given up on.")
+
+    attempts = models.IntegerField(default=0, null=False, blank=False,
+        help_text="The number of failed attempts to send the message.")
+
+    next_attempt = models.DateTimeField(null=False, blank=False, default=timezone.now, db_index=True,
+        help_text="The message won't be sent before this date/time.")
+
+    last_error = models.TextField(blank=True,
+        help_text="The error from the most recent failed attempt, if any.")
+
+    sent = models.DateTimeField(null=True, blank=True, default=None,
+        help_text="Date/time at which the message was handed to the email backend.")
+
+    def __str__(self):
+        return "%s, %s, %s" % (self.created.isoformat()[:10], self.recipients.replace("\n", ", "), self.subject)
+
+    class Meta:
+        ordering = ['next_attempt']
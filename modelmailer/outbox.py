@@ -0,0 +1,133 @@
+# Standard
+import hashlib
+import logging
+from datetime import timedelta
+from typing import Tuple
+
+# Third Party
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.utils import timezone
+
+# Local
+from abutils.utils import run_in_background
+from modelmailer.models import OutgoingEmail
+
+MAX_ATTEMPTS = 8
+FIRST_RETRY_DELAY = timedelta(minutes=1)  # Doubles after each failed attempt.
+MAX_RETRY_DELAY = timedelta(hours=6)
+BATCH_SIZE = 50
+LEASE_TIME = timedelta(minutes=10)  # If a drain dies mid-batch, the rest of its batch is retried after this.
+
+
+def make_idempotency_key(*parts) -> str:
+    """Derive a key from whatever identifies a message, e.g. its class, target, and content."""
+    return hashlib.sha256("\n".join(str(part) for part in parts).encode()).hexdigest()
+
+
+def queue_message(msg: EmailMultiAlternatives, idempotency_key: str, info_for_log: str="") -> Tuple[OutgoingEmail, bool]:
+    """
+    Durably store msg so that the outbox will send it, and ask for the outbox to be drained.
+    Queueing a message with the same idempotency key as one that's still pending does nothing.
+    Once that one has been sent (or given up on), the key can be used to queue the message again.
+    :return: (the OutgoingEmail, whether it was newly queued)
+    """
+    html = ""
+    for content, mimetype in getattr(msg, 'alternatives', []):
+        if mimetype == "text/html":
+            html = content
+    email, created = OutgoingEmail.objects.get_or_create(
+        idempotency_key=idempotency_key,
+        defaults={
+            'subject': msg.subject,
+            'sender': msg.from_email,
+            'recipients': "\n".join(msg.to),
+            'bccs': "\n".join(msg.bcc),
+            'text_body': msg.body,
+            'html_body': html,
+            'info_for_log': info_for_log,
+        }
+    )
+    if created:
+        request_drain()
+    return email, created
+
+
+def request_drain():
+    """Drain the outbox on the rq worker, or right now if background jobs aren't available."""
+    run_in_background('default', drain_outbox)
+
+
+def _as_message(email: OutgoingEmail) -> EmailMultiAlternatives:
+    msg = EmailMultiAlternatives(
+        email.subject,
+        email.text_body,
+        email.sender,
+        email.recipients.splitlines(),
+        email.bccs.splitlines(),
+    )
+    if email.html_body != "":
+        msg.attach_alternative(email.html_body, "text/html")
+    return msg
+
+
+def _retry_delay(attempts: int) -> timedelta:
+    return min(FIRST_RETRY_DELAY * 2**(attempts-1), MAX_RETRY_DELAY)
+
+
+def _lease_batch(batch_size: int) -> list:
+    """
+    Claim up to batch_size due messages by pushing their next attempt LEASE_TIME into the future.
+    The row locks are only held for this short transaction, not while the messages are being sent,
+    and other drains skip the claimed messages until the lease runs out.
+    """
+    with transaction.atomic():
+        now = timezone.now()
+        batch = list(OutgoingEmail.objects.select_for_update().filter(
+            status=OutgoingEmail.STAT_PENDING,
+            next_attempt__lte=now,
+        )[:batch_size])
+        OutgoingEmail.objects.filter(pk__in=[email.pk for email in batch]).update(next_attempt=now+LEASE_TIME)
+    return batch
+
+
+def drain_outbox(batch_size: int=BATCH_SIZE) -> int:
+    """
+    Send pending messages that are due, batch_size at a time, over a single email backend connection.
+    Failed messages are retried with exponential backoff and are marked dead after MAX_ATTEMPTS.
+    :return: The number of messages sent.
+    """
+    logger = logging.getLogger("modelmailer")
+    sent_count = 0
+    connection = get_connection()
+    try:
+        while True:
+            batch = _lease_batch(batch_size)
+            if len(batch) == 0:
+                break
+            for email in batch:
+                try:
+                    if connection.send_messages([_as_message(email)]) != 1:
+                        raise RuntimeError("The email backend did not accept the message.")
+                except Exception as e:
+                    email.attempts += 1
+                    email.last_error = str(e)
+                    if email.attempts >= MAX_ATTEMPTS:
+                        email.status = OutgoingEmail.STAT_DEAD
+                        email.idempotency_key = None
+                        logger.error("Gave up on email #%s to %s because: %s", email.pk, email.recipients, str(e))
+                    else:
+                        email.next_attempt = timezone.now() + _retry_delay(email.attempts)
+                        logger.warning("Will retry email #%s to %s because: %s", email.pk, email.recipients, str(e))
+                    email.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt', 'idempotency_key'])
+                else:
+                    email.status = OutgoingEmail.STAT_SENT
+                    email.idempotency_key = None
+                    email.sent = timezone.now()
+                    sent_count += 1
+                    if email.info_for_log != "":
+                        logger.info(email.info_for_log)
+                    email.save(update_fields=['status', 'sent', 'idempotency_key'])
+    finally:
+        connection.close()
+    return sent_count
@@ -1,30 +1,164 @@
 # Standard
+from datetime import timedelta
 
 # Third Party
-from django.test import TestCase, TransactionTestCase
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.core import mail
+from django.core.mail import EmailMessage, EmailMultiAlternatives
+from django.core.mail.backends.base import BaseEmailBackend
+from django.utils import timezone
 
 # Local
 from books.mailviews import DonationMailView
 from books.models import Donation
-from modelmailer.mailviews import registrations
+from modelmailer.mailviews import MailView, registrations, render_messages, send_messages_batched
+from modelmailer.models import OutgoingEmail
+from modelmailer import outbox
 
 
+@override_settings(INTSYS_ASYNC_JOBS=False)
 class DonationTests(TestCase):
     # TODO: These tests depend on the books app, which is bad. Replace with User (?) test views defined here.
 
     def test_normal(self):
         don = Donation.objects.create(donator_name="Frank", donator_email="frank@example.com")
         mv = DonationMailView()
-        self.assertTrue(mv.send(don))
+        self.assertEquals(mv.send(don), MailView.SEND_QUEUED)
         self.assertEquals(len(mail.outbox), 1)
         self.assertEquals(registrations[Donation], DonationMailView)
+        self.assertEquals(OutgoingEmail.objects.get().status, OutgoingEmail.STAT_SENT)
+
+    def test_send_twice_while_pending(self):
+        don = Donation.objects.create(donator_name="Frank", donator_email="frank@example.com")
+        mv = DonationMailView()
+        with override_settings(EMAIL_BACKEND='modelmailer.tests.FailingBackend'):
+            self.assertEquals(mv.send(don), MailView.SEND_QUEUED)
+            self.assertEquals(mv.send(don), MailView.SEND_ALREADY_QUEUED)
+        self.assertEquals(OutgoingEmail.objects.count(), 1)
+
+    def test_resend_after_sent(self):
+        don = Donation.objects.create(donator_name="Frank", donator_email="frank@example.com")
+        mv = DonationMailView()
+        self.assertEquals(mv.send(don), MailView.SEND_QUEUED)
+        self.assertEquals(mv.send(don), MailView.SEND_QUEUED)
+        self.assertEquals(len(mail.outbox), 2)
 
     def test_bad_input(self):
         mv = DonationMailView()
-        self.assertFalse(mv.send(None))
+        self.assertEquals(mv.send(None), MailView.SEND_FAILED)
 
     def test_no_email_addr(self):
         don = Donation.objects.create(donator_name="Frank", donator_email="")
         mv = DonationMailView()
-        self.assertFalse(mv.send(don))
+        self.assertEquals(mv.send(don), MailView.SEND_FAILED)
+
+
+class BatchedSendTests(TestCase):
+
+    @staticmethod
+    def render(addr):
+        if addr is None:
+            raise ValueError("No address.")
+        return EmailMessage("Subject", "Body", "from@example.com", [addr])
+
+    def test_render_and_send(self):
+        addrs = ["a@example.com", None, "b@example.com", "c@example.com"]
+        messages = render_messages(self.render, addrs)
+        self.assertIsNone(messages[1])
+        results = send_messages_batched(messages, chunk_size=2)
+        self.assertEquals(results, [True, False, True, True])
+        self.assertEquals([msg.to[0] for msg in mail.outbox], ["a@example.com", "b@example.com", "c@example.com"])
+
+    def test_short_count_is_not_sent(self):
+        messages = [self.render(addr) for addr in ["a@example.com", "b@example.com", "c@example.com"]]
+        with override_settings(EMAIL_BACKEND='modelmailer.tests.ShortCountBackend'):
+            results = send_messages_batched(messages, chunk_size=2)
+        self.assertEquals(results, [False, False, True])
+
+    def test_render_in_threads(self):
+        addrs = ["x{}@example.com".format(n) for n in range(10)]
+        messages = render_messages(self.render, addrs, threads=3)
+        self.assertEquals([msg.to[0] for msg in messages], addrs)
+
+
+class FailingBackend(BaseEmailBackend):
+
+    def send_messages(self, email_messages):
+        raise ConnectionError("Provider is down.")
+
+
+class RefusingBackend(BaseEmailBackend):
+
+    def send_messages(self, email_messages):
+        return 0
+
+
+class ShortCountBackend(BaseEmailBackend):
+    """Refuses the first message of each call."""
+
+    def send_messages(self, email_messages):
+        return len(email_messages) - 1
+
+
+@override_settings(INTSYS_ASYNC_JOBS=False)
+class OutboxTests(TestCase):
+
+    def queue(self, key="key1"):
+        msg = EmailMultiAlternatives("Subject", "Text", "from@example.com", ["to@example.com"], ["bcc@example.com"])
+        msg.attach_alternative("<p>HTML</p>", "text/html")
+        email, _ = outbox.queue_message(msg, key)
+        return email
+
+    def test_sent_immediately_without_worker(self):
+        self.queue()
+        self.assertEquals(len(mail.outbox), 1)
+        sent = mail.outbox[0]
+        self.assertEquals(sent.bcc, ["bcc@example.com"])
+        self.assertEquals(sent.alternatives, [("<p>HTML</p>", "text/html")])
+
+    def test_retry_then_dead_letter(self):
+        with override_settings(EMAIL_BACKEND='modelmailer.tests.FailingBackend'):
+            email = self.queue()
+        email.refresh_from_db()
+        self.assertEquals(email.status, OutgoingEmail.STAT_PENDING)
+        self.assertEquals(email.attempts, 1)
+        self.assertGreater(email.next_attempt, timezone.now())
+
+        # Not due yet, so nothing is attempted.
+        self.assertEquals(outbox.drain_outbox(), 0)
+        self.assertEquals(len(mail.outbox), 0)
+
+        # Keep failing until it's given up on.
+        with override_settings(EMAIL_BACKEND='modelmailer.tests.FailingBackend'):
+            for _ in range(outbox.MAX_ATTEMPTS - 1):
+                OutgoingEmail.objects.filter(pk=email.pk).update(next_attempt=timezone.now() - timedelta(seconds=1))
+                outbox.drain_outbox()
+        email.refresh_from_db()
+        self.assertEquals(email.status, OutgoingEmail.STAT_DEAD)
+        self.assertEquals(email.attempts, outbox.MAX_ATTEMPTS)
+        self.assertEquals(email.last_error, "Provider is down.")
+
+    def test_retry_succeeds(self):
+        with override_settings(EMAIL_BACKEND='modelmailer.tests.FailingBackend'):
+            email = self.queue()
+        OutgoingEmail.objects.filter(pk=email.pk).update(next_attempt=timezone.now() - timedelta(seconds=1))
+        self.assertEquals(outbox.drain_outbox(), 1)
+        email.refresh_from_db()
+        self.assertEquals(email.status, OutgoingEmail.STAT_SENT)
+        self.assertEquals(len(mail.outbox), 1)
+
+    def test_refused_message_is_retried(self):
+        with override_settings(EMAIL_BACKEND='modelmailer.tests.RefusingBackend'):
+            email = self.queue()
+        email.refresh_from_db()
+        self.assertEquals(email.status, OutgoingEmail.STAT_PENDING)
+        self.assertEquals(email.attempts, 1)
+
+    def test_leased_messages_are_skipped(self):
+        with override_settings(EMAIL_BACKEND='modelmailer.tests.FailingBackend'):
+            email = self.queue()
+        OutgoingEmail.objects.filter(pk=email.pk).update(next_attempt=timezone.now() - timedelta(seconds=1))
+        self.assertEquals([e.pk for e in outbox._lease_batch(10)], [email.pk])
+        # Another drain running while the first is still sending doesn't pick it up.
+        self.assertEquals(outbox._lease_batch(10), [])
+        self.assertEquals(outbox.drain_outbox(), 0)
@@ -7,11 +7,12 @@ from django.core.management.base import BaseCommand
 from django.core.mail import EmailMultiAlternatives
 from django.template.loader import get_template
 from django.template import Context
-from django.db.models import F
+from django.db.models import F, Q, Sum
 
 # Local
-from tasks.models import Task, Claim, Nag, Worker
-from members.models import Member
+from tasks.models import Task, Claim, Nag
+from modelmailer.mailviews import render_messages, send_messages_batched
+from members.models import Member, Tagging
 
 __author__ = 'adrian'
 
@@ -33,63 +34,95 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('--host', default="https://xerocraft-django.herokuapp.com")
+        parser.add_argument('--chunk-size', type=int, default=100,
+            help="Number of emails to hand to the email backend per call.")
+        parser.add_argument('--render-threads', type=int, default=0,
+            help="Number of threads used to render emails. Zero renders them in the main thread.")
 
     @staticmethod
-    def nag_for_workers(HOST):
-        today = datetime.date.today()
-
-        # Find out who's doing what over the next 2 weeks. Who's already scheduled to work and who's heavily scheduled?
-        ppl_already_scheduled = Claim.sum_in_period(today, today+TWOWEEKS)
-        ppl_heavily_scheduled = set([member for member, dur in ppl_already_scheduled.items() if dur >= datetime.timedelta(hours=6.0)])
-
-        # Rule out the following sets:
-        ppl_excluded = set()
-        ppl_excluded |= set([worker.member for worker in Worker.objects.filter(should_nag=False)])
-        ppl_excluded |= set(Member.objects.filter(auth_user__email=""))
-        ppl_excluded |= set(Member.objects.filter(auth_user__is_active=False))
+    def plan_nags(today):
+        """
+        Determine which members should be nagged about which upcoming tasks.
+        The number of queries is fixed, regardless of the number of tasks and eligible members.
+        :return: A dict mapping each Member to a list of Tasks, in task order.
+        """
+
+        # Upcoming NAGGING tasks that are workable.
+        tasks = list(Task.objects.filter(
+            scheduled_date__gte=today, scheduled_date__lt=today+THREEDAYS,
+            should_nag=True, status=Task.STAT_ACTIVE))
+        if len(tasks) == 0: return {}
+
+        # No need to nag if task is fully claimed.
+        claimed = dict(
+            (row['claimed_task'], row['total']) for row in Claim.objects
+            .filter(claimed_task__in=tasks, status__in=[Claim.STAT_CURRENT, Claim.STAT_WORKING])
+            .values('claimed_task')
+            .annotate(total=Sum('claimed_duration'))
+        )
+        tasks = [t for t in tasks if t.max_work - claimed.get(t.pk, datetime.timedelta(0)) != datetime.timedelta(0)]
+        if len(tasks) == 0: return {}
+
+        # Eligibility by name and by tag, as (task pk, member pk) pairs.
+        potentials = set(
+            Task.eligible_claimants.through.objects.filter(task__in=tasks).values_list('task', 'member'))
+        potentials |= set(
+            Tagging.objects.filter(tag__claimable_Tasks__in=tasks).values_list('tag__claimable_Tasks', 'tagged_member'))
+
+        # Rule out people who have already claimed the task or who aren't interested in it.
+        potentials -= set(Claim.objects.filter(
+            claimed_task__in=tasks, status__in=[Claim.STAT_CURRENT, Claim.STAT_UNINTERESTED]
+        ).values_list('claimed_task', 'claiming_member'))
+
+        # Rule out people who don't want nags or who can't receive them.
+        ppl_excluded = set(Member.objects.filter(
+            Q(worker__should_nag=False) | Q(auth_user__email="") | Q(auth_user__is_active=False)
+        ).values_list('pk', flat=True))
+
+        # Find out who's doing what over the next 2 weeks. Who's heavily scheduled?
+        ppl_heavily_scheduled = Claim.heavily_scheduled(datetime.timedelta(hours=6.0), TWOWEEKS, today)
+
+        member_pks_by_task = {}
+        for task_pk, member_pk in potentials:
+            if member_pk in ppl_excluded: continue
+            member_pks_by_task.setdefault(task_pk, set()).add(member_pk)
+
+        members = Member.objects.filter(pk__in=set().union(*member_pks_by_task.values())).select_related('auth_user')
+        members = {member.pk: member for member in members}
 
-        # Cycle through future days' NAGGING tasks to see which need workers and who should be nagged.
         nag_lists = {}
-        for task in Task.objects.filter(scheduled_date__gte=today, scheduled_date__lt=today+THREEDAYS, should_nag=True):
-
-            # No need to nag if task is fully claimed or not workable.
-            if (not task.is_active()) or task.is_fully_claimed():
-                continue
-
-            potentials = task.all_eligible_claimants()
-            potentials -= task.current_claimants()
-            potentials -= task.uninterested_claimants()
-            potentials -= ppl_excluded
-
+        for task in tasks:
+            member_pks = member_pks_by_task.get(task.pk, set())
             panic_situation = task.scheduled_date == today and task.priority == Task.PRIO_HIGH
             if not panic_situation:
                 # Don't bother heavily scheduled people if it's not time to panic
-                potentials -= ppl_heavily_scheduled
+                member_pks = member_pks - ppl_heavily_scheduled
+            for member_pk in member_pks:
+                nag_lists.setdefault(members[member_pk], []).append(task)
+        return nag_lists
 
-            for member in potentials:
-                if member not in nag_lists:
-                    nag_lists[member] = []
-                nag_lists[member] += [task]
+    @staticmethod
+    def nag_for_workers(HOST, chunk_size=100, render_threads=0):
+        today = datetime.date.today()
+        nag_lists = Command.plan_nags(today)
 
-        # Send email messages:
+        nag_lists = list(nag_lists.items())
+        nags = Nag.create_in_bulk([(member, tasks, []) for member, tasks in nag_lists])
+        jobs = [(b64, member, tasks) for (_, b64), (member, tasks) in zip(nags, nag_lists)]
+
+        # Render all the email messages and then send them in batches:
         text_content_template = get_template('tasks/email_nag_template.txt')
         html_content_template = get_template('tasks/email_nag_template.html')
-        for member, tasks in nag_lists.items():
-
-            b64, md5 = Member.generate_auth_token_str(
-                lambda token: Nag.objects.filter(auth_token_md5=token).count() == 0  # uniqueness test
-            )
-
-            nag = Nag.objects.create(who=member, auth_token_md5=md5)
-            nag.tasks.add(*tasks)
+        subject = 'Call for Volunteers, ' + today.strftime('%a %b %d')
 
+        def render(job):
+            b64, member, tasks = job
             d = Context({
                 'token': b64,
                 'member': member,
                 'tasks': tasks,
                 'host': HOST,
             })
-            subject = 'Call for Volunteers, ' + datetime.date.today().strftime('%a %b %d')
             from_email = VC_EMAIL
             bcc_email = XIS_EMAIL
             to = member.email
@@ -97,7 +130,20 @@ class Command(BaseCommand):
             html_content = html_content_template.render(d)
             msg = EmailMultiAlternatives(subject, text_content, from_email, [to], [bcc_email])
             msg.attach_alternative(html_content, "text/html")
-            msg.send()
+            return msg
+
+        messages = render_messages(render, jobs, render_threads)
+        results = send_messages_batched(messages, chunk_size)
+        Command.log_unsent("Nag", [member for _, member, _ in jobs], results)
+        return results
+
+    @staticmethod
+    def log_unsent(kind, members, results):
+        """Log the members whose emails weren't sent. results is parallel to members, per send_messages_batched."""
+        logger = logging.getLogger("tasks")
+        for member, sent in zip(members, results):
+            if not sent:
+                logger.error("%s email to %s was not sent.", kind, member)
 
     @staticmethod
     def abandon_suspect_claims():
@@ -120,24 +166,22 @@ class Command(BaseCommand):
             claim.delete()
 
     @staticmethod
-    def verify_default_claims(HOST):
+    def verify_default_claims(HOST, chunk_size=100, render_threads=0):
 
         text_content_template = get_template('tasks/email-verify-claim.txt')
         html_content_template = get_template('tasks/email-verify-claim.html')
 
         today = datetime.date.today()
-        for claim in Claim.objects.filter(
+        claims = list(Claim.objects.filter(
           status = Claim.STAT_CURRENT,
           claimed_task__scheduled_date__range=[today+THREEDAYS, today+FOURDAYS],
           claiming_member=F('claimed_task__recurring_task_template__default_claimant'),
-          date_verified__isnull=True):
-            b64, md5 = Member.generate_auth_token_str(
-                lambda token: Nag.objects.filter(auth_token_md5=token).count() == 0)  # uniqueness test
-
-            nag = Nag.objects.create(who=claim.claiming_member, auth_token_md5=md5)
-            nag.claims.add(claim)
-            nag.tasks.add(claim.claimed_task)
+          date_verified__isnull=True).select_related('claimed_task', 'claiming_member__auth_user'))
+        nags = Nag.create_in_bulk([(claim.claiming_member, [claim.claimed_task], [claim]) for claim in claims])
+        jobs = [(b64, claim) for (_, b64), claim in zip(nags, claims)]
 
+        def render(job):
+            b64, claim = job
             dow = claim.claimed_task.scheduled_weekday()
 
             d = Context({
@@ -149,7 +193,6 @@ class Command(BaseCommand):
                 'host': HOST,
             })
 
-            # Send email messages:
             subject = 'Please verify your availability for this {}'.format(dow)
             from_email = VC_EMAIL
             bcc_email = XIS_EMAIL
@@ -158,13 +201,25 @@ class Command(BaseCommand):
             html_content = html_content_template.render(d)
             msg = EmailMultiAlternatives(subject, text_content, from_email, [to], [bcc_email])
             msg.attach_alternative(html_content, "text/html")
-            msg.send()
+            return msg
+
+        # Send email messages:
+        messages = render_messages(render, jobs, render_threads)
+        results = send_messages_batched(messages, chunk_size)
+        Command.log_unsent("Claim verification", [claim.claiming_member for _, claim in jobs], results)
+        return results
 
     def handle(self, *args, **options):
 
         HOST = options['host']
+        chunk_size = options['chunk_size']
+        render_threads = options['render_threads']
 
         # Order is significant!
         self.abandon_suspect_claims()
-        self.verify_default_claims(HOST)
-        self.nag_for_workers(HOST)
+        for kind, results in [
+          ("claim verification", self.verify_default_claims(HOST, chunk_size, render_threads)),
+          ("nag", self.nag_for_workers(HOST, chunk_size, render_threads))]:
+            self.stdout.write("Sent {} of {} {} email(s).".format(sum(results), len(results), kind))
+            if not all(results):
+                self.stderr.write("{} {} email(s) were not sent.".format(results.count(False), kind))
@@ -1,8 +1,44 @@
 __author__ = 'adrian'
 
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.db.models import F, Min
 from tasks.models import RecurringTaskTemplate, Task
+from multiprocessing import Pool
 import datetime
+import logging
+import time
+
+
+def create_tasks_for_template(template_pk, num_days):
+    """Create the template's new tasks while holding a lock on its row.
+    Locking serializes workers (and overlapping cron runs) that pick up the same template, and the
+    template's state is re-read under the lock, so the second one sees what the first one created.
+    Returns (template_pk, template description, number of tasks created, elapsed seconds).
+    """
+    started = time.time()
+    with transaction.atomic():
+        template = RecurringTaskTemplate.objects.select_for_update().get(pk=template_pk)
+        created = template.create_tasks(num_days)
+    return template_pk, str(template), created, time.time() - started
+
+
+def _create_tasks_or_report(template_pk, num_days):
+    """Like create_tasks_for_template, but a failure is logged and returned instead of stopping the other templates.
+    Returns (timing, None) on success, else (None, (template_pk, error message)).
+    """
+    try:
+        return create_tasks_for_template(template_pk, num_days), None
+    except Exception as e:
+        logging.getLogger("tasks").error("Couldn't create tasks for template %s because %s", template_pk, str(e))
+        return None, (template_pk, str(e))
+
+
+def _pool_worker(args):
+    try:
+        return _create_tasks_or_report(*args)
+    finally:
+        connections.close_all()  # Each worker process has its own connection.
 
 
 class Command(BaseCommand):
@@ -10,35 +46,89 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('num_days', type=int)
+        parser.add_argument('--workers', type=int, default=1,
+            help="Number of processes to spread the templates across.")
 
     @staticmethod
-    def add_new_tasks(num_days):
-        for template in RecurringTaskTemplate.objects.filter(active=True):
-            template.create_tasks(num_days)
+    def add_new_tasks(num_days, workers=1):
+        """Returns (timings, failures) where timings is a list of
+        (template_pk, template description, tasks created, elapsed seconds) and failures is a list of
+        (template_pk, error message) for templates whose tasks couldn't be created.
+        """
+        template_pks = RecurringTaskTemplate.objects.filter(active=True).values_list('pk', flat=True)
+        work = [(pk, num_days) for pk in template_pks]
+        if workers <= 1:
+            results = [_create_tasks_or_report(*args) for args in work]
+        else:
+            connections.close_all()  # Forked processes mustn't share the parent's connection.
+            pool = Pool(workers)
+            try:
+                results = pool.map(_pool_worker, work, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        timings = [timing for timing, _ in results if timing is not None]
+        failures = [failure for _, failure in results if failure is not None]
+        return timings, failures
 
     @staticmethod
     def reschedule_missed_dates():
+        """Slide the active instances of templates whose earliest active instance is in the past.
+        Returns (number of templates slid, number of tasks slid).
+        """
+        logger = logging.getLogger("tasks")
         today = datetime.date.today()
-        for template in RecurringTaskTemplate.objects.all():
-            tasks = template.instances.filter(
-                status=Task.STAT_ACTIVE,
-                scheduled_date__isnull=False
-            ).order_by('scheduled_date')
+        active_dated = Task.objects.filter(
+            recurring_task_template__isnull=False,
+            status=Task.STAT_ACTIVE,
+            scheduled_date__isnull=False,
+        )
 
-            if len(tasks) == 0: continue
-            t0 = tasks[0]
-            if t0.scheduled_date >= today: continue
+        # Templates whose earliest active instance has slipped into the past, with that earliest date.
+        earliest_qs = active_dated\
+            .values('recurring_task_template')\
+            .annotate(earliest=Min('scheduled_date'))\
+            .filter(earliest__lt=today)
+        earliest = {row['recurring_task_template']: row['earliest'] for row in earliest_qs}
+        if len(earliest) == 0: return 0, 0
 
-            if t0.missed_date_action == Task.MDA_SLIDE_SELF_AND_LATER:
-                slide_delta = today - t0.scheduled_date
-                for task in tasks:
-                    task.scheduled_date += slide_delta
-                    task.save()
+        # The earliest instance's missed_date_action decides what happens to the template's instances.
+        actions = {}
+        past_tasks = active_dated.filter(
+            recurring_task_template__in=earliest.keys(),
+            scheduled_date__lt=today,
+        ).order_by('recurring_task_template', 'scheduled_date', 'pk')
+        for template_pk, action in past_tasks.values_list('recurring_task_template', 'missed_date_action'):
+            actions.setdefault(template_pk, action)
 
-            if t0.missed_date_action == Task.MDA_IGNORE:
-                pass  # No action required
+        template_count, task_count = 0, 0
+        for template_pk, earliest_date in earliest.items():
+            if actions.get(template_pk) != Task.MDA_SLIDE_SELF_AND_LATER: continue  # E.g. MDA_IGNORE
+            slide_delta = today - earliest_date
+            try:
+                with transaction.atomic():
+                    slid = active_dated.filter(recurring_task_template_id=template_pk)\
+                        .update(scheduled_date=F('scheduled_date') + slide_delta)
+            except Exception as e:
+                logger.error("Couldn't slide instances of template %s because %s", template_pk, str(e))
+                continue
+            logger.info("Slid %d instance(s) of template %s forward by %d day(s).",
+                slid, template_pk, slide_delta.days)
+            template_count += 1
+            task_count += slid
+        if task_count > 0:
+            Task.forget_open_tasks_snapshot()  # UPDATE doesn't send signals.
+        return template_count, task_count
 
     def handle(self, *args, **options):
-        Command.reschedule_missed_dates()
-        Command.add_new_tasks(options['num_days'])
-
+        if options['workers'] < 1:
+            raise CommandError("--workers must be at least 1.")
+        template_count, task_count = Command.reschedule_missed_dates()
+        self.stdout.write("Rescheduled %d task(s) from %d template(s)." % (task_count, template_count))
+        timings, failures = Command.add_new_tasks(options['num_days'], options['workers'])
+        timings.sort(key=lambda timing: timing[3], reverse=True)
+        for pk, desc, created, elapsed in timings:
+            self.stdout.write("%8.3fs %4d task(s) created for template %d, %s" % (elapsed, created, pk, desc))
+        self.stdout.write("Created %d task(s)." % sum(timing[2] for timing in timings))
+        for pk, error in failures:
+            self.stderr.write("Couldn't create tasks for template %d: %s" % (pk, error))
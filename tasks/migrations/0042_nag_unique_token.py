@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tasks', '0041_auto_20160912_1733'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='nag',
+            name='auth_token_md5',
+            field=models.CharField(max_length=32, unique=True, help_text="MD5 checksum of the random urlsafe base64 string used in the nagging email's URLs."),
+        ),
+    ]
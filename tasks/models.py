@@ -4,10 +4,13 @@ import logging
 import abc
 from decimal import Decimal
 from datetime import date, timedelta, datetime
+import hashlib
 import re
 
 # Third party
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Max, Q, Sum
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.core.validators import RegexValidator
 from django.utils.translation import ugettext_lazy as _
@@ -15,6 +18,7 @@ import nptime
 
 # Local
 from members import models as mm
+from tasks import recurrence
 
 
 class TimeWindowedObject(object):
@@ -216,14 +220,32 @@ class RecurringTaskTemplate(make_TaskMixin("TaskTemplates")):
     def greatest_scheduled_date(self):
         "Of the Tasks that correspond to this template, returns the greatest scheduled_date."
 
-        if len(self.instances.all()) == 0:
+        result = self.instances.aggregate(Max('scheduled_date'))['scheduled_date__max']
+        if result is None:
             # Nothing is scheduled yet but nothing can be scheduled before start_date.
             # So, pretend that day before start_date is the greatest scheduled date.
             result = self.start_date + timedelta(days = -1)
-            return result
+        return result
+
+    def recurrence_rule(self, last_date: date=None):
+        """Compile the template's schedule into a rule object that can generate occurrences(start, end).
+        For interval schedules, last_date is the anchor and defaults to greatest_scheduled_date().
+        Returns None if the template doesn't specify a schedule.
+        """
+
+        if self.repeats_at_intervals():
+            if last_date is None: last_date = self.greatest_scheduled_date()
+            return recurrence.IntervalRule(self.repeat_interval, last_date)
+
+        if self.repeats_on_certain_days():
+            return recurrence.compile_certain_days(
+                [self.monday, self.tuesday, self.wednesday, self.thursday, self.friday, self.saturday, self.sunday],
+                [self.first, self.second, self.third, self.fourth, self.last, self.every],
+                [self.jan, self.feb, self.mar, self.apr, self.may, self.jun,
+                 self.jul, self.aug, self.sep, self.oct, self.nov, self.dec],
+            )
 
-        scheduled_dates = map(lambda x: x.scheduled_date, self.instances.all())
-        return max(scheduled_dates)
+        return None
 
     def date_matches_template(self, d: date):
 
@@ -234,61 +256,10 @@ class RecurringTaskTemplate(make_TaskMixin("TaskTemplates")):
             return self.date_matches_template_certain_days(d)
 
     def date_matches_template_intervals(self, date_considered: date):
-        last_date = self.greatest_scheduled_date()
-        days_since = date_considered - last_date
-        return days_since.days >= self.repeat_interval # >= instead of == b/c of a bootstrapping scenario.
+        return self.recurrence_rule().matches(date_considered)
 
     def date_matches_template_certain_days(self, d: date):
-
-        def nth_xday(d):
-            """ Return a value which indicates that date d is the nth <x>day of the month. """
-            dom_num = d.day
-            ord_num = 1
-            while dom_num > 7:
-                dom_num -= 7
-                ord_num += 1
-            return ord_num
-
-        def is_last_xday(d):
-            """ Return a value which indicates whether date d is the LAST <x>day of the month. """
-            month = d.month
-            d += timedelta(weeks = +1)
-            return True if d.month > month else False
-
-        month_matches = (d.month==1 and self.jan) \
-            or (d.month==2 and self.feb) \
-            or (d.month==3 and self.mar) \
-            or (d.month==4 and self.apr) \
-            or (d.month==5 and self.may) \
-            or (d.month==6 and self.jun) \
-            or (d.month==7 and self.jul) \
-            or (d.month==8 and self.aug) \
-            or (d.month==9 and self.sep) \
-            or (d.month==10 and self.oct) \
-            or (d.month==11 and self.nov) \
-            or (d.month==12 and self.dec)
-        if not month_matches: return False
-
-        dow_num = d.weekday() # day-of-week number
-        day_matches = (dow_num==0 and self.monday) \
-            or (dow_num==1 and self.tuesday) \
-            or (dow_num==2 and self.wednesday) \
-            or (dow_num==3 and self.thursday) \
-            or (dow_num==4 and self.friday) \
-            or (dow_num==5 and self.saturday) \
-            or (dow_num==6 and self.sunday)
-        if not day_matches: return False  # Doesn't match template if day-of-week doesn't match.
-        if self.every: return True  # Does match if it happens every week and the day-of-week matches.
-        if is_last_xday(d) and self.last: return True # Check for last <x>day match.
-
-        # Otherwise, figure out the ordinal and see if we match it.
-        ord_num = nth_xday(d)
-        ordinal_matches = (ord_num==1 and self.first) \
-            or (ord_num==2 and self.second) \
-            or (ord_num==3 and self.third) \
-            or (ord_num==4 and self.fourth)
-
-        return ordinal_matches
+        return self.recurrence_rule().matches(d)
 
     def is_dow_chosen(self):
         return self.monday    \
@@ -327,60 +298,92 @@ class RecurringTaskTemplate(make_TaskMixin("TaskTemplates")):
     def repeats_at_intervals(self):
         return self.repeat_interval is not None
 
+    def new_instance(self, sched_date: date, instructions: str) -> 'Task':
+        """Returns an unsaved Task for the given date with mixin fields copied from the template.
+        Instructions are passed in so that callers creating many instances only expand snippets once.
+        """
+        return Task(
+            recurring_task_template =self,
+            creation_date           =date.today(),
+            scheduled_date          =sched_date,
+            orig_sched_date         =sched_date,
+            # Copy mixin fields from template to instance:
+            owner                   =self.owner,
+            instructions            =instructions,
+            short_desc              =self.short_desc,
+            reviewer                =self.reviewer,
+            missed_date_action      =self.missed_date_action,
+            max_work                =self.max_work,
+            max_workers             =self.max_workers,
+            work_start_time         =self.work_start_time,
+            work_duration           =self.work_duration,
+            should_nag              =self.should_nag,
+            priority                =self.priority,
+        )
+
     def create_tasks(self, max_days_in_advance):
         """Creates/schedules new tasks from today or day after GSD (inclusive).
         Stops when scheduling a new task would be more than max_days_in_advance from current date.
         Does not create/schedule a task on date D if one already exists for date D.
         Does nothing if the template is not active.
+        All of the template's new tasks, their many-to-many rows, and their default claims are
+        written in bulk inside a single transaction. If anything fails, nothing is created for this template
+        and the exception is raised for the caller to report.
+        Returns the number of tasks created.
         """
 
-        if not self.active: return
+        if not self.active: return 0
 
         # Earliest possible date to schedule is "day after GSD" or "today", whichever is later.
-        # Note that curr gets inc'ed at start of while, so we need "GSD" and "yesterday" here.
         gsd = self.greatest_scheduled_date()  # TODO: This should work with orig_sched_date, not scheduled_date
         yesterday = date.today()+timedelta(days=-1)
-        curr = max(gsd, yesterday)
+        start = max(gsd, yesterday) + timedelta(days=+1)
         stop = date.today() + timedelta(days=max_days_in_advance)
+        rule = self.recurrence_rule(last_date=gsd)
+        if rule is None: return 0
+
         logger = logging.getLogger("tasks")
-        while curr < stop:
-            curr += timedelta(days=+1)
-            if self.date_matches_template(curr):
-
-                # If task creation fails, log it and carry on.
-                try:
-                    t = None
-                    t = Task.objects.create(
-                        recurring_task_template =self,
-                        creation_date           =date.today(),
-                        scheduled_date          =curr,
-                        orig_sched_date         =curr,
-                        # Copy mixin fields from template to instance:
-                        owner                   =self.owner,
-                        instructions            =Snippet.expand(self.instructions),
-                        short_desc              =self.short_desc,
-                        reviewer                =self.reviewer,
-                        missed_date_action      =self.missed_date_action,
-                        max_work                =self.max_work,
-                        max_workers             =self.max_workers,
-                        work_start_time         =self.work_start_time,
-                        work_duration           =self.work_duration,
-                        should_nag              =self.should_nag,
-                        priority                =self.priority,
-                    )
-
-                    # Many-to-many fields:
-                    t.eligible_claimants =self.eligible_claimants.all()
-                    t.eligible_tags      =self.eligible_tags.all()
-
-                    if self.default_claimant is not None:
-                        t.create_default_claim()
-
-                    logger.info("Created %s on %s", self.short_desc, curr)
-
-                except Exception as e:
-                    logger.error("Couldn't create %s on %s because %s", self.short_desc, curr, str(e))
-                    if t is not None: t.delete()
+        sched_dates = list(rule.occurrences(start, stop))
+
+        # Tasks from other templates might already occupy some dates, per Task's unique_together.
+        if len(sched_dates) > 0 and self.work_start_time is not None:
+            occupied = set(Task.objects.filter(
+                scheduled_date__in=sched_dates,
+                short_desc=self.short_desc,
+                work_start_time=self.work_start_time,
+            ).values_list('scheduled_date', flat=True))
+            for d in sorted(occupied):
+                logger.error("Couldn't create %s on %s because a task with the same description and time exists.",
+                    self.short_desc, d)
+            sched_dates = [d for d in sched_dates if d not in occupied]
+
+        if len(sched_dates) == 0: return 0
+
+        with transaction.atomic():
+            instructions = Snippet.expand(self.instructions)
+            Task.objects.bulk_create([self.new_instance(d, instructions) for d in sched_dates])
+
+            # bulk_create doesn't provide pks, but every task on these dates is new since they're all after GSD.
+            tasks = list(Task.objects.filter(recurring_task_template=self, scheduled_date__in=sched_dates))
+            for t in tasks: t.recurring_task_template = self  # Avoids a query per task, below.
+
+            # Many-to-many fields:
+            claimant_pks = list(self.eligible_claimants.values_list('pk', flat=True))
+            tag_pks = list(self.eligible_tags.values_list('pk', flat=True))
+            EligibleClaimant = Task.eligible_claimants.through
+            EligibleClaimant.objects.bulk_create(
+                [EligibleClaimant(task_id=t.pk, member_id=pk) for t in tasks for pk in claimant_pks])
+            EligibleTag = Task.eligible_tags.through
+            EligibleTag.objects.bulk_create(
+                [EligibleTag(task_id=t.pk, tag_id=pk) for t in tasks for pk in tag_pks])
+
+            if self.default_claimant is not None:
+                Claim.objects.bulk_create([t.new_default_claim() for t in tasks])
+
+        Task.forget_open_tasks_snapshot()
+        for d in sched_dates:
+            logger.info("Created %s on %s", self.short_desc, d)
+        return len(sched_dates)
 
     def recurrence_str(self):
         days_of_week = self.repeats_on_certain_days()
@@ -476,17 +479,43 @@ class Claim(models.Model, TimeWindowedObject):
         if False:  # TODO: Finish this check
             raise ValidationError(_("Task has a time window so claim must have a start time."))
 
+    @staticmethod
+    def claimed_durations(start_date=None, end_date=None, statuses=(STAT_CURRENT,)):
+        """
+        Sum up durations claimed per claimant with a single aggregate query.
+        :param start_date: If given, only count claims on tasks scheduled on or after this date.
+        :param end_date: If given, only count claims on tasks scheduled on or before this date.
+        :param statuses: Only count claims having one of these statuses. None counts all claims.
+        :return: A dict mapping member pks to timedeltas.
+        """
+        claims = Claim.objects.all()
+        if statuses is not None:
+            claims = claims.filter(status__in=statuses)
+        if start_date is not None:
+            claims = claims.filter(claimed_task__scheduled_date__gte=start_date)
+        if end_date is not None:
+            claims = claims.filter(claimed_task__scheduled_date__lte=end_date)
+        totals = claims.values('claiming_member').annotate(total=Sum('claimed_duration'))
+        return {row['claiming_member']: row['total'] for row in totals}
+
+    @staticmethod
+    def heavily_scheduled(threshold: timedelta, window: timedelta, start: date=None):
+        """
+        Determine who has current claims totalling at least threshold on tasks scheduled in the window.
+        :param start: The first day of the window, default today. The window's last day is start+window.
+        :return: A set of member pks.
+        """
+        if start is None:
+            start = date.today()
+        totals = Claim.claimed_durations(start, start+window)
+        return set(member_pk for member_pk, total in totals.items() if total >= threshold)
+
     @staticmethod
     def sum_in_period(startDate, endDate):
         """ Sum up hours claimed per claimant during period startDate to endDate, inclusive. """
-        claimants = {}
-        for task in Task.objects.filter(scheduled_date__gte=startDate).filter(scheduled_date__lte=endDate):
-            for claim in task.claim_set.all():
-                if claim.status == claim.STAT_CURRENT:
-                    if claim.claiming_member not in claimants:
-                        claimants[claim.claiming_member] = timedelta(0)
-                    claimants[claim.claiming_member] += claim.claimed_duration
-        return claimants
+        totals = Claim.claimed_durations(startDate, endDate)
+        members = mm.Member.objects.in_bulk(list(totals.keys()))
+        return {members[member_pk]: total for member_pk, total in totals.items()}
 
     # Implementation of TimeWindowedObject abstract methods:
     def window_start_time(self): return self.claimed_start_time
@@ -535,8 +564,19 @@ class Work(models.Model):
         verbose_name_plural = "Work"
 
 
+class TaskQuerySet(models.QuerySet):
+
+    def eligible_for(self, member):
+        """The tasks that member may claim, either directly by name or indirectly by tag."""
+        by_name = Task.eligible_claimants.through.objects.filter(member=member).values('task')
+        by_tag = Task.eligible_tags.through.objects.filter(tag__members=member).values('task')
+        return self.filter(Q(pk__in=by_name) | Q(pk__in=by_tag))
+
+
 class Task(make_TaskMixin("Tasks"), TimeWindowedObject):
 
+    objects = TaskQuerySet.as_manager()
+
     creation_date = models.DateField(null=False, default=date.today,
         help_text="The date on which this task was created in the database.")
 
@@ -623,16 +663,68 @@ class Task(make_TaskMixin("Tasks"), TimeWindowedObject):
     def all_claims_verified(self):
         return all(claim.date_verified is not None for claim in self.claim_set.all())
 
+    # Kiosk arrival screens need today's and undated open tasks, with their eligibility and claim status.
+    # That's assembled once, cached, and forgotten whenever tasks, claims, eligibility or tags change.
+    # Forgetting only reaches the process that made the change unless the cache is shared between processes,
+    # so the snapshot also expires after a couple of minutes.
+    SNAPSHOT_VERSION_CACHE_KEY = "tasks.open-tasks-snapshot.version"
+    SNAPSHOT_CACHE_TIMEOUT = 2*60
+
+    @staticmethod
+    def forget_open_tasks_snapshot():
+        try:
+            cache.incr(Task.SNAPSHOT_VERSION_CACHE_KEY)
+        except ValueError:  # Key isn't in the cache, yet.
+            cache.set(Task.SNAPSHOT_VERSION_CACHE_KEY, 1, None)
+
+    @staticmethod
+    def open_tasks_snapshot() -> list:
+        """
+        Today's active tasks followed by active tasks with no scheduled date, using a fixed number of queries.
+        :return: A list of (task, eligible member pks, eligible tag names, has claims) tuples.
+        """
+        today = date.today()
+        cache_key = "tasks.open-tasks-snapshot.%s.%s" % (
+            cache.get(Task.SNAPSHOT_VERSION_CACHE_KEY, 0), today.isoformat())
+        snapshot = cache.get(cache_key)
+        if snapshot is None:
+            tasks = list(Task.objects.filter(status=Task.STAT_ACTIVE)
+                .filter(Q(scheduled_date=today) | Q(scheduled_date__isnull=True)))
+            tasks.sort(key=lambda t: t.scheduled_date is None)
+            claimed = set(Claim.objects.filter(claimed_task__in=tasks).values_list('claimed_task', flat=True))
+            member_pks, tag_names = {}, {}
+            for task_pk, member_pk in Task.eligible_claimants.through.objects \
+                    .filter(task__in=tasks).values_list('task', 'member'):
+                member_pks.setdefault(task_pk, set()).add(member_pk)
+            for task_pk, tag_name in Task.eligible_tags.through.objects \
+                    .filter(task__in=tasks).values_list('task', 'tag__name'):
+                tag_names.setdefault(task_pk, set()).add(tag_name)
+            snapshot = [
+                (t, frozenset(member_pks.get(t.pk, ())), frozenset(tag_names.get(t.pk, ())), t.pk in claimed)
+                for t in tasks
+            ]
+            cache.set(cache_key, snapshot, Task.SNAPSHOT_CACHE_TIMEOUT)
+        return snapshot
+
+    def eligible_members(self):
+        """
+        Determine all eligible claimants whether they're directly eligible by name or indirectly by tag
+        :return: A queryset of Members
+        """
+        by_name = Task.eligible_claimants.through.objects.filter(task=self).values('member')
+        by_tag = mm.Tagging.objects.filter(tag__claimable_Tasks=self).values('tagged_member')
+        return mm.Member.objects.filter(Q(pk__in=by_name) | Q(pk__in=by_tag))
+
+    def is_eligible(self, member) -> bool:
+        """Determine whether member may claim this task, using a single query."""
+        return Task.objects.eligible_for(member).filter(pk=self.pk).exists()
+
     def all_eligible_claimants(self):
         """
         Determine all eligible claimants whether they're directly eligible by name or indirectly by tag
         :return: A set of Members
         """
-        result = set()
-        result |= set(list(self.eligible_claimants.all()))
-        for tag in self.eligible_tags.all():
-            result |= set(list(tag.members.all()))
-        return result
+        return set(self.eligible_members())
 
     def current_claimants(self):
         """
@@ -656,15 +748,15 @@ class Task(make_TaskMixin("Tasks"), TimeWindowedObject):
                 result |= set([claim.claiming_member])
         return result
 
-    def create_default_claim(self):
-        '''Create a claim assuming that other task info has already been initialized.'''
+    def new_default_claim(self):
+        '''Return an unsaved claim for the template's default claimant, assuming that other task info has already been initialized.'''
         duration = self.work_duration
         if duration is None:
             if self.max_workers != 1:
                 raise RuntimeError("Not yet coded to deal with multiple workers.")
             else:
                 duration = self.max_work
-        Claim.objects.create(
+        return Claim(
             claiming_member=self.recurring_task_template.default_claimant,
             status=Claim.STAT_CURRENT,
             claimed_task=self,
@@ -672,6 +764,12 @@ class Task(make_TaskMixin("Tasks"), TimeWindowedObject):
             claimed_duration=duration
         )
 
+    def create_default_claim(self):
+        '''Create a claim assuming that other task info has already been initialized.'''
+        claim = self.new_default_claim()
+        claim.save()
+        return claim
+
     def all_future_instances(self):
         """Find other instances of the same template which are scheduled later than this instance."""
         all_future_instances = Task.objects.filter(
@@ -797,9 +895,32 @@ class Nag(models.Model):
         help_text = "The member who was nagged.")
 
     # Saving as MD5 provides some protection against read-only attacks.
-    auth_token_md5 = models.CharField(max_length=32, null=False, blank=False,
+    auth_token_md5 = models.CharField(max_length=32, null=False, blank=False, unique=True,
         help_text="MD5 checksum of the random urlsafe base64 string used in the nagging email's URLs.")
 
+    @staticmethod
+    def create_in_bulk(specs):
+        """
+        Create many nags with a fixed number of queries.
+        :param specs: A sequence of (member, tasks, claims) tuples, one per nag to create.
+        :return: A list of (nag, auth token) tuples, parallel to specs.
+        """
+        if len(specs) == 0: return []
+        tokens = mm.Member.generate_auth_token_strs(len(specs),
+            lambda md5s: Nag.objects.filter(auth_token_md5__in=md5s).values_list('auth_token_md5', flat=True))
+        Nag.objects.bulk_create([Nag(who=who, auth_token_md5=md5) for (who, _, _), (_, md5) in zip(specs, tokens)])
+
+        # bulk_create doesn't set pks, so fetch the new nags by their unique tokens.
+        nags = {nag.auth_token_md5: nag for nag in Nag.objects.filter(auth_token_md5__in=[md5 for _, md5 in tokens])}
+        task_rows, claim_rows = [], []
+        for (_, tasks, claims), (_, md5) in zip(specs, tokens):
+            nag_pk = nags[md5].pk
+            task_rows += [Nag.tasks.through(nag_id=nag_pk, task_id=task.pk) for task in tasks]
+            claim_rows += [Nag.claims.through(nag_id=nag_pk, claim_id=claim.pk) for claim in claims]
+        Nag.tasks.through.objects.bulk_create(task_rows)
+        Nag.claims.through.objects.bulk_create(claim_rows)
+        return [(nags[md5], b64) for b64, md5 in tokens]
+
     def __str__(self):
         return "%s %s, %ld tasks, %s" % (
             self.who.first_name,
@@ -833,8 +954,8 @@ class Worker(models.Model):
         "Creates a calendar token if none exists, else does nothing."
         if self.calendar_token is None or len(self.calendar_token) == 0:
             # I'm arbitrarily choosing md5str, below, but the fact that it came from md5 doesn't matter.
-            _, md5str = mm.Member.generate_auth_token_str(
-                lambda t: Worker.objects.filter(calendar_token=t).count() == 0  # uniqueness test
+            [(_, md5str)] = mm.Member.generate_auth_token_strs(1,
+                lambda md5s: Worker.objects.filter(calendar_token__in=md5s).values_list('calendar_token', flat=True)
             )
             self.calendar_token = md5str
             self.save()
@@ -916,19 +1037,69 @@ class Snippet(models.Model):
     text = models.TextField(max_length=2048, blank=False,
         help_text="The full text content of the snippet.")
 
+    # Expansions are cached under the current snippet version, which is bumped whenever a snippet changes.
+    # The timeout bounds staleness in processes that didn't see the change (the cache may be per-process).
+    VERSION_CACHE_KEY = "tasks.snippet.version"
+    EXPANSION_CACHE_TIMEOUT = 10*60
+
+    @staticmethod
+    def invalidate_expansions():
+        try:
+            cache.incr(Snippet.VERSION_CACHE_KEY)
+        except ValueError:  # Key isn't in the cache, yet.
+            cache.set(Snippet.VERSION_CACHE_KEY, 1, None)
+
     @staticmethod
     def expand(instr: str) -> str:
-        while True:
-            searchresult = re.search(Snippet.snippet_ref_regex, instr, flags=0)
-            if searchresult is None:
-                return instr
-            snippet_ref = searchresult.group()
-            snippet_name = snippet_ref.strip("{}")
-            try:
-                snippet = Snippet.objects.get(name=snippet_name)
-                instr = instr.replace(snippet_ref, snippet.text)
-            except Snippet.DoesNotExist:
-                logger = logging.getLogger("tasks")
-                logger.warning("%s is a bad snippet reference.", snippet_ref)
-                instr = instr.replace(snippet_ref, Snippet.BAD_SNIPPET_REF_STR)
+        """Replace each {{name}} reference in instr with the named snippet's text, recursively."""
+        if instr is None or "{{" not in instr:
+            return instr
+        version = cache.get(Snippet.VERSION_CACHE_KEY, 0)
+        key = "tasks.snippet.expansion.%s.%s" % (version, hashlib.md5(instr.encode()).hexdigest())
+        result = cache.get(key)
+        if result is None:
+            result = _SnippetResolver().expand(instr)
+            cache.set(key, result, Snippet.EXPANSION_CACHE_TIMEOUT)
+        return result
+
+
+class _SnippetResolver(object):
+    """Expands snippet references in a single pass, using one query per level of nesting."""
+
+    ref_regex = re.compile(Snippet.snippet_ref_regex)
+
+    def __init__(self):
+        self.texts = {}  # Snippet name -> text, or None if there's no such snippet.
+
+    def _names_in(self, text: str):
+        return {ref.strip("{}") for ref in self.ref_regex.findall(text)}
+
+    def _load(self, names):
+        while names:
+            found = dict(Snippet.objects.filter(name__in=names).values_list('name', 'text'))
+            for name in names:
+                self.texts[name] = found.get(name)
+            nested = set()
+            for text in found.values():
+                nested |= self._names_in(text)
+            names = nested - self.texts.keys()
+
+    def _expand_text(self, text: str, active) -> str:
+        return self.ref_regex.sub(lambda match: self._expand_ref(match.group(), active), text)
+
+    def _expand_ref(self, snippet_ref: str, active) -> str:
+        logger = logging.getLogger("tasks")
+        name = snippet_ref.strip("{}")
+        text = self.texts.get(name)
+        if text is None:
+            logger.warning("%s is a bad snippet reference.", snippet_ref)
+            return Snippet.BAD_SNIPPET_REF_STR
+        if name in active:
+            logger.warning("%s is a circular snippet reference.", snippet_ref)
+            return Snippet.BAD_SNIPPET_REF_STR
+        return self._expand_text(text, active | {name})
+
+    def expand(self, instr: str) -> str:
+        self._load(self._names_in(instr))
+        return self._expand_text(instr, frozenset())
 
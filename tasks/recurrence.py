@@ -0,0 +1,118 @@
+
+# Standard
+from datetime import date, timedelta
+from calendar import monthrange
+from typing import Iterator
+
+# Third party
+
+# Local
+
+# Bit positions for the ordinal mask. Weekday bits are date.weekday() values (Monday=0)
+# and month bits are date.month values (January=1).
+ORD_FIRST  = 1 << 1
+ORD_SECOND = 1 << 2
+ORD_THIRD  = 1 << 3
+ORD_FOURTH = 1 << 4
+ORD_LAST   = 1 << 5
+ORD_EVERY  = 1 << 6
+
+
+def _mask(*bits) -> int:
+    result = 0
+    for bit in bits:
+        result |= bit
+    return result
+
+
+class CertainDaysRule(object):
+    """Compiled form of a 'day-of-week vs nth-of-month' schedule, e.g. "every first and third Thursday".
+    Matching dates are computed month by month instead of testing every day in a range.
+    """
+
+    def __init__(self, weekdays: int, ordinals: int, months: int):
+        self.weekdays = weekdays  # Bit n is set if date.weekday()==n matches.
+        self.ordinals = ordinals  # Combination of the ORD_* bits.
+        self.months = months      # Bit n is set if date.month==n matches.
+
+    def is_empty(self) -> bool:
+        return self.weekdays == 0 or self.ordinals == 0 or self.months == 0
+
+    def matches(self, d: date) -> bool:
+        if not self.months & (1 << d.month): return False
+        if not self.weekdays & (1 << d.weekday()): return False
+        if self.ordinals & ORD_EVERY: return True
+        _, days_in_month = monthrange(d.year, d.month)
+        if self.ordinals & ORD_LAST and d.day + 7 > days_in_month: return True
+        ord_num = (d.day - 1) // 7 + 1
+        return bool(ord_num <= 4 and self.ordinals & (1 << ord_num))
+
+    def _dates_in_month(self, year: int, month: int) -> Iterator[date]:
+        first_dow, days_in_month = monthrange(year, month)
+        days = set()
+        for dow in range(7):
+            if not self.weekdays & (1 << dow): continue
+            first_day = 1 + (dow - first_dow) % 7  # Day of month of the first <x>day.
+            all_days = range(first_day, days_in_month+1, 7)
+            if self.ordinals & ORD_EVERY:
+                days.update(all_days)
+                continue
+            for ord_num, day in enumerate(all_days, start=1):
+                if ord_num <= 4 and self.ordinals & (1 << ord_num):
+                    days.add(day)
+            if self.ordinals & ORD_LAST:
+                days.add(all_days[-1])
+        for day in sorted(days):
+            yield date(year, month, day)
+
+    def occurrences(self, start: date, end: date) -> Iterator[date]:
+        """Generate the matching dates from start to end, inclusive, in ascending order."""
+        if self.is_empty(): return
+        year, month = start.year, start.month
+        while date(year, month, 1) <= end:
+            if self.months & (1 << month):
+                for d in self._dates_in_month(year, month):
+                    if start <= d <= end:
+                        yield d
+            month += 1
+            if month > 12:
+                year, month = year+1, 1
+
+
+class IntervalRule(object):
+    """Compiled form of an 'every X days' schedule.
+    The anchor is the most recently scheduled date. The next occurrence is 'interval' days after the anchor,
+    or the start of the range if that has already passed, and occurrences repeat every 'interval' days from there.
+    """
+
+    def __init__(self, interval: int, anchor: date):
+        self.interval = timedelta(days=interval)
+        self.anchor = anchor
+
+    def is_empty(self) -> bool:
+        return self.interval <= timedelta(0)
+
+    def matches(self, d: date) -> bool:
+        return d - self.anchor >= self.interval
+
+    def occurrences(self, start: date, end: date) -> Iterator[date]:
+        """Generate the matching dates from start to end, inclusive, in ascending order."""
+        if self.is_empty(): return
+        curr = max(self.anchor + self.interval, start)
+        while curr <= end:
+            yield curr
+            curr += self.interval
+
+
+def compile_certain_days(weekdays, ordinals, months) -> CertainDaysRule:
+    """Build a rule from three sequences of booleans.
+    :param weekdays: Seven booleans, Monday first.
+    :param ordinals: Six booleans: first, second, third, fourth, last, every.
+    :param months: Twelve booleans, January first.
+    """
+    ordinal_bits = [ORD_FIRST, ORD_SECOND, ORD_THIRD, ORD_FOURTH, ORD_LAST, ORD_EVERY]
+    return CertainDaysRule(
+        weekdays=_mask(*[1 << n for n, chosen in enumerate(weekdays) if chosen]),
+        ordinals=_mask(*[bit for bit, chosen in zip(ordinal_bits, ordinals) if chosen]),
+        months=_mask(*[1 << n for n, chosen in enumerate(months, start=1) if chosen]),
+    )
@@ -1,9 +1,9 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.dispatch import receiver
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
 from members.models import Member, Tag, Tagging
-from tasks.models import Worker
+from tasks.models import Worker, Snippet, Task, Claim
 
 __author__ = 'Adrian'
 
@@ -21,3 +21,21 @@ def act_on_new_tag(sender, **kwargs):
 def create_default_worker(sender, **kwargs):
     if kwargs.get('created', True):
         w,_ = Worker.objects.get_or_create(member=kwargs.get('instance'))
+
+
+@receiver(post_save, sender=Snippet)
+@receiver(post_delete, sender=Snippet)
+def invalidate_snippet_expansions(sender, **kwargs):
+    Snippet.invalidate_expansions()
+
+
+@receiver(post_save, sender=Task)
+@receiver(post_delete, sender=Task)
+@receiver(post_save, sender=Claim)
+@receiver(post_delete, sender=Claim)
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(m2m_changed, sender=Task.eligible_claimants.through)
+@receiver(m2m_changed, sender=Task.eligible_tags.through)
+def forget_open_tasks_snapshot(sender, **kwargs):
+    Task.forget_open_tasks_snapshot()
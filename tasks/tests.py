@@ -1,6 +1,8 @@
 # Standard
 from datetime import datetime, date, timedelta, time
 from pydoc import locate  # for loading classes
+from io import StringIO
+from unittest.mock import patch
 import os
 
 # Third Party
@@ -19,8 +21,9 @@ from rest_framework.test import force_authenticate
 
 # Local
 from tasks.models import RecurringTaskTemplate, Task, TaskNote, Claim, Work, WorkNote, Nag, Snippet
-from members.models import Member, Tag, VisitEvent
+from members.models import Member, Tag, Tagging, VisitEvent
 import tasks.restapi as restapi
+from members.tests import DirectorsOnlyMixin
 
 ONEDAY = timedelta(days=1)
 TWODAYS   = 2 * ONEDAY
@@ -292,6 +295,53 @@ class TestTemplateToInstanceCopy(TransactionTestCase):
         self.assertEqual(set(task.eligible_tags.all()), set(template.eligible_tags.all()))
 
 
+class TestBulkTaskCreation(TestCase):
+
+    def setUp(self):
+        self.claimant = User.objects.create_user(username='claimant', password='123').member
+        self.rt = RecurringTaskTemplate.objects.create(
+            short_desc="bulk test",
+            max_work=timedelta(hours=2),
+            work_start_time=time(18, 00),
+            work_duration=timedelta(hours=2),
+            start_date=date.today(),
+            repeat_interval=7,
+            default_claimant=self.claimant,
+        )
+        self.rt.full_clean()
+        self.rt.eligible_claimants.add(self.claimant)
+        self.rt.eligible_tags.add(Tag.objects.get(name="Member"))
+
+    def test_instances_and_related_rows(self):
+        created = self.rt.create_tasks(max_days_in_advance=60)
+        tasks = Task.objects.filter(recurring_task_template=self.rt)
+        self.assertEqual(created, len(tasks))
+        self.assertGreater(created, 0)
+        for task in tasks:
+            self.assertEqual(list(task.eligible_claimants.all()), [self.claimant])
+            self.assertEqual(task.eligible_tags.count(), 1)
+            self.assertEqual(task.current_claimants(), {self.claimant})
+        # Running again shouldn't create anything new.
+        self.assertEqual(self.rt.create_tasks(max_days_in_advance=60), 0)
+
+    def test_occupied_dates_are_skipped(self):
+        # Find the dates the template would use, then start over with its first date taken by another task.
+        unoccupied_count = self.rt.create_tasks(max_days_in_advance=60)
+        first_date = self.rt.instances.order_by('scheduled_date').first().scheduled_date
+        self.rt.instances.all().delete()
+        Task.objects.create(
+            short_desc=self.rt.short_desc,
+            max_work=timedelta(hours=2),
+            work_start_time=self.rt.work_start_time,
+            work_duration=timedelta(hours=2),
+            scheduled_date=first_date,
+            orig_sched_date=first_date,
+        )
+        created = self.rt.create_tasks(max_days_in_advance=60)
+        self.assertEqual(created, unoccupied_count - 1)
+        self.assertFalse(self.rt.instances.filter(scheduled_date=first_date).exists())
+
+
 class TestRecurringTaskTemplateCertainDays(TestCase):
 
     def setUp(self):
@@ -337,6 +387,106 @@ class TestRecurringTaskTemplateIntervals(TransactionTestCase):
         self.assertEqual(len(Task.objects.all()), 13)
 
 
+class TestRecurrenceRule(TestCase):
+
+    def test_certain_days_occurrences(self):
+        rt = RecurringTaskTemplate(
+            short_desc="a test",
+            max_work=timedelta(hours=1.5),
+            start_date=date(2016, 1, 1),
+            first=True, third=True, last=True,
+            tuesday=True, saturday=True,
+            jun=False, jul=False,
+        )
+        rule = rt.recurrence_rule()
+        start = date(2016, 1, 1)
+        end = date(2017, 12, 31)
+        occurrences = list(rule.occurrences(start, end))
+        expected = []
+        day = start
+        while day <= end:
+            if rule.matches(day): expected.append(day)
+            day += ONEDAY
+        self.assertEqual(occurrences, expected)
+        self.assertIn(date(2016, 12, 31), occurrences)  # Last Saturday of December.
+        self.assertIn(date(2016, 11, 15), occurrences)  # Third Tuesday of November.
+        self.assertNotIn(date(2016, 11, 8), occurrences)  # Second Tuesday of November.
+        self.assertFalse([d for d in occurrences if d.month in [6, 7]])
+
+    def test_interval_occurrences(self):
+        rt = RecurringTaskTemplate(
+            short_desc="a test",
+            max_work=timedelta(hours=1.5),
+            start_date=date(2016, 1, 1),
+            repeat_interval=14,
+        )
+        rule = rt.recurrence_rule(last_date=date(2016, 1, 1))
+        self.assertEqual(
+            list(rule.occurrences(date(2016, 1, 2), date(2016, 2, 12))),
+            [date(2016, 1, 15), date(2016, 1, 29), date(2016, 2, 12)])
+        # If the next date has already passed, the first occurrence is the start of the range.
+        self.assertEqual(
+            list(rule.occurrences(date(2016, 3, 1), date(2016, 3, 20))),
+            [date(2016, 3, 1), date(2016, 3, 15)])
+
+
+class TestEligibility(TestCase):
+
+    def setUp(self):
+        self.by_name = User.objects.create_user(username='byname', password='123').member
+        self.by_tag = User.objects.create_user(username='bytag', password='123').member
+        self.neither = User.objects.create_user(username='neither', password='123').member
+        tag = Tag.objects.create(name="Eligibility Test", meaning="For testing eligibility")
+        Tagging.objects.create(tagged_member=self.by_tag, tag=tag)
+        self.task = Task.objects.create(short_desc="Eligibility test", max_work=timedelta(hours=1))
+        self.task.eligible_claimants.add(self.by_name)
+        self.task.eligible_tags.add(tag)
+        self.other_task = Task.objects.create(short_desc="Nobody eligible", max_work=timedelta(hours=1))
+
+    def test_eligible_members(self):
+        self.assertEqual(set(self.task.eligible_members()), {self.by_name, self.by_tag})
+        self.assertEqual(self.task.all_eligible_claimants(), {self.by_name, self.by_tag})
+        self.assertEqual(self.other_task.all_eligible_claimants(), set())
+
+    def test_eligible_for(self):
+        self.assertEqual(list(Task.objects.eligible_for(self.by_name)), [self.task])
+        self.assertEqual(list(Task.objects.eligible_for(self.by_tag)), [self.task])
+        self.assertEqual(list(Task.objects.eligible_for(self.neither)), [])
+        self.assertTrue(self.task.is_eligible(self.by_tag))
+        self.assertFalse(self.task.is_eligible(self.neither))
+        self.assertFalse(self.other_task.is_eligible(self.by_name))
+
+
+class TestOpenTasksSnapshot(TestCase):
+
+    def setUp(self):
+        self.member = User.objects.create_user(username='snapper', password='123').member
+        self.today_task = Task.objects.create(short_desc="Today", max_work=timedelta(hours=1), scheduled_date=date.today())
+        self.anytime_task = Task.objects.create(short_desc="Anytime", max_work=timedelta(hours=1))
+        Task.objects.create(short_desc="Tomorrow", max_work=timedelta(hours=1), scheduled_date=date.today()+ONEDAY)
+        self.today_task.eligible_claimants.add(self.member)
+        self.anytime_task.eligible_tags.add(Tag.objects.get(name="Member"))
+
+    def test_contents(self):
+        snapshot = Task.open_tasks_snapshot()
+        self.assertEqual([t for t, _, _, _ in snapshot], [self.today_task, self.anytime_task])
+        _, member_pks, tag_names, has_claims = snapshot[0]
+        self.assertEqual(member_pks, {self.member.pk})
+        self.assertFalse(has_claims)
+        _, member_pks, tag_names, _ = snapshot[1]
+        self.assertEqual(tag_names, {"Member"})
+        with self.assertNumQueries(0):
+            Task.open_tasks_snapshot()
+
+    def test_claim_invalidates(self):
+        Task.open_tasks_snapshot()
+        Claim.objects.create(
+            claimed_task=self.today_task, claiming_member=self.member,
+            claimed_duration=timedelta(hours=1), status=Claim.STAT_CURRENT)
+        _, _, _, has_claims = Task.open_tasks_snapshot()[0]
+        self.assertTrue(has_claims)
+
+
 class TestPriorityMatch(TestCase):
 
     def testPrioMatch(self):
@@ -605,9 +755,108 @@ class RunSchedAndNagCmds(TestCase):
 
     def test_run_nagger(self):
         management.call_command("scheduletasks", "2")
-        management.call_command("nag")
+        out = StringIO()
+        management.call_command("nag", stdout=out)
         self.assertEqual(len(mail.outbox), 1)
         self.assertEqual(len(Nag.objects.all()), 1)
+        self.assertIn("Sent 1 of 1 nag email(s).", out.getvalue())
+
+    def test_plan_nags(self):
+        from tasks.management.commands.nag import Command as NagCmd
+        management.call_command("scheduletasks", "2")
+        member = self.user.member
+        tasks = list(self.rt.instances.all())
+        self.assertEqual(NagCmd.plan_nags(date.today()), {member: tasks})
+
+        # Uninterested members aren't nagged about the task.
+        Claim.objects.create(
+            claimed_task=tasks[0], claiming_member=member, claimed_start_time=time(19, 0, 0),
+            claimed_duration=timedelta(0), status=Claim.STAT_UNINTERESTED)
+        self.assertEqual(NagCmd.plan_nags(date.today()), {member: tasks[1:]})
+
+        # Members that have opted out aren't nagged at all.
+        member.worker.should_nag = False
+        member.worker.save()
+        self.assertEqual(NagCmd.plan_nags(date.today()), {})
+
+    def test_nags_in_bulk(self):
+        management.call_command("scheduletasks", "2")
+        member = self.user.member
+        tasks = list(self.rt.instances.all())
+        results = Nag.create_in_bulk([(member, tasks, []), (member, tasks[:1], [])])
+        self.assertEqual(len(results), 2)
+        (nag1, b64_1), (nag2, b64_2) = results
+        self.assertNotEqual(b64_1, b64_2)
+        self.assertEqual(list(nag1.tasks.all()), tasks)
+        self.assertEqual(list(nag2.tasks.all()), tasks[:1])
+        self.assertEqual(nag1.who, member)
+        self.assertEqual(Nag.objects.count(), 2)
+
+    def test_token_collisions_are_replaced(self):
+        taken_once = []
+        def taken(md5s):
+            if len(taken_once) == 0:
+                taken_once.append(md5s[0])
+                return md5s[:1]
+            return []
+        tokens = Member.generate_auth_token_strs(5, taken)
+        self.assertEqual(len(tokens), 5)
+        self.assertNotIn(taken_once[0], [md5 for _, md5 in tokens])
+
+    def test_claim_rollups(self):
+        management.call_command("scheduletasks", "2")
+        member = self.user.member
+        for task in self.rt.instances.all():
+            Claim.objects.create(
+                claimed_task=task, claiming_member=member, claimed_start_time=time(19, 0, 0),
+                claimed_duration=timedelta(hours=1.5), status=Claim.STAT_CURRENT)
+        self.assertEqual(Claim.claimed_durations(), {member.pk: timedelta(hours=4.5)})
+        self.assertEqual(Claim.claimed_durations(date.today(), date.today()), {member.pk: timedelta(hours=1.5)})
+        self.assertEqual(Claim.claimed_durations(statuses=[Claim.STAT_DONE]), {})
+        self.assertEqual(Claim.sum_in_period(date.today(), date.today()+TWODAYS), {member: timedelta(hours=4.5)})
+        self.assertEqual(Claim.heavily_scheduled(timedelta(hours=4), TWODAYS), {member.pk})
+        self.assertEqual(Claim.heavily_scheduled(timedelta(hours=4), ONEDAY), set())
+
+    def test_slide_missed_dates(self):
+        from tasks.management.commands.scheduletasks import Command as SchedCmd
+        slider = RecurringTaskTemplate.objects.create(
+            short_desc="Slide Test",
+            max_work=timedelta(hours=1),
+            start_date=date.today() - THREEDAYS,
+            repeat_interval=1,
+            missed_date_action=Task.MDA_SLIDE_SELF_AND_LATER,
+        )
+        with freeze_time(date.today() - THREEDAYS):
+            slider.create_tasks(2)
+        orig_dates = sorted(slider.instances.values_list('scheduled_date', flat=True))
+        self.assertEqual(orig_dates[0], date.today() - THREEDAYS)
+
+        self.rt.create_tasks(1)  # Not slipped, so shouldn't be touched.
+        self.assertEqual(SchedCmd.reschedule_missed_dates(), (1, 3))
+        new_dates = sorted(slider.instances.values_list('scheduled_date', flat=True))
+        self.assertEqual(new_dates, [d + THREEDAYS for d in orig_dates])
+        self.assertEqual(self.rt.instances.order_by('scheduled_date')[0].scheduled_date, date.today())
+        self.assertEqual(SchedCmd.reschedule_missed_dates(), (0, 0))
+
+    def test_template_failures_are_reported(self):
+        from tasks.management.commands.scheduletasks import Command as SchedCmd
+        with self.assertRaises(management.CommandError):
+            management.call_command("scheduletasks", "2", workers=0)
+        self.assertEqual(self.rt.instances.count(), 0)
+
+        broken = RecurringTaskTemplate.objects.create(short_desc="Broken", max_work=timedelta(hours=1),
+            start_date=date.today(), repeat_interval=1, instructions="Broken {{instructions}}")
+        expand = Snippet.expand
+        def fail_for_broken(instr):
+            if instr == broken.instructions:
+                raise ValueError("Broken instructions")
+            return expand(instr)
+        with patch.object(Snippet, 'expand', side_effect=fail_for_broken):
+            timings, failures = SchedCmd.add_new_tasks(2)
+        self.assertEqual([pk for pk, _, _, _ in timings], [self.rt.pk])
+        self.assertEqual(failures, [(broken.pk, "Broken instructions")])
+        self.assertEqual(broken.instances.count(), 0)
+        self.assertGreater(self.rt.instances.count(), 0)
 
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
@@ -885,3 +1134,41 @@ class TestSnippets(TestCase):
         expected_expansion = test_string % Snippet.BAD_SNIPPET_REF_STR
         result = Snippet.expand(unexpanded)
         self.assertEqual(result, expected_expansion)
+
+    def test_nested_refs(self):
+        Snippet.objects.create(name="outer", description="for testing purposes", text="<{{foo}}|{{bar}}>")
+        result = Snippet.expand("Nested: {{outer}}")
+        self.assertEqual(result, "Nested: <%s|%s>" % (TestSnippets.snippet1_content, TestSnippets.snippet2_content))
+
+    def test_circular_refs(self):
+        Snippet.objects.create(name="ping", description="for testing purposes", text="ping {{pong}}")
+        Snippet.objects.create(name="pong", description="for testing purposes", text="pong {{ping}}")
+        result = Snippet.expand("{{ping}}")
+        self.assertEqual(result, "ping pong %s" % Snippet.BAD_SNIPPET_REF_STR)
+
+    def test_edit_invalidates_cache(self):
+        unexpanded = "Cached {{foo}}"
+        self.assertEqual(Snippet.expand(unexpanded), "Cached " + TestSnippets.snippet1_content)
+        snippet = Snippet.objects.get(name=TestSnippets.snippet1_name)
+        snippet.text = "changed"
+        snippet.save()
+        self.assertEqual(Snippet.expand(unexpanded), "Cached changed")
+
+
+class TestWorkCsv(DirectorsOnlyMixin, TestCase):
+
+    directors_only_urls = ['task:csv-work']
+
+    def setUp(self):
+        super().setUp()
+        task = Task.objects.create(short_desc="Sweep", max_work=timedelta(hours=2), scheduled_date=date(2016, 6, 20))
+        claim = Claim.objects.create(
+            claimed_task=task, claiming_member=self.member, claimed_duration=timedelta(hours=2), status=Claim.STAT_DONE)
+        for hours in [1, 1.5]:
+            Work.objects.create(claim=claim, work_date=date(2016, 6, 20), work_duration=timedelta(hours=hours))
+
+    def test_work(self):
+        response = self.get_as_director('task:csv-work')
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], "id,work date,hours,member,task,task date")
+        self.assertEqual([line.split(",")[2:5] for line in lines[1:]], [["1.0", "notdirector", "Sweep"], ["1.5", "notdirector", "Sweep"]])
@@ -51,6 +51,9 @@ urlpatterns = [
     url(r'^desktop-timesheet/$', views.desktop_timesheet, name='desktop-timesheet'),
     url(r'^desktop-timesheet-verify/$', views.desktop_timesheet_verify, name='desktop-timesheet-verify'),
 
+    # Director exports
+    url(r'^csv/work/$', views.csv_work_download, name='csv-work'),
+
     # DJANGO REST FRAMEWORK API
     url(r'^api/', include(router.urls)),
 
@@ -22,6 +22,7 @@ from tasks.models import Task, Nag, Claim, Work, WorkNote, Worker, TimeWindowedO
 from members.models import Member, VisitEvent
 from members.signals.handlers import note_login
 from members.views import kiosk_visitevent_contentprovider
+from abutils.utils import iterate_in_chunks, streaming_csv_response
 
 
 # = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = = =
@@ -60,23 +61,22 @@ def visitevent_arrival_content(member, member_card_str, visit_event_type):
     for claim in member.claim_set.filter(
       claimed_task__status=Task.STAT_ACTIVE,
       status__in=[Claim.STAT_CURRENT, Claim.STAT_WORKING],
-      claimed_task__scheduled_date=date.today()):
+      claimed_task__scheduled_date=date.today()).select_related('claimed_task'):
         if not claim.in_window_now(start_leeway=-halfhour): continue
         if claim.status == Claim.STAT_CURRENT:
             claimed_today.append((claim.claimed_task, task_button_text(claim)))
         if claim.status == Claim.STAT_WORKING:
             working_today.append((claim.claimed_task, task_button_text(claim)))
 
-    # Find today's unclaimed tasks:
-    for task in Task.objects.filter(status=Task.STAT_ACTIVE, scheduled_date=date.today()):
+    # Find today's unclaimed tasks and unclaimed tasks with no scheduled date:
+    member_tag_names = member.tag_map().keys()
+    for task, eligible_pks, eligible_tag_names, has_claims in Task.open_tasks_snapshot():
+        if has_claims: continue
+        if member.pk not in eligible_pks and eligible_tag_names.isdisjoint(member_tag_names): continue
         if not task.in_window_now(start_leeway=-halfhour): continue
-        if member in task.all_eligible_claimants() and task.claimants.count() == 0:
+        if task.scheduled_date is not None:
             unclaimed_today.append((task, task_button_text(task)))
-
-    # Find unclaimed tasks with no scheduled date:
-    for task in Task.objects.filter(status=Task.STAT_ACTIVE, scheduled_date__isnull=True):
-        if not task.in_window_now(start_leeway=-halfhour): continue
-        if member in task.all_eligible_claimants() and task.claimants.count() == 0:
+        else:
             unclaimed_anytime.append((task, task_button_text(task)))
 
     template = loader.get_template('tasks/check_in_content.html')
@@ -189,12 +189,11 @@ def offer_more_tasks(request, task_pk, auth_token):
             recurring_task_template=task.recurring_task_template,
             scheduled_date__gt=task.scheduled_date,
             status=Task.STAT_ACTIVE
-        )
+        ).eligible_for(nag.who)
         future_instances_same_dow = []
         for instance in all_future_instances:
             if instance.scheduled_weekday() == task.scheduled_weekday() \
-               and instance.unclaimed_hours() == instance.max_work \
-               and nag.who in instance.all_eligible_claimants():
+               and instance.unclaimed_hours() == instance.max_work:
                 future_instances_same_dow.append(instance)
             if len(future_instances_same_dow) > 3:  # Don't overwhelm potential worker.
                 break
@@ -332,7 +331,8 @@ def offer_task_spa(request, task_pk=0, auth_token=""):
 
     futures = task.all_future_instances_same_dow()
     futures = [x for x in futures if len(x.claim_set.all()) == 0]
-    futures = [x for x in futures if nag.who in x.all_eligible_claimants()]
+    eligible_pks = set(Task.objects.eligible_for(nag.who).filter(pk__in=[x.pk for x in futures]).values_list('pk', flat=True))
+    futures = [x for x in futures if x.pk in eligible_pks]
     futures = sorted(futures, key=lambda x: x.scheduled_date)
     futures = [x.pk for x in futures]
 
@@ -442,7 +442,7 @@ def will_work_now(request, task_pk, member_card_str):
         # This message doesn't need to be logged since it's an expected error.
         return JsonResponse({"error": "Looks like somebody else just claimed it, so you can't."})
 
-    if member not in task.all_eligible_claimants():
+    if not task.is_eligible(member):
         # There is a small chance that this will happen legitimately, so I'll call it a warning.
         msg = "You aren't eligible to claim this task."
         logging.getLogger("tasks").warning(msg)
@@ -720,3 +720,20 @@ def desktop_timesheet_verify(request):
     else:  # For GET and any other methods:
         return render(request, 'tasks/desktop_timesheet_verify.html', {})
 
+
+@login_required
+def csv_work_download(request):
+    if not request.user.member.is_tagged_with("Director"):
+        return HttpResponse("This page is for Directors only.")
+
+    works = Work.objects.select_related('claim__claiming_member__auth_user', 'claim__claimed_task')
+    rows = (
+        [
+            work.pk, work.work_date, work.work_duration.total_seconds() / 3600.0,
+            work.claim.claiming_member.username, work.claim.claimed_task.short_desc,
+            work.claim.claimed_task.scheduled_date or ""
+        ]
+        for work in iterate_in_chunks(works)
+    )
+    header = ["id", "work date", "hours", "member", "task", "task date"]
+    return streaming_csv_response("work.csv", header, rows)
@@ -0,0 +1,27 @@
+# Queues periodic jobs for the rq worker. See Procfile.
+
+# Standard
+import os
+import sys
+import time
+
+TICK = 5  # Seconds between checks for work that's due.
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "xerocraft.settings")
+    import django
+    django.setup()
+
+    from django.conf import settings
+    from modelmailer.outbox import request_drain
+    from members.notifications import flush_if_due
+
+    last_drain = None
+    while True:
+        # Retries come due without anything new being queued, so they need a periodic drain.
+        if last_drain is None or time.monotonic() - last_drain >= settings.INTSYS_OUTBOX_DRAIN_INTERVAL:
+            request_drain()
+            last_drain = time.monotonic()
+        flush_if_due()
+        time.sleep(TICK)
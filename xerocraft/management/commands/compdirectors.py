@@ -36,7 +36,7 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
 
-        for member in Tag.objects.get(name="Director").members.all():
-            if member.is_currently_paid(): continue
+        for member in Tag.objects.get(name="Director").members.with_paid_status():
+            if member.is_paid: continue
             self.handle_member(member)
 
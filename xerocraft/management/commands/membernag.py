@@ -12,7 +12,7 @@ from django.utils import timezone
 from freezegun import freeze_time
 
 # Local
-from members.models import Membership, VisitEvent, PaidMembershipNudge
+from members.models import Membership, VisitEvent, PaidMembershipNudge, Tagging
 
 __author__ = 'adrian'
 
@@ -96,17 +96,16 @@ class Command(BaseCommand):
             self.logger.info("Email sent to %s re bad visit.", member.username)
             PaidMembershipNudge.objects.create(member=member)
 
-    def during_open_hack(self, visit):
-        assert timezone.localtime(visit.when).date() == self.yesterday.date()
+    def open_hack_windows(self):
+        """Aware datetime ranges, including leeway, during which yesterday's visits are OK."""
         time_leeway = timedelta(hours=1)
+        windows = []
         for (hack_dow, hack_start, hack_end) in OPENHACKS:
-            visit_dow = timezone.localtime(visit.when).weekday()
-            if visit_dow == hack_dow:
-                hack_start = self.tz.localize(datetime.combine(self.yesterday, hack_start))
-                hack_end = self.tz.localize(datetime.combine(self.yesterday, hack_end))
-                if hack_start-time_leeway <= visit.when <= hack_end+time_leeway:
-                    return True
-        return False
+            if self.yesterday.weekday() == hack_dow:
+                hack_start = self.tz.localize(datetime.combine(self.yesterday.date(), hack_start))
+                hack_end = self.tz.localize(datetime.combine(self.yesterday.date(), hack_end))
+                windows.append((hack_start-time_leeway, hack_end+time_leeway))
+        return windows
 
     def nag_for_unpaid_visits(self):
 
@@ -116,18 +115,25 @@ class Command(BaseCommand):
         date_leeway = timedelta(days=14)
 
         yesterdays_visits = VisitEvent.objects.filter(when__range=[self.yesterday, self.today])
-        for visit in yesterdays_visits:
 
-            # Ignore the visit if it was during open hacks because all open hack visits are OK.
-            if self.during_open_hack(visit): continue
+        # Ignore visits during open hacks because all open hack visits are OK.
+        for (window_start, window_end) in self.open_hack_windows():
+            yesterdays_visits = yesterdays_visits.exclude(when__range=[window_start, window_end])
+
+        # Ignore visits by directors (who have decided they don't need to pay)
+        directors = Tagging.objects.filter(tag__name="Director").values('tagged_member')
+        yesterdays_visits = list(yesterdays_visits.exclude(who__in=directors).select_related('who__auth_user'))
 
-            # Ignore visits by directors (who have decided they don't need to pay)
-            if visit.who.is_tagged_with("Director"): continue
+        # Get most recent membership for each visitor, all in one query.
+        visitor_pks = set(visit.who_id for visit in yesterdays_visits)
+        latest_memberships = {}
+        for pm in Membership.objects.filter(member__in=visitor_pks).order_by('start_date'):
+            latest_memberships[pm.member_id] = pm
+
+        for visit in yesterdays_visits:
 
-            # Get most recent membership for visitor.
-            try:
-                pm = Membership.objects.filter(member=visit.who).latest('start_date')
-            except Membership.DoesNotExist:
+            pm = latest_memberships.get(visit.who_id)
+            if pm is None:
                 # Don't nag people that have NEVER paid because either:
                 #  1) It's too soon to bother the member.
                 #  2) The member is hopeless and will never pay.
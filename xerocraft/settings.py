@@ -330,3 +330,24 @@ INTSYS_ORG_NAME_POSSESSIVE = "Xerocraft's"
 #   (1) A DNS name that resolves to the facility's public IP
 #   (2) The facility's static IP address.
 INTSYS_FACILITY_PUBLIC_IP = os.getenv('INTSYS_FACILITY_PUBLIC_IP', None)
+
+# Kiosk check-in content providers run one after another if this is 0, else concurrently in this many threads.
+# When concurrent, a provider that takes longer than the timeout (in seconds) contributes nothing to the page.
+INTSYS_KIOSK_CONTENT_THREADS = int(os.getenv('INTSYS_KIOSK_CONTENT_THREADS', 0))
+INTSYS_KIOSK_CONTENT_TIMEOUT = 2.0
+
+# Bulk WiFi MAC detections within this many seconds of an earlier detection of the same MAC are dropped.
+INTSYS_WIFI_DEDUPE_WINDOW = 5*60
+
+# Background jobs are run by the rq worker (xerocraft/worker.py) when a Redis server is provisioned.
+# Otherwise, they are run immediately in the process that requested them.
+INTSYS_REDIS_URL = os.getenv('REDISTOGO_URL', 'redis://localhost:6379')
+INTSYS_ASYNC_JOBS = 'REDISTOGO_URL' in os.environ
+
+# The clock process (xerocraft/clock.py) queues a drain of the email outbox this often, in seconds,
+# so that retries go out when they come due.
+INTSYS_OUTBOX_DRAIN_INTERVAL = 5*60
+
+# Pushover notifications are held for this many seconds after the first of them is queued, and then the
+# clock process has the rq worker send them as one digest per recipient.
+INTSYS_NOTIFICATION_WINDOW = 60
@@ -2,6 +2,7 @@
 
 # Standard
 import os
+import sys
 
 # Third Party
 import redis
@@ -14,6 +15,12 @@ redis_url = os.getenv('REDISTOGO_URL', 'redis://localhost:6379')
 conn = redis.from_url(redis_url)
 
 if __name__ == '__main__':
+    # Jobs use the Django models, so set Django up before taking any.
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "xerocraft.settings")
+    import django
+    django.setup()
+
     with Connection(conn):
         worker = Worker(map(Queue, listen))
         worker.work()